@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the formula parser and of the equation, fit and harmonics models
+
+Run headless, with the ModelRunner, on synthetic DataToExport of various sizes, the results
+are written to a json file so that they can be compared between versions::
+
+    python benchmarks/bench_datamixer.py --output results.json
+    python benchmarks/bench_datamixer.py --quick --compare results.json
+"""
+import argparse
+import json
+import platform
+import sys
+import timeit
+from datetime import datetime
+from importlib import metadata
+from typing import Callable, Dict, List
+
+import numpy as np
+
+from pymodaq_data.data import DataToExport, DataRaw, Axis
+
+from pymodaq_plugins_datamixer.extensions.utils.runner import ModelRunner
+from pymodaq_plugins_datamixer.extensions.utils.parser import (
+    split_formulae, replace_names_in_formula, Formula, FormulaGraph)
+from pymodaq_plugins_datamixer.models.equation_model import DataMixerModelEquation
+from pymodaq_plugins_datamixer.models.fit_model import DataMixerModelFit, gaussian_fit
+from pymodaq_plugins_datamixer.models.harmonics_model import DataMixerModelFit as DataMixerModelHarmonics
+
+
+SIZES_0D = [1, 10, 100]  # number of channels
+SIZES_1D = [1024, 4096, 16384, 65536]
+SIZES_2D = [(256, 256), (1024, 1024), (2048, 2048)]
+QUICK_SIZES_1D = [1024, 16384]
+QUICK_SIZES_2D = [(256, 256), (512, 512)]
+
+rng = np.random.default_rng(0)
+
+
+def make_dte(size_0d: int = 1, size_1d: int = 1024, size_2d=(256, 256)) -> DataToExport:
+    """ Synthetic detectors: a 0D one with size_0d channels, a spectrometer and a camera"""
+    x = np.linspace(0, 100, size_1d)
+    spectrum = gaussian_fit(x, 2., 40., 5., 0.1) + 0.5 * gaussian_fit(x, 1., 70., 3., 0.)
+    y_2d, x_2d = np.arange(size_2d[0]), np.linspace(0, 100, size_2d[1])
+    image = (gaussian_fit(x_2d, 1., 50., 10., 0.)[None, :] +
+             rng.normal(0, 0.01, size_2d))
+    return DataToExport('Benchmark', data=[
+        DataRaw('Counts', data=[rng.normal(1, 0.1, (1,)) for _ in range(size_0d)], origin='Det0D'),
+        DataRaw('Spectro', data=[spectrum + rng.normal(0, 0.01, x.shape)], origin='Spectro',
+                axes=[Axis('x', data=x, index=0)]),
+        DataRaw('Image', data=[image], origin='Camera',
+                axes=[Axis('y', data=y_2d.astype(float), index=0), Axis('x', data=x_2d, index=1)]),
+    ])
+
+
+def make_model(model_class, dte: DataToExport, settings: dict = None):
+    """ Instantiate a model outside of the dashboard, its data being those of dte"""
+    return ModelRunner(model_class, settings, data=dte).model
+
+
+def measure(function: Callable, autorange: bool = True, repeat: int = 5) -> Dict[str, float]:
+    """ Time a function, calibrating the number of calls per measurement like timeit if
+    autorange, otherwise calling it once per measurement"""
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange() if autorange else (1, None)
+    times = np.array(timer.repeat(repeat=repeat, number=number)) / number
+    return dict(best=float(times.min()), mean=float(times.mean()), median=float(np.median(times)),
+                number=number, repeat=repeat)
+
+
+def bench_parser(quick: bool) -> List[dict]:
+    results = []
+    for n_lines in [1, 10, 100]:
+        formulae = '\n'.join([f'np.abs({{Spectro/Spectro}} * {ind}) + {{Det0D/Counts}}'
+                              f' - {{Camera/Image}}.mean()' for ind in range(n_lines)])
+        results.append(dict(name='split_formulae', size=n_lines,
+                            **measure(lambda: split_formulae(formulae))))
+        results.append(dict(name='replace_names_in_formula', size=n_lines,
+                            **measure(lambda: [replace_names_in_formula(formula)
+                                               for formula in split_formulae(formulae)])))
+        results.append(dict(name='FormulaGraph', size=n_lines,
+                            **measure(lambda: FormulaGraph(formulae))))
+    return results
+
+
+def bench_equation(quick: bool) -> List[dict]:
+    results = []
+    for size in SIZES_0D:
+        dte = make_dte(size_0d=size)
+        model = make_model(DataMixerModelEquation, dte)
+        formula = Formula('{Det0D/Counts} * 2 + 1', name='out')  # compiled once, as in the model
+        results.append(dict(name='compute_formula_0D', size=size, **measure(
+            lambda: model.compute_formula(formula, dte, 'out'))))
+    for size in QUICK_SIZES_1D if quick else SIZES_1D:
+        dte = make_dte(size_1d=size)
+        model = make_model(DataMixerModelEquation, dte)
+        formula = Formula('np.abs({Spectro/Spectro} - 0.1) * 2', name='out')
+        results.append(dict(name='compute_formula_1D', size=size, **measure(
+            lambda: model.compute_formula(formula, dte, 'out'))))
+    for shape in QUICK_SIZES_2D if quick else SIZES_2D:
+        dte = make_dte(size_2d=shape)
+        size = shape[0] * shape[1]
+        for engine in ['DataWithAxes', 'ndarray']:
+            model = make_model(DataMixerModelEquation, dte, dict(
+                engine=engine, edit_formula='np.abs({Camera/Image} - 0.1) * 2\n'
+                                            '{Camera/Image} / ({Camera/Image} + 1)'))
+            results.append(dict(name=f'process_dte_2D_{engine}', size=size,
+                                **measure(lambda: model.process_dte(dte))))
+    return results
+
+
+def bench_fit(quick: bool) -> List[dict]:
+    results = []
+    for size in QUICK_SIZES_1D if quick else SIZES_1D:
+        dte = make_dte(size_1d=size)
+        for tracking in [False, True]:
+            model = make_model(DataMixerModelFit, dte, dict(tracking=tracking, coeffs_only=True))
+            results.append(dict(name=f'fit_1D{"_tracking" if tracking else ""}', size=size,
+                                **measure(lambda: model.process_dte(dte))))
+    for shape in QUICK_SIZES_2D if quick else SIZES_2D:
+        dte = make_dte(size_2d=shape)
+        model = make_model(DataMixerModelFit, dte, dict(source='Camera/Image', batch=True))
+        results.append(dict(name='fit_2D_batch', size=shape[0] * shape[1],
+                            **measure(lambda: model.process_dte(dte), autorange=False, repeat=3)))
+    return results
+
+
+def bench_harmonics(quick: bool) -> List[dict]:
+    results = []
+    for size in QUICK_SIZES_1D if quick else SIZES_1D:
+        dte = make_dte(size_1d=size)
+        dte = DataToExport('Benchmark', data=[dte.get_data_from_full_name('Spectro/Spectro')])
+        for tracking in [False, True]:
+            model = make_model(DataMixerModelHarmonics, dte,
+                               {('find_peaks', 'tracking'): tracking})
+            results.append(dict(name=f'harmonics{"_tracking" if tracking else ""}', size=size,
+                                **measure(lambda: model.process_dte(dte))))
+    return results
+
+
+BENCHMARKS = {'parser': bench_parser, 'equation': bench_equation, 'fit': bench_fit,
+              'harmonics': bench_harmonics}
+
+
+def get_versions() -> Dict[str, str]:
+    versions = {'python': platform.python_version(), 'platform': platform.platform()}
+    for package in ['pymodaq_plugins_datamixer', 'pymodaq', 'pymodaq_data', 'numpy', 'scipy']:
+        try:
+            versions[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            versions[package] = ''
+    return versions
+
+
+def compare(results: List[dict], reference: List[dict]):
+    """ Print the ratio of the best times to those of a previous run"""
+    reference_times = {(result['name'], result['size']): result['best'] for result in reference}
+    for result in results:
+        key = (result['name'], result['size'])
+        if key in reference_times:
+            ratio = result['best'] / reference_times[key]
+            print(f'{result["name"]:<32} {result["size"]:>10} {ratio:8.2f}x'
+                  f'{"  <- slower" if ratio > 1.2 else ""}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--output', default='benchmark_results.json',
+                        help='json file where to write the results')
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), default=list(BENCHMARKS),
+                        help='benchmarks to run')
+    parser.add_argument('--quick', action='store_true', help='only run the smaller sizes')
+    parser.add_argument('--compare', help='json file of a previous run to compare to')
+    args = parser.parse_args(argv)
+
+    results = []
+    for name in args.only:
+        for result in BENCHMARKS[name](args.quick):
+            result['benchmark'] = name
+            print(f'{result["name"]:<32} {result["size"]:>10} {result["best"] * 1e3:12.4f} ms')
+            results.append(result)
+
+    with open(args.output, 'w') as f:
+        json.dump({'date': datetime.now().isoformat(), 'versions': get_versions(),
+                   'quick': args.quick, 'results': results}, f, indent=1)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f)['results'])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
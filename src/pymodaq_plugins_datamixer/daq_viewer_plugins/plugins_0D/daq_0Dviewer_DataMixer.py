@@ -1,4 +1,5 @@
-from typing import TYPE_CHECKING
+from time import perf_counter
+from typing import Optional, TYPE_CHECKING
 import numpy as np
 
 from pymodaq_utils.utils import ThreadCommand
@@ -11,6 +12,8 @@ from pymodaq.utils.data import DataFromPlugins
 if TYPE_CHECKING:
     from pymodaq_plugins_datamixer.extensions.data_mixer import DataMixer
 
+GRAB_MODES = ['Snap detectors', 'Cached result']
+
 
 class DAQ_0DViewer_DataMixer(DAQ_Viewer_base):
     """ Instrument plugin class for a OD viewer.
@@ -25,10 +28,24 @@ class DAQ_0DViewer_DataMixer(DAQ_Viewer_base):
          hardware library.
 
     """
-    params = comon_parameters+[]
+    params = comon_parameters+[
+        {'title': 'Grab mode:', 'name': 'grab_mode', 'type': 'list', 'limits': GRAB_MODES,
+         'value': GRAB_MODES[0],
+         'tip': 'Snap detectors: acquire all the DataMixer detectors and return the computed data\n'
+                'Cached result: never acquire, return the last computed data if recent enough or'
+                ' else the next ones, computed when the detectors acquire on their own, for'
+                ' instance within a scan'},
+        {'title': 'Max age (ms):', 'name': 'max_age', 'type': 'float', 'value': 0., 'min': 0.,
+         'tip': 'Cached result mode: maximum age of the returned computed data, each result being'
+                ' returned once. 0 to always wait for the next ones, as needed within a scan for'
+                ' the data to match the step'},
+    ]
 
     def ini_attributes(self):
         self.controller: DataMixer = None
+        self._last_dte: Optional[DataToExport] = None
+        self._last_time = 0.
+        self._waiting = False
 
     def commit_settings(self, param: Parameter):
         """Apply the consequences of a change of value in the detector settings
@@ -38,7 +55,8 @@ class DAQ_0DViewer_DataMixer(DAQ_Viewer_base):
         param: Parameter
             A given parameter (within detector_settings) whose value has been changed by the user
         """
-        pass
+        if param.name() == 'grab_mode':
+            self._waiting = False
 
     def ini_detector(self, controller=None):
         """Detector communication initialization
@@ -69,6 +87,15 @@ class DAQ_0DViewer_DataMixer(DAQ_Viewer_base):
         pass
 
     def grab_done(self, dte: DataToExport):
+        """ Emit the computed data or, in Cached result mode, emit them only if a grab is
+        waiting for them and otherwise keep them for the next grab"""
+        if self.settings['grab_mode'] == 'Cached result':
+            if not self._waiting:
+                self._last_dte = dte
+                self._last_time = perf_counter()
+                return
+            self._waiting = False
+            self._last_dte = None  # already served
         self.dte_signal.emit(dte)
 
     def grab_data(self, Naverage=1, **kwargs):
@@ -82,10 +109,20 @@ class DAQ_0DViewer_DataMixer(DAQ_Viewer_base):
         kwargs: dict
             others optionals arguments
         """
-        self.controller.snap()
+        if self.settings['grab_mode'] == 'Cached result':
+            max_age = self.settings['max_age'] / 1000
+            if (max_age > 0 and self._last_dte is not None and
+                    perf_counter() - self._last_time <= max_age):
+                dte, self._last_dte = self._last_dte, None  # a cached result is served once
+                self.dte_signal.emit(dte)
+            else:
+                self._waiting = True
+        else:
+            self.controller.snap()
 
     def stop(self):
         """Stop the current grab hardware wise if necessary"""
+        self._waiting = False
         return ''
 
 
@@ -1,7 +1,7 @@
 from qtpy import QtWidgets, QtCore
 import numpy as np
 
-from typing import Optional
+from typing import List, Optional, Union
 
 from pymodaq_gui import utils as gutils
 from pymodaq_utils.config import Config, ConfigError
@@ -14,11 +14,21 @@ from pymodaq.extensions.utils import CustomExt
 
 from pymodaq_gui.plotting.data_viewers.viewer import ViewerDispatcher
 from pymodaq_gui.utils.widgets.qled import QLED
-from pymodaq_gui.parameter import utils as putils
+from pymodaq_gui.parameter import Parameter, utils as putils
 
 from pymodaq_plugins_datamixer.utils import Config as PluginConfig
 from pymodaq.control_modules.utils import DAQTypesEnum
-from pymodaq_plugins_datamixer.extensions.utils.model import get_models, DataMixerModel
+from pymodaq_plugins_datamixer.extensions.utils.model import (get_models, load_model_class,
+                                                               DataMixerModel)
+from pymodaq_plugins_datamixer.extensions.utils.worker import (ModelWorker, FrameCounters,
+                                                                OVERLOAD_POLICIES)
+from pymodaq_plugins_datamixer.extensions.utils.join import JoinBuffer, JOIN_POLICIES
+from pymodaq_plugins_datamixer.extensions.utils.diagnostics import Diagnostics, DIAGNOSTICS_NAME
+from pymodaq_plugins_datamixer.extensions.utils.runner import (ModelRunner,
+                                                                HeadlessModulesManager)
+from pymodaq_plugins_datamixer.extensions.utils.pipeline import (ModelPipeline, PipelineStage,
+                                                                  DETECTORS_INPUT, is_descendant)
+from pymodaq_plugins_datamixer.extensions.utils.process import ProcessModelRunner, PROCESS_BACKENDS
 
 logger = set_logger(get_module_name(__file__))
 
@@ -29,6 +39,25 @@ EXTENSION_NAME = 'Data Mixer'  # the name that will be displayed in the extensio
 # dashboard
 CLASS_NAME = 'DataMixer'  # this should be the name of your class defined below
 
+DIAGNOSTICS_COLUMNS = ['Name', 'Count', 'Last (ms)', 'Mean (ms)', 'P99 (ms)', 'Errors']
+
+
+class SettingsSetter(QtCore.QObject):
+    """ Set parameter values within the thread owning the settings tree
+
+    Models process data in a worker thread while the settings are displayed in the GUI thread,
+    the value changes are hence forwarded through a queued signal when needed
+    """
+    value_signal = QtCore.Signal(object, object)
+
+    def __init__(self):
+        super().__init__()
+        self.value_signal.connect(self.set_value)
+
+    @staticmethod
+    def set_value(param: Parameter, value):
+        param.setValue(value)
+
 
 class DataMixer(CustomExt):
     settings_name = 'DataMixerSettings'
@@ -39,8 +68,68 @@ class DataMixer(CustomExt):
              {'title': 'Models class:', 'name': 'model_class', 'type': 'list',
               'limits': [d['name'] for d in models]},
              {'title': 'Ini Model', 'name': 'ini_model', 'type': 'action', },
+             {'title': 'Add Model', 'name': 'add_model', 'type': 'action',
+              'tip': 'Add a model of the selected class, processing the detectors data in'
+                     ' parallel or the output of another model'},
              {'title': 'Model params:', 'name': 'model_params', 'type': 'group', 'children': []},
+             {'title': 'Added models:', 'name': 'added_models', 'type': 'group', 'children': []},
 
+         ]},
+        {'title': 'Processing', 'name': 'processing', 'type': 'group', 'expanded': False,
+         'children': [
+             {'title': 'Backend:', 'name': 'backend', 'type': 'list', 'limits': PROCESS_BACKENDS,
+              'value': PROCESS_BACKENDS[0],
+              'tip': 'Run the model in a thread or, for CPU-bound models, in a separate process'
+                     ' receiving the frames through shared memory'},
+             {'title': 'Shared slot size (MB):', 'name': 'slot_size', 'type': 'float',
+              'value': 64., 'min': 1.,
+              'tip': 'Size of the shared memory for one frame with the Process backend, larger'
+                     ' frames are pickled'},
+             {'title': 'Select needed detectors:', 'name': 'select_detectors', 'type': 'bool',
+              'value': False,
+              'tip': 'Only grab the detectors providing the data the models read, uncheck to'
+                     ' select back the previous detectors and list all their data'},
+             {'title': 'Overload policy:', 'name': 'overload_policy', 'type': 'list',
+              'limits': OVERLOAD_POLICIES, 'value': OVERLOAD_POLICIES[0],
+              'tip': 'What to do with the incoming frames when the model is slower than the'
+                     ' detectors'},
+             {'title': 'Process every N:', 'name': 'every_n', 'type': 'int', 'value': 2,
+              'min': 1, 'tip': 'Process only one frame out of N (Every Nth policy)'},
+             {'title': 'Queue size:', 'name': 'queue_size', 'type': 'int', 'value': 1, 'min': 1,
+              'tip': 'Maximum number of frames waiting to be processed, the oldest ones are'
+                     ' dropped when the model is too slow (not used by the Process all policy)'},
+             {'title': 'Reset counters', 'name': 'reset_counters', 'type': 'action'},
+         ]},
+        {'title': 'Join detectors', 'name': 'join', 'type': 'group', 'expanded': False,
+         'children': [
+             {'title': 'Join free-running frames:', 'name': 'join_frames', 'type': 'bool',
+              'value': False,
+              'tip': 'Combine the frames each selected detector emits at its own rate, for'
+                     ' instance in continuous grab, into frames acquired at the same time'},
+             {'title': 'Tolerance (ms):', 'name': 'tolerance', 'type': 'float', 'value': 50.,
+              'min': 0., 'tip': 'Maximum time difference between the joined frames'},
+             {'title': 'Policy:', 'name': 'join_policy', 'type': 'list', 'limits': JOIN_POLICIES,
+              'value': JOIN_POLICIES[0],
+              'tip': 'Take the nearest frame of each detector or interpolate between the frames'
+                     ' acquired just before and after'},
+         ]},
+        {'title': 'Diagnostics', 'name': 'diagnostics', 'type': 'group', 'expanded': False,
+         'children': [
+             {'title': 'Record timings:', 'name': 'record_timings', 'type': 'bool', 'value': False,
+              'tip': 'Record the processing time of the model and of each formula line and the'
+                     ' latency between acquisition and emission of the computed data'},
+             {'title': 'Emit as data:', 'name': 'emit_diagnostics', 'type': 'bool', 'value': False,
+              'tip': f'Append the timings, as 0D data from {DIAGNOSTICS_NAME}, to the computed'
+                     f' data'},
+             {'title': 'Reset', 'name': 'reset_diagnostics', 'type': 'action'},
+         ]},
+        {'title': 'Display', 'name': 'display', 'type': 'group', 'expanded': False,
+         'children': [
+             {'title': 'Max refresh rate (fps):', 'name': 'max_fps', 'type': 'float',
+              'value': 20., 'min': 0.,
+              'tip': 'Maximum refresh rate of the computed data plots, only the newest result'
+                     ' is displayed. Set to 0 to plot every computed frame. Computed data are'
+                     ' always emitted at full rate.'},
          ]}]
 
     dte_computed_signal = QtCore.Signal(DataToExport)
@@ -49,18 +138,44 @@ class DataMixer(CustomExt):
         super().__init__(parent, dashboard)
 
         self.model_class: Optional[DataMixerModel] = None
+        self.runner: Optional[Union[ModelRunner, ProcessModelRunner]] = None
+        self.pipeline: Optional[ModelPipeline] = None
+        self._updating_models = False
+        self._user_detectors: Optional[List[str]] = None  # selection before select_detectors
+        self._settings_setter = SettingsSetter()
+        self.worker: Optional[ModelWorker] = None
+        self.frame_counters = FrameCounters()
+        self.diagnostics = Diagnostics()
+        self.join_buffer: Optional[JoinBuffer] = None
+        self._dte_to_display: Optional[DataToExport] = None
 
         self.setup_ui()
 
         self.settings.child('models', 'ini_model').sigActivated.connect(
             self.get_action('ini_model').trigger)
+        self.settings.child('models', 'add_model').sigActivated.connect(self.add_model)
+        self.settings.child('processing', 'reset_counters').sigActivated.connect(
+            self.reset_counters)
+        self.settings.child('diagnostics', 'reset_diagnostics').sigActivated.connect(
+            self.reset_diagnostics)
+
+        self.counters_timer = QtCore.QTimer()
+        self.counters_timer.setInterval(500)
+        self.counters_timer.timeout.connect(self.show_counters)
+        self.counters_timer.start()
+
+        self.display_timer = QtCore.QTimer()
+        self.display_timer.timeout.connect(self.refresh_display)
+        self.set_display_rate(self.settings['display', 'max_fps'])
 
     def get_set_model_params(self, model_name):
         self.settings.child('models', 'model_params').clearChildren()
         if len(self.models) > 0:
-            model_class = find_dict_in_list_from_key_val(self.models, 'name', model_name)['class']
-            params = getattr(model_class, 'params')
-            self.settings.child('models', 'model_params').addChildren(params)
+            model_class = load_model_class(
+                find_dict_in_list_from_key_val(self.models, 'name', model_name))
+            if model_class is not None:
+                params = getattr(model_class, 'params')
+                self.settings.child('models', 'model_params').addChildren(params)
 
 
     def setup_docks(self):
@@ -91,6 +206,14 @@ class DataMixer(CustomExt):
 
         self.dte_computed_viewer = ViewerDispatcher(self.area_computed)
 
+        self.docks['diagnostics'] = gutils.Dock('Diagnostics')
+        self.dockarea.addDock(self.docks['diagnostics'], 'bottom', self.docks['computed'])
+        self.diagnostics_table = QtWidgets.QTableWidget(0, len(DIAGNOSTICS_COLUMNS))
+        self.diagnostics_table.setHorizontalHeaderLabels(DIAGNOSTICS_COLUMNS)
+        self.diagnostics_table.verticalHeader().setVisible(False)
+        self.docks['diagnostics'].addWidget(self.diagnostics_table)
+        self.docks['diagnostics'].setVisible(False)
+
         if len(self.models) != 0:
             self.get_set_model_params(self.models[0]['name'])
 
@@ -101,6 +224,9 @@ class DataMixer(CustomExt):
         self.add_action('quit', 'Quit', 'close2', "Quit program")
         self.add_action('ini_model', 'Init Model', 'ini')
         self.add_widget('model_led', QLED, toolbar=self.toolbar)
+        self.add_widget('frame_counters', QtWidgets.QLabel, toolbar=self.toolbar,
+                        tip='Number of frames received, processed by the model and dropped'
+                            ' because of overload')
         self.add_action('snap', 'Snap Detectors', 'snap',
                         'Snap all selected detectors')
         self.add_action('create_computed_detectors', 'Create Computed Detectors', 'Add_Step',
@@ -117,9 +243,70 @@ class DataMixer(CustomExt):
         self.connect_action('create_computed_detectors', self.create_computed_detectors)
 
     def process_data(self, dte: DataToExport):
-        if self.model_class is not None:
-            dte_computed = self.model_class.process_dte(dte)
-            self.dte_computed_signal.emit(dte_computed)
+        if self.worker is not None and self.join_buffer is None:
+            self.worker.submit(dte)
+
+    def join_data(self, dte: DataToExport):
+        """ Buffer the frame of one detector and process the joined frames, if any"""
+        if self.join_buffer is not None and self.worker is not None:
+            joined = self.join_buffer.add(dte)
+            if joined is not None:
+                self.worker.submit(joined)
+
+    def set_join_buffer(self):
+        """ Create the join stage of the selected detectors frames, if activated"""
+        if self.settings['join', 'join_frames']:
+            self.join_buffer = JoinBuffer(self.modules_manager.selected_detectors_name,
+                                          tolerance=self.settings['join', 'tolerance'] / 1000,
+                                          policy=self.settings['join', 'join_policy'])
+        else:
+            self.join_buffer = None
+
+    def start_worker(self):
+        """ Start the thread processing the data with the model outside the GUI thread
+
+        The frames pending in the previous thread, if any, are processed by the new one
+        """
+        pending = self.worker.take_pending() if self.worker is not None else []
+        self.stop_worker()
+        self.worker = ModelWorker(self.pipeline,
+                                  maxsize=self.settings['processing', 'queue_size'],
+                                  policy=self.settings['processing', 'overload_policy'],
+                                  every_n=self.settings['processing', 'every_n'],
+                                  counters=self.frame_counters,
+                                  diagnostics=self.diagnostics)
+        # emitted from the worker thread, the connected slots are called within their own thread
+        self.worker.dte_computed.connect(self.dte_computed_signal.emit,
+                                         QtCore.Qt.ConnectionType.DirectConnection)
+        self.worker.requeue(pending)
+        self.worker.start()
+
+    def show_counters(self):
+        self.get_action('frame_counters').setText(str(self.frame_counters))
+        if self.diagnostics.enabled:
+            self.show_diagnostics()
+
+    def show_diagnostics(self):
+        rows = self.diagnostics.get_rows()
+        self.diagnostics_table.setRowCount(len(rows))
+        for ind_row, row in enumerate(rows):
+            for ind_col, value in enumerate(row):
+                text = f'{value:.3f}' if isinstance(value, float) else str(value)
+                self.diagnostics_table.setItem(ind_row, ind_col, QtWidgets.QTableWidgetItem(text))
+
+    def reset_diagnostics(self):
+        self.diagnostics.reset()
+        self.show_diagnostics()
+
+    def reset_counters(self):
+        self.frame_counters.reset()
+        self.show_counters()
+
+    def stop_worker(self):
+        """ End the processing thread, if any, once the frame being processed is done"""
+        if self.worker is not None:
+            self.worker.stop()
+            self.worker = None
 
     def snap(self):
         self.modules_manager.grab_data(check_do_override=False)
@@ -138,6 +325,7 @@ class DataMixer(CustomExt):
             self.connect_detectors(False)
         except :
             pass
+        self.set_join_buffer()
         self.connect_detectors()
 
     def connect_detectors(self, connect=True):
@@ -148,14 +336,43 @@ class DataMixer(CustomExt):
         connect: bool
             If True make the connection else disconnect
         """
+        if not connect or self.join_buffer is not None:
+            self.modules_manager.connect_detectors(connect=connect, slot=self.join_data)
         self.modules_manager.connect_detectors(connect=connect)
 
     def plot_computed_results(self, dte):
-        self.dte_computed_viewer.show_data(dte)
+        if self.display_timer.isActive():
+            self._dte_to_display = dte
+        else:
+            self.dte_computed_viewer.show_data(dte)
+
+    def refresh_display(self):
+        """ Plot the newest computed data, if any, since the last refresh"""
+        if self._dte_to_display is not None:
+            dte, self._dte_to_display = self._dte_to_display, None
+            self.dte_computed_viewer.show_data(dte)
+
+    def set_display_rate(self, max_fps: float):
+        """ Throttle the refresh of the computed data plots
+
+        Parameters
+        ----------
+        max_fps: float
+            maximum refresh rate, if 0 each computed frame is plotted
+        """
+        if max_fps > 0:
+            self.display_timer.start(max(1, int(1000 / max_fps)))
+        else:
+            self.display_timer.stop()
+            self.refresh_display()
 
     def ini_model(self):
-        if self.model_class is None:
+        if self.pipeline is None:
             self.set_model()
+            if self.pipeline is None:
+                return
+        if self.worker is None:
+            self.start_worker()
 
         self.get_action('model_led').set_as_true()
         self.set_action_enabled('ini_model', False)
@@ -163,11 +380,165 @@ class DataMixer(CustomExt):
 
         self.update_connect_detectors()
 
+    def get_model_inputs(self, before: str = None) -> dict:
+        """ The possible inputs of a model: the detectors data or the output of a previous model
+
+        Parameters
+        ----------
+        before: str, optional
+            the name of an added model, only the models before it are listed
+        """
+        inputs = {DETECTORS_INPUT: DETECTORS_INPUT,
+                  self.settings['models', 'model_class']: 'model_params'}
+        for group in self.settings.child('models', 'added_models').children():
+            if group.name() == before:
+                break
+            inputs[f'{group["model_name"]} ({group.name()})'] = group.name()
+        return inputs
+
+    def add_model(self):
+        """ Add a model of the selected class to the processing pipeline"""
+        model_name = self.settings['models', 'model_class']
+        model_class = load_model_class(
+            find_dict_in_list_from_key_val(self.models, 'name', model_name))
+        if model_class is None:
+            logger.warning(f'The {model_name} model could not be loaded')
+            return
+        added_models = self.settings.child('models', 'added_models')
+        names = [group.name() for group in added_models.children()]
+        index = 0
+        while f'model{index:02d}' in names:
+            index += 1
+        name = f'model{index:02d}'
+        group = added_models.addChild(
+            {'title': f'{model_name}:', 'name': name, 'type': 'group', 'children': [
+                {'title': 'Model:', 'name': 'model_name', 'type': 'str', 'value': model_name,
+                 'readonly': True},
+                {'title': 'Input:', 'name': 'input', 'type': 'list',
+                 'limits': self.get_model_inputs(name), 'value': DETECTORS_INPUT,
+                 'tip': 'Process the detectors data, in parallel with the other models, or the'
+                        ' output of a previous model'},
+                {'title': 'Remove', 'name': 'remove', 'type': 'action'},
+                {'title': 'Model params:', 'name': 'model_params', 'type': 'group',
+                 'children': model_class.params},
+            ]})
+        group.child('remove').sigActivated.connect(lambda: self.remove_model(name))
+        self.restart_models()
+
+    def remove_model(self, name: str):
+        """ Remove an added model, the models processing its output process its input instead"""
+        added_models = self.settings.child('models', 'added_models')
+        group = added_models.child(name)
+        self._updating_models = True
+        try:
+            for other in added_models.children():
+                if other['input'] == name:
+                    other.child('input').setValue(group['input'])
+            group.remove()
+            self.update_model_inputs()
+        finally:
+            self._updating_models = False
+        self.restart_models()
+
+    def update_model_inputs(self):
+        """ Update the possible inputs of the added models, keeping their current input"""
+        for group in self.settings.child('models', 'added_models').children():
+            input_name = group['input']
+            group.child('input').setLimits(self.get_model_inputs(group.name()))
+            group.child('input').setValue(input_name)
+
+    def create_runner(self, model_name: str, settings_path: tuple, input_name: str,
+                      label: str = ''):
+        """ Host a model within a thread or a separate process depending on the backend
+
+        The models processing the output of another model list this output as their data. The
+        timings the model records are named after its label
+        """
+        model_class = load_model_class(
+            find_dict_in_list_from_key_val(self.models, 'name', model_name))
+        if model_class is None:
+            logger.warning(f'The {model_name} model could not be loaded')
+            return
+        modules_manager = (self.modules_manager if input_name == DETECTORS_INPUT else
+                           HeadlessModulesManager())
+        if self.settings['processing', 'backend'] == 'Process':
+            try:
+                return ProcessModelRunner(
+                    model_class, settings_tree=self.settings, settings_path=settings_path,
+                    data=modules_manager.get_det_data_list(),
+                    parameter_setter=self._settings_setter.value_signal.emit,
+                    diagnostics=self.diagnostics, name=label,
+                    slot_bytes=int(self.settings['processing', 'slot_size'] * 2 ** 20))
+            except RuntimeError as e:
+                logger.exception(str(e))
+                return
+        return ModelRunner(model_class, settings_tree=self.settings, settings_path=settings_path,
+                           modules_manager=modules_manager, diagnostics=self.diagnostics,
+                           parameter_setter=self._settings_setter.value_signal.emit, name=label)
+
     def set_model(self):
-        model_name = self.settings.child('models', 'model_class').value()
-        self.model_class = find_dict_in_list_from_key_val(
-            self.models, 'name', model_name)['class'](self)
-        self.model_class.ini_model_base()
+        """ Create the pipeline of the selected model and of the added ones"""
+        declarations = [('model_params', self.settings['models', 'model_class'],
+                         ('models', 'model_params'), DETECTORS_INPUT)]
+        for group in self.settings.child('models', 'added_models').children():
+            declarations.append((group.name(), group['model_name'],
+                                 ('models', 'added_models', group.name(), 'model_params'),
+                                 group['input']))
+        pipeline = ModelPipeline()
+        for name, model_name, settings_path, input_name in declarations:
+            label = model_name if name == 'model_params' else f'{model_name} ({name})'
+            runner = self.create_runner(model_name, settings_path, input_name, label)
+            if runner is None:
+                pipeline.stop()
+                return
+            pipeline.add_stage(PipelineStage(name, runner, input_name))
+        self.pipeline = pipeline
+        self.runner = pipeline.stages[0].runner
+        self.model_class = self.runner.model  # None if living in the model process
+        self.select_detectors()
+
+    def select_detectors(self):
+        """ Select only the detectors providing the data the models read, if asked for and if
+        the models declare them"""
+        if not self.settings['processing', 'select_detectors'] or self.pipeline is None:
+            return
+        data_names = self.pipeline.required_data()
+        if not data_names:
+            return
+        origins = {data_name.split('/')[0] for data_name in data_names}
+        selected = [name for name in self.modules_manager.detectors_name if name in origins]
+        if len(selected) > 0 and selected != self.modules_manager.selected_detectors_name:
+            if self._user_detectors is None:
+                self._user_detectors = self.modules_manager.selected_detectors_name
+            self.modules_manager.selected_detectors_name = selected
+
+    def restore_detectors(self):
+        """ Select back the detectors selected before select_detectors"""
+        if self._user_detectors is not None:
+            self.modules_manager.selected_detectors_name = self._user_detectors
+            self._user_detectors = None
+
+    def stop_runner(self):
+        """ End the model processes, if any, and forget the models"""
+        if self.pipeline is not None:
+            self.pipeline.stop()
+        self.pipeline = None
+        self.runner = None
+        self.model_class = None
+
+    def restart_models(self):
+        """ Recreate the models and their processing thread, if initialized, after a change of
+        the pipeline"""
+        if self.pipeline is not None:
+            pending = self.worker.take_pending() if self.worker is not None else []
+            self.stop_worker()
+            self.stop_runner()
+            self.set_model()
+            if self.pipeline is not None:
+                self.start_worker()
+                self.worker.requeue(pending)
+            else:
+                self.frame_counters.dropped += len(pending)
 
     def setup_menu(self):
         """Non mandatory method to be subclassed in order to create a menubar
@@ -206,13 +577,53 @@ class DataMixer(CustomExt):
         """
         if param.name() == 'model_class':
             self.get_set_model_params(param.value())
-        elif param.name() in putils.iter_children(self.settings.child('models', 'model_params'), []):
-            if self.model_class is not None:
-                self.model_class.update_settings(param)
+            self._updating_models = True
+            try:
+                self.update_model_inputs()
+            finally:
+                self._updating_models = False
+        elif param.name() == 'input' and is_descendant(
+                self.settings.child('models', 'added_models'), param):
+            if not self._updating_models:
+                self.restart_models()
+        elif self.pipeline is not None and self.pipeline.update_settings(param):
+            self.select_detectors()
+        elif param.name() == 'max_fps':
+            self.set_display_rate(param.value())
+        elif param.name() == 'record_timings':
+            self.diagnostics.enabled = param.value()
+            self.docks['diagnostics'].setVisible(param.value())
+        elif param.name() == 'emit_diagnostics':
+            self.diagnostics.emit = param.value()
+        elif param.name() == 'join_frames':
+            self.update_connect_detectors()
+        elif param.name() in putils.iter_children(self.settings.child('join'), []):
+            self.set_join_buffer()
+        elif param.name() in ['backend', 'slot_size']:
+            self.restart_models()
+        elif param.name() == 'select_detectors':
+            if param.value():
+                self.select_detectors()
+            else:
+                self.restore_detectors()
+        elif param.name() in putils.iter_children(self.settings.child('processing'), []):
+            if self.worker is not None:
+                self.start_worker()
 
-    def quit(self):
+    def quit_fun(self):
+        """ End the processing thread and the model processes before closing the window
+
+        Called by the dashboard when closing the extension or itself
+        """
+        self.counters_timer.stop()
+        self.display_timer.stop()
+        self.stop_worker()
+        self.stop_runner()
         self.mainwindow.close()
 
+    def quit(self):
+        self.quit_fun()
+
 
 def main():
     from pymodaq_gui.utils.utils import mkQApp
@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+"""
+Offline replay of acquisitions saved with the PyMoDAQ hdf5 backend through a DataMixer model
+
+The saved data are read chunk by chunk along their navigation axes, processed frame by frame by
+a ModelRunner and the computed data are written into a new hdf5 file with the same navigation
+axes, so that files larger than the memory can be re-analysed::
+
+    datamixer_replay scan.h5 computed.h5 --model equation_model
+        --settings "{\"edit_formula\": \"{Camera/Image}.mean()\"}" --processes 4
+"""
+import argparse
+import json
+import sys
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Mapping, Tuple, Union
+
+import numpy as np
+
+from pymodaq_utils.logger import set_logger, get_module_name
+from pymodaq_data.data import Axis, DataRaw, DataToExport
+from pymodaq_data.h5modules.backends import GROUP, CARRAY
+from pymodaq_data.h5modules.saving import H5SaverLowLevel
+from pymodaq_data.h5modules.data_saving import (AxisSaverLoader, DataLoader,
+                                                DataToExportExtendedSaver)
+
+from pymodaq_plugins_datamixer.extensions.utils.model import get_models
+from pymodaq_plugins_datamixer.extensions.utils.runner import ModelRunner, get_model_class
+
+logger = set_logger(get_module_name(__file__))
+
+DATA_TYPES = ['data', 'data_enlargeable']  # the data_type of the nodes to replay
+
+
+class SavedData:
+    """ The arrays of one saved DataWithAxes, whose leading dimensions are navigation ones
+
+    Parameters
+    ----------
+    arrays: list of CARRAY
+        the data nodes, one per channel, of a channel group
+    axes: list of Axis
+        the axes saved with the data, indexed within the saved arrays
+    """
+
+    def __init__(self, arrays: List[CARRAY], axes: List[Axis]):
+        self.arrays = arrays
+        attrs = arrays[0].attrs
+        self.name: str = attrs['TITLE']
+        self.origin: str = attrs['origin'] if 'origin' in attrs else ''
+        self.units: str = attrs['units'] if 'units' in attrs else ''
+        self.labels = [array.attrs['label'] for array in arrays]
+        self.n_nav = len(attrs['nav_indexes']) if 'nav_indexes' in attrs else 0
+        shape = tuple(arrays[0].array.shape)  # the shape attribute is not updated when enlarged
+        self.nav_shape = shape[:self.n_nav]
+        self.signal_shape = shape[self.n_nav:]
+        if len(self.signal_shape) == 0:  # 0D data saved as a scalar at each navigation index
+            self.signal_shape = (1, )
+        self.nav_axes = [axis for axis in axes if axis.index < self.n_nav]
+        self.signal_axes = []
+        for axis in axes:
+            if axis.index >= self.n_nav:
+                axis.index -= self.n_nav
+                self.signal_axes.append(axis)
+
+    @property
+    def full_name(self) -> str:
+        return f'{self.origin}/{self.name}'
+
+    def is_navigable(self) -> bool:
+        """ True if the navigation dimensions are the leading ones, as saved by the DAQ_Scan or the
+        enlargeable savers"""
+        nav_indexes = tuple(self.arrays[0].attrs['nav_indexes'])
+        return self.n_nav > 0 and nav_indexes == tuple(range(self.n_nav))
+
+    def read(self, start: int, stop: int) -> List[np.ndarray]:
+        """ Read the rows start to stop of the first navigation axis, as one array per channel of
+        shape (number of frames, *signal_shape)"""
+        return [np.asarray(array[start:stop]).reshape((-1, ) + self.signal_shape)
+                for array in self.arrays]
+
+    def read_frame(self, index: int) -> List[np.ndarray]:
+        """ Read the frame at a flat navigation index, as one block of a single frame per
+        channel"""
+        nav_index = np.unravel_index(index, self.nav_shape)
+        return [np.asarray(array[nav_index]).reshape((1, ) + self.signal_shape)
+                for array in self.arrays]
+
+    def to_data(self, blocks: List[np.ndarray], index: int) -> DataRaw:
+        return DataRaw(self.name, data=[block[index] for block in blocks], labels=self.labels,
+                       units=self.units, origin=self.origin,
+                       axes=[axis.copy() for axis in self.signal_axes])
+
+
+class ReplaySource:
+    """ Read-only access, chunk by chunk, to the data of a saved acquisition
+
+    All data hanging from a group and sharing the navigation shape of the first found one are
+    replayed, the others are skipped.
+
+    Parameters
+    ----------
+    file_path: Path or str
+        the hdf5 file, opened read only
+    where: str, optional
+        the path of the group whose data are replayed, by default the last scan group or the raw
+        data group if there is none
+    """
+
+    def __init__(self, file_path: Union[Path, str], where: str = None):
+        self.h5saver = H5SaverLowLevel()
+        self.h5saver.open_file(Path(file_path), 'r')
+        self._axis_loader = AxisSaverLoader(self.h5saver)
+
+        raw_group = self.h5saver.get_node('/RawData')
+        if where is None:
+            scan_group = self.h5saver.get_last_group(raw_group, 'scan')
+            where = scan_group if scan_group is not None else raw_group
+        self.where = self.h5saver.get_node(where)
+
+        self.data: List[SavedData] = []
+        for arrays in self.get_data_nodes().values():
+            saved_data = SavedData(arrays, self._axis_loader.get_axes(arrays[0].parent_node))
+            if not saved_data.is_navigable():
+                logger.warning(f'{saved_data.full_name} has no leading navigation axes, skipped')
+            elif len(self.data) > 0 and saved_data.nav_shape != self.nav_shape:
+                logger.warning(f'{saved_data.full_name} has a navigation shape '
+                               f'{saved_data.nav_shape} different from {self.nav_shape}, skipped')
+            else:
+                self.data.append(saved_data)
+        if len(self.data) == 0:
+            raise ValueError(f'No data to replay in {self.where.path}')
+
+        self.nav_axes = self.get_nav_axes()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close_file()
+
+    def close_file(self):
+        self.h5saver.close_file()
+
+    def get_data_nodes(self) -> Dict[str, List[CARRAY]]:
+        """ The data nodes hanging from where indexed by the path of their channel group"""
+        data_nodes: Dict[str, List[CARRAY]] = {}
+        for node in self.h5saver.walk_nodes(self.where):
+            if (not isinstance(node, GROUP) and 'data_type' in node.attrs and
+                    node.attrs['data_type'] in DATA_TYPES):
+                data_nodes.setdefault(node.parent_node.path, []).append(node)
+        for arrays in data_nodes.values():
+            arrays.sort(key=lambda array: array.name)
+        return data_nodes
+
+    def get_nav_axes(self) -> List[Axis]:
+        """ The axes of the NavAxes group of the data, as saved by the DAQ_Scan, or else the
+        navigation axes saved with the data"""
+        nav_group = DataLoader(self.h5saver).get_nav_group(self.data[0].arrays[0])
+        if nav_group is not None:
+            return self._axis_loader.get_axes(nav_group)
+        return self.data[0].nav_axes
+
+    @property
+    def nav_shape(self) -> Tuple[int, ...]:
+        return self.data[0].nav_shape
+
+    @property
+    def n_frames(self) -> int:
+        return int(np.prod(self.nav_shape))
+
+    @property
+    def row_frames(self) -> int:
+        """ The number of frames in one index of the first navigation axis"""
+        return int(np.prod(self.nav_shape[1:]))
+
+    def get_chunks(self, chunk_frames: int) -> List[Tuple[int, int]]:
+        """ Split the first navigation axis in chunks of about chunk_frames frames"""
+        rows = max(1, chunk_frames // self.row_frames)
+        return [(start, min(start + rows, self.nav_shape[0]))
+                for start in range(0, self.nav_shape[0], rows)]
+
+    def read_frame(self, index: int) -> DataToExport:
+        """ The frame at a flat navigation index"""
+        return DataToExport('Replay', data=[saved_data.to_data(saved_data.read_frame(index), 0)
+                                            for saved_data in self.data])
+
+    def read_chunk(self, start: int, stop: int) -> List[DataToExport]:
+        """ The frames of the rows start to stop of the first navigation axis"""
+        blocks = [saved_data.read(start, stop) for saved_data in self.data]
+        return [DataToExport('Replay', data=[saved_data.to_data(data_blocks, index)
+                                             for saved_data, data_blocks in zip(self.data, blocks)])
+                for index in range((stop - start) * self.row_frames)]
+
+
+class ReplayWriter:
+    """ Writer of the computed data in a new hdf5 file, within a scan group having the navigation
+    axes of the replayed data
+
+    Parameters
+    ----------
+    file_path: Path or str
+    nav_shape: tuple of int
+    nav_axes: list of Axis
+    title: str
+        the title of the detector group holding the computed data
+    metadata: dict
+        saved as attributes of the detector group
+    """
+
+    def __init__(self, file_path: Union[Path, str], nav_shape: Tuple[int, ...],
+                 nav_axes: List[Axis], title: str = 'DataMixer', metadata: dict = None):
+        self.nav_shape = nav_shape
+        self.h5saver = H5SaverLowLevel(save_type='scan')
+        self.h5saver.init_file(Path(file_path), new_file=True)
+        scan_group = self.h5saver.add_scan_group(title='DataMixer replay')
+        self.det_group = self.h5saver.add_det_group(scan_group, title=title, metadata=metadata)
+        self._saver = DataToExportExtendedSaver(self.h5saver, nav_shape)
+        self._saver.add_nav_axes(scan_group, [axis.copy() for axis in nav_axes])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close_file()
+
+    def close_file(self):
+        self.h5saver.flush()
+        self.h5saver.close_file()
+
+    def add_data(self, frame: int, dte: DataToExport):
+        """ Save computed data at a flat index of the navigation shape"""
+        if len(dte) > 0:
+            indexes = [int(index) for index in np.unravel_index(frame, self.nav_shape)]
+            self._saver.add_data(self.det_group, dte, indexes=indexes)
+
+
+_worker_state = {}
+
+
+def init_replay(file_path: Union[Path, str], where: str, model: Union[str, type],
+                settings: Mapping = None):
+    """ Open the source and create the model runner of the current process"""
+    source = ReplaySource(file_path, where)
+    _worker_state['source'] = source
+    _worker_state['runner'] = ModelRunner(model, settings, data=source.read_frame(0))
+
+
+def replay_chunk(chunk: Tuple[int, int]) -> List[DataToExport]:
+    """ Process the frames of a chunk with the runner of the current process"""
+    runner: ModelRunner = _worker_state['runner']
+    return [runner.process(dte) for dte in _worker_state['source'].read_chunk(*chunk)]
+
+
+def map_bounded(executor: Executor, function: Callable, items: Iterable,
+                max_pending: int) -> Iterator:
+    """ Like executor.map, yielding in order, but submitting items only as results are consumed
+    so that at most max_pending results are held in memory"""
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(function, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while len(pending) > 0:
+        yield pending.popleft().result()
+
+
+def replay(file_path: Union[Path, str], output_path: Union[Path, str],
+           model: Union[str, type], settings: Mapping = None, where: str = None,
+           chunk_frames: int = 256, processes: int = 0):
+    """ Process a saved acquisition with a DataMixer model and save the computed data
+
+    Parameters
+    ----------
+    file_path: Path or str
+        the hdf5 file to replay
+    output_path: Path or str
+        the new hdf5 file where to save the computed data
+    model: str or type
+        the model class or its name as listed by get_models
+    settings: dict, optional
+        the model settings as accepted by ModelRunner
+    where: str, optional
+        the group whose data are replayed, see ReplaySource
+    chunk_frames: int
+        the approximate number of frames read at once
+    processes: int
+        if strictly positive, the number of processes the chunks are fanned out to. Each process
+        has its own model, so that models keeping a state from frame to frame (statistics, history,
+        peak tracking...) will not give the results of a sequential replay
+    """
+    model_class = get_model_class(model)
+    with ReplaySource(file_path, where) as source:
+        chunks = source.get_chunks(chunk_frames)
+        row_frames = source.row_frames
+        n_frames = source.n_frames
+        metadata = dict(model=model_class.__name__, source_file=str(file_path),
+                        source_group=source.where.path,
+                        settings=json.dumps(settings if settings is not None else {}))
+        writer = ReplayWriter(output_path, source.nav_shape, source.nav_axes,
+                              title=model_class.__name__, metadata=metadata)
+
+    with writer:
+        if processes > 0:
+            with ProcessPoolExecutor(processes, initializer=init_replay,
+                                     initargs=(file_path, where, model_class, settings)) as executor:
+                write_chunks(writer, chunks, row_frames, n_frames,
+                             map_bounded(executor, replay_chunk, chunks, 2 * processes))
+        else:
+            init_replay(file_path, where, model_class, settings)
+            try:
+                write_chunks(writer, chunks, row_frames, n_frames,
+                             (replay_chunk(chunk) for chunk in chunks))
+            finally:
+                _worker_state.pop('source').close_file()
+                _worker_state.clear()
+
+
+def write_chunks(writer: ReplayWriter, chunks: List[Tuple[int, int]], row_frames: int,
+                 n_frames: int, results: Iterable[List[DataToExport]]):
+    for (start, stop), dtes in zip(chunks, results):
+        for index, dte in enumerate(dtes):
+            writer.add_data(start * row_frames + index, dte)
+        logger.info(f'Replayed {stop * row_frames}/{n_frames} frames')
+
+
+def load_settings(settings: str) -> dict:
+    """ Settings given as a json string or as the path of a json file"""
+    if settings is None:
+        return {}
+    if Path(settings).is_file():
+        settings = Path(settings).read_text()
+    return json.loads(settings)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Replay an acquisition saved as hdf5 through a DataMixer model')
+    parser.add_argument('input', help='the hdf5 file to replay')
+    parser.add_argument('output', help='the hdf5 file where to save the computed data')
+    parser.add_argument('--model', required=True,
+                        help=f'name of the model, one of: '
+                             f'{", ".join([model["name"] for model in get_models()])}')
+    parser.add_argument('--settings',
+                        help='model settings as a json mapping, or the path of a json file')
+    parser.add_argument('--where', help='path of the group to replay, default to the last scan')
+    parser.add_argument('--chunk', type=int, default=256,
+                        help='approximate number of frames read at once')
+    parser.add_argument('--processes', type=int, default=0,
+                        help='number of processes to fan the chunks out to, only for models '
+                             'processing each frame independently')
+    args = parser.parse_args(argv)
+
+    try:
+        get_model_class(args.model)
+    except ValueError as e:
+        parser.error(str(e))
+
+    replay(args.input, args.output, args.model, load_settings(args.settings), where=args.where,
+           chunk_frames=args.chunk, processes=args.processes)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
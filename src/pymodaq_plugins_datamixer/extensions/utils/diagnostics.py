@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Instrumentation of the hot path of the DataMixer: wall time of the models and formula lines,
+latency between the acquisition and the emission of the computed data, exception counts and the
+circuit breaker disabling what keeps failing
+"""
+from time import perf_counter
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from pymodaq_data.data import DataToExport, DataCalculated
+
+
+DIAGNOSTICS_NAME = 'MixerDiagnostics'
+MODEL_TIMING = 'model'
+LATENCY_TIMING = 'latency'
+ERRORS_NAME = 'errors'
+
+
+class TimingStatistics:
+    """ Statistics of a duration measured at each frame
+
+    The last durations are kept in a fixed-size ring buffer from which the percentile is computed
+    when read.
+
+    Parameters
+    ----------
+    size: int
+        the number of durations kept for the percentile
+    """
+
+    def __init__(self, size: int = 1000):
+        self.durations = np.zeros((size, ))
+        self.count = 0
+        self.errors = 0
+        self.last = 0.
+        self.total = 0.
+        self._taken = (0, 0)  # count and errors when last taken
+
+    def add(self, duration: float):
+        self.durations[self.count % self.durations.size] = duration
+        self.count += 1
+        self.last = duration
+        self.total += duration
+
+    def take(self) -> Tuple[List[float], int]:
+        """ The durations and the number of errors added since the last call"""
+        taken_count, taken_errors = self._taken
+        start = max(taken_count, self.count - self.durations.size)
+        durations = [float(self.durations[ind % self.durations.size])
+                     for ind in range(start, self.count)]
+        self._taken = (self.count, self.errors)
+        return durations, self.errors - taken_errors
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count > 0 else 0.
+
+    @property
+    def p99(self) -> float:
+        if self.count == 0:
+            return 0.
+        return float(np.percentile(self.durations[:min(self.count, self.durations.size)], 99))
+
+
+class CircuitBreaker:
+    """ Disable what fails on too many consecutive frames
+
+    Parameters
+    ----------
+    max_failures: int
+        the number of consecutive failures after which a name is disabled, 0 to never disable
+
+    Attributes
+    ----------
+    errors: dict
+        the number of failures of each name
+    disabled: dict
+        the last error message of each disabled name
+    """
+
+    def __init__(self, max_failures: int = 10):
+        self.max_failures = max_failures
+        self.errors: Dict[str, int] = {}
+        self.disabled: Dict[str, str] = {}
+        self._consecutive: Dict[str, int] = {}
+
+    def success(self, name: str):
+        if name in self._consecutive:
+            del self._consecutive[name]
+
+    def failure(self, name: str, error: Exception) -> bool:
+        """ Count a failure, returns True if the name has just been disabled"""
+        self.errors[name] = self.errors.get(name, 0) + 1
+        consecutive = self._consecutive.get(name, 0) + 1
+        self._consecutive[name] = consecutive
+        if 0 < self.max_failures <= consecutive and name not in self.disabled:
+            self.disabled[name] = str(error)
+            return True
+        return False
+
+
+class Diagnostics:
+    """ Timings and exception counts recorded by the DataMixer, its worker and its models
+
+    Nothing is timed when disabled, so that the only overhead is a check of the enabled attribute.
+    Exceptions are always counted.
+
+    Attributes
+    ----------
+    enabled: bool
+        if True the durations are recorded
+    emit: bool
+        if True the diagnostics are appended, as 0D data, to each computed DataToExport
+    timings: dict
+        the TimingStatistics indexed by the name of what is timed: model, latency or the name of
+        a formula line
+    """
+
+    def __init__(self, enabled: bool = False, emit: bool = False):
+        self.enabled = enabled
+        self.emit = emit
+        self.timings: Dict[str, TimingStatistics] = {}
+
+    @staticmethod
+    def now() -> float:
+        return perf_counter()
+
+    def reset(self):
+        self.timings = {}
+
+    def get_timing(self, name: str) -> TimingStatistics:
+        timing = self.timings.get(name)
+        if timing is None:
+            timing = TimingStatistics()
+            self.timings[name] = timing
+        return timing
+
+    def record(self, name: str, duration: float):
+        """ Record a duration in seconds"""
+        self.get_timing(name).add(duration)
+
+    def record_since(self, name: str, start: float):
+        """ Record the duration since start, a time given by the now method"""
+        self.get_timing(name).add(perf_counter() - start)
+
+    def record_error(self, name: str):
+        self.get_timing(name).errors += 1
+
+    def take_records(self) -> Dict[str, Tuple[List[float], int]]:
+        """ The durations and error counts recorded for each name since the last call, to be
+        added to other diagnostics with add_records"""
+        records = {name: timing.take() for name, timing in list(self.timings.items())}
+        return {name: record for name, record in records.items() if record != ([], 0)}
+
+    def add_records(self, records: Dict[str, Tuple[List[float], int]], prefix: str = ''):
+        """ Add the durations and error counts recorded by other diagnostics, their names being
+        prefixed with prefix/ if given"""
+        for name, (durations, errors) in records.items():
+            timing = self.get_timing(f'{prefix}/{name}' if prefix else name)
+            for duration in durations:
+                timing.add(duration)
+            timing.errors += errors
+
+    def get_rows(self) -> List[List]:
+        """ The name, count, last, mean and p99 durations in ms and errors of each timing"""
+        return [[name, timing.count, timing.last * 1000, timing.mean * 1000, timing.p99 * 1000,
+                 timing.errors] for name, timing in list(self.timings.items())]
+
+    def to_dte(self) -> DataToExport:
+        """ The diagnostics as 0D data: the last, mean and p99 durations in ms of each timing
+        and the dimensionless error counts of all the timings, one channel each"""
+        rows = self.get_rows()
+        data = [DataCalculated(name, data=[np.array([last]), np.array([mean]), np.array([p99])],
+                               labels=['last', 'mean', 'p99'], units='ms',
+                               origin=DIAGNOSTICS_NAME)
+                for name, count, last, mean, p99, errors in rows]
+        if len(rows) > 0:
+            data.append(DataCalculated(ERRORS_NAME, data=[np.array([row[-1]]) for row in rows],
+                                       labels=[row[0] for row in rows], units='',
+                                       origin=DIAGNOSTICS_NAME))
+        return DataToExport(DIAGNOSTICS_NAME, data=data)
+
+
+class DiagnosticsScope:
+    """ The diagnostics of one of several models, recording the timings under the model name
+
+    Parameters
+    ----------
+    diagnostics: Diagnostics
+        the diagnostics shared by the models
+    prefix: str
+        the name of the model, the recorded names become prefix/name
+    """
+
+    def __init__(self, diagnostics: Diagnostics, prefix: str):
+        self.diagnostics = diagnostics
+        self.prefix = prefix
+
+    @property
+    def enabled(self) -> bool:
+        return self.diagnostics.enabled
+
+    @staticmethod
+    def now() -> float:
+        return perf_counter()
+
+    def record(self, name: str, duration: float):
+        self.diagnostics.record(f'{self.prefix}/{name}', duration)
+
+    def record_since(self, name: str, start: float):
+        self.diagnostics.record_since(f'{self.prefix}/{name}', start)
+
+    def record_error(self, name: str):
+        self.diagnostics.record_error(f'{self.prefix}/{name}')
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+Evaluation engines of the formulae compiled into a FormulaGraph
+
+* DataWithAxesEngine evaluates the formulae on the DataWithAxes objects themselves
+* NdarrayEngine evaluates them on the underlying numpy arrays, each channel at a time, reusing
+  the temporary arrays of elementwise operations and wrapping the outputs in a DataCalculated
+  only once
+"""
+import ast
+import copy
+from typing import Any, Dict, List, Mapping, Optional
+
+import numpy as np
+
+from pymodaq_data.data import DataCalculated, DataWithAxes
+
+from pymodaq_plugins_datamixer.extensions.utils.history import HistoryStore
+from pymodaq_plugins_datamixer.extensions.utils.parser import (
+    Formula, FormulaGraph, bind_variables, formula_globals, history_identifier)
+
+
+ENGINES = ['DataWithAxes', 'ndarray']
+
+_binary_ufuncs = {ast.Add: np.add, ast.Sub: np.subtract, ast.Mult: np.multiply,
+                  ast.Div: np.true_divide, ast.FloorDiv: np.floor_divide, ast.Mod: np.remainder,
+                  ast.Pow: np.power}
+_unary_ufuncs = {ast.USub: np.negative}
+
+_same_type_loops: Dict[tuple, bool] = {}
+
+
+def _has_same_type_loop(ufunc: np.ufunc, dtype: np.dtype) -> bool:
+    """ Check if the ufunc has a loop whose inputs and output are all of the given float dtype"""
+    key = (ufunc, dtype)
+    if key not in _same_type_loops:
+        _same_type_loops[key] = (np.issubdtype(dtype, np.floating) and
+                                 f'{dtype.char * ufunc.nin}->{dtype.char}' in ufunc.types)
+    return _same_type_loops[key]
+
+
+def _can_write(out: Any, ufunc: np.ufunc, *operands) -> bool:
+    return (isinstance(out, np.ndarray) and out.flags.writeable and
+            _has_same_type_loop(ufunc, out.dtype) and
+            np.result_type(*operands) == out.dtype and
+            out.shape == np.broadcast_shapes(*[np.shape(operand) for operand in operands]))
+
+
+def inplace_binary(ufunc: np.ufunc, left, right, left_fresh: bool, right_fresh: bool):
+    """ Apply a binary ufunc writing the result into a temporary operand when possible"""
+    if left_fresh and _can_write(left, ufunc, left, right):
+        return ufunc(left, right, out=left)
+    if right_fresh and _can_write(right, ufunc, left, right):
+        return ufunc(left, right, out=right)
+    return ufunc(left, right)
+
+
+def inplace_unary(ufunc: np.ufunc, operand):
+    """ Apply a unary ufunc writing the result into its temporary operand when possible"""
+    if _can_write(operand, ufunc, operand):
+        return ufunc(operand, out=operand)
+    return ufunc(operand)
+
+
+_engine_globals = dict(formula_globals, _inplace_binary=inplace_binary,
+                       _inplace_unary=inplace_unary)
+
+
+def _get_numpy_ufunc(node: ast.expr):
+    """ Get the numpy ufunc called as np.ufunc_name(...), None if not a numpy ufunc"""
+    if (isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and
+            node.value.id == 'np' and isinstance(getattr(np, node.attr, None), np.ufunc)):
+        return getattr(np, node.attr)
+    return None
+
+
+def is_fresh(node: ast.expr) -> bool:
+    """ Check if an expression produces a new temporary array that nothing else references"""
+    if isinstance(node, (ast.BinOp, ast.UnaryOp)):
+        return True
+    if isinstance(node, ast.Call):
+        if isinstance(node.func, ast.Name) and node.func.id in ('_inplace_binary',
+                                                                '_inplace_unary'):
+            return True
+        return _get_numpy_ufunc(node.func) is not None and len(node.keywords) == 0
+    return False
+
+
+def _numpy_attribute(ufunc: np.ufunc) -> ast.Attribute:
+    return ast.Attribute(value=ast.Name(id='np', ctx=ast.Load()), attr=ufunc.__name__,
+                         ctx=ast.Load())
+
+
+class ElementwiseFuser(ast.NodeTransformer):
+    """ Rewrite elementwise operations applied on temporary arrays into in-place operations
+
+    For instance in *np.abs(a / b) * c*, the division allocates a temporary array, that is then
+    reused to store the absolute value and the product instead of allocating two more arrays.
+    """
+
+    def visit_BinOp(self, node: ast.BinOp):
+        self.generic_visit(node)
+        ufunc = _binary_ufuncs.get(type(node.op))
+        left_fresh, right_fresh = is_fresh(node.left), is_fresh(node.right)
+        if ufunc is None or not (left_fresh or right_fresh):
+            return node
+        return ast.copy_location(ast.Call(
+            func=ast.Name(id='_inplace_binary', ctx=ast.Load()),
+            args=[_numpy_attribute(ufunc), node.left, node.right,
+                  ast.Constant(left_fresh), ast.Constant(right_fresh)],
+            keywords=[]), node)
+
+    def visit_UnaryOp(self, node: ast.UnaryOp):
+        self.generic_visit(node)
+        ufunc = _unary_ufuncs.get(type(node.op))
+        if ufunc is None or not is_fresh(node.operand):
+            return node
+        return ast.copy_location(ast.Call(
+            func=ast.Name(id='_inplace_unary', ctx=ast.Load()),
+            args=[_numpy_attribute(ufunc), node.operand], keywords=[]), node)
+
+    def visit_Call(self, node: ast.Call):
+        self.generic_visit(node)
+        ufunc = _get_numpy_ufunc(node.func)
+        if ufunc is None or len(node.keywords) != 0 or len(node.args) != ufunc.nin:
+            return node
+        if ufunc.nin == 1 and is_fresh(node.args[0]):
+            return ast.copy_location(ast.Call(
+                func=ast.Name(id='_inplace_unary', ctx=ast.Load()),
+                args=[node.func, node.args[0]], keywords=[]), node)
+        elif ufunc.nin == 2 and (is_fresh(node.args[0]) or is_fresh(node.args[1])):
+            return ast.copy_location(ast.Call(
+                func=ast.Name(id='_inplace_binary', ctx=ast.Load()),
+                args=[node.func, node.args[0], node.args[1],
+                      ast.Constant(is_fresh(node.args[0])), ast.Constant(is_fresh(node.args[1]))],
+                keywords=[]), node)
+        return node
+
+
+def fuse(node: ast.expr) -> ast.expr:
+    """ Get a copy of the expression with its elementwise operations fused when possible"""
+    return ElementwiseFuser().visit(copy_node(node))
+
+
+def copy_node(node: ast.expr) -> ast.expr:
+    return ast.parse(ast.unparse(node), mode='eval').body
+
+
+class DataWithAxesEngine:
+    """ Evaluate the formulae on the DataWithAxes objects"""
+
+    def __init__(self, graph: FormulaGraph):
+        self.graph = graph
+
+    def bind(self, index: Mapping[str, DataWithAxes],
+             history: Optional[HistoryStore] = None) -> Dict[str, Any]:
+        """ Get the namespace binding the formulae variables to the indexed data and their
+        history"""
+        namespace = bind_variables(index, self.graph.variables)
+        if history is not None:
+            namespace.update(self.bind_history(history))
+        return namespace
+
+    def bind_history(self, history: HistoryStore) -> Dict[str, Any]:
+        return {history_identifier(identifier): history[full_name]
+                for full_name, identifier in self.graph.variables.items() if full_name in history}
+
+    def evaluate(self, formula: Formula, namespace: Dict[str, Any]) -> Any:
+        return formula.evaluate(namespace)
+
+    def to_data(self, formula: Formula, value: DataWithAxes,
+                index: Mapping[str, DataWithAxes]) -> DataWithAxes:
+        if any(value is data for data in index.values()):  # the input is shared with other models
+            value = copy.copy(value)  # renamed only, the arrays are copied by DataToExport.append
+        value.name = formula.name
+        return value
+
+
+class NdarrayEngine(DataWithAxesEngine):
+    """ Evaluate the formulae on the numpy arrays of the data, channel by channel
+
+    Data with a single channel are broadcast over the channels of the others. The outputs are
+    wrapped once into a DataCalculated whose axes are copied from the first data the formula
+    reads, if the shapes match.
+    """
+
+    def __init__(self, graph: FormulaGraph):
+        super().__init__(graph)
+        self.codes = {id(formula): compile(ast.fix_missing_locations(
+            ast.Expression(fuse(formula.node))), f'<{formula.name}>', 'eval')
+            for formula in graph.steps}
+        intermediates = {formula.target: formula for formula in graph.steps
+                         if formula.target is not None}
+        self.input_names = {id(formula): self.get_input_names(formula, intermediates)
+                            for formula in graph.outputs}
+
+    @staticmethod
+    def get_input_names(formula: Formula, intermediates: Dict[str, Formula]) -> List[str]:
+        """ Get the data full names a formula reads, directly or through intermediates"""
+        names = list(formula.data_names)
+        for name in sorted(formula.dependencies):
+            if name in intermediates:
+                names.extend(NdarrayEngine.get_input_names(intermediates[name], intermediates))
+        return list(dict.fromkeys(names))
+
+    def bind(self, index: Mapping[str, DataWithAxes],
+             history: Optional[HistoryStore] = None) -> Dict[str, List[Any]]:
+        namespace = {identifier: index[full_name].data
+                     for full_name, identifier in self.graph.variables.items()
+                     if full_name in index}
+        if history is not None:
+            namespace.update(self.bind_history(history))
+        return namespace
+
+    def bind_history(self, history: HistoryStore) -> Dict[str, List[Any]]:
+        return {history_identifier(identifier): history[full_name].channels
+                for full_name, identifier in self.graph.variables.items() if full_name in history}
+
+    def evaluate(self, formula: Formula, namespace: Dict[str, Any]) -> List[Any]:
+        code = self.codes[id(formula)]
+        arguments = {name: namespace[name] for name in formula.dependencies if name in namespace}
+        n_channels = max([len(channels) for channels in arguments.values()], default=1)
+        if n_channels == 1:
+            return [eval(code, _engine_globals,
+                         {name: channels[0] for name, channels in arguments.items()})]
+        for name, channels in arguments.items():
+            if len(channels) not in (1, n_channels):
+                raise ValueError(f'Cannot broadcast {len(channels)} channels over {n_channels}')
+        return [eval(code, _engine_globals,
+                     {name: channels[ind if len(channels) > 1 else 0]
+                      for name, channels in arguments.items()})
+                for ind in range(n_channels)]
+
+    def to_data(self, formula: Formula, value: List[Any],
+                index: Mapping[str, DataWithAxes]) -> DataCalculated:
+        arrays = [np.atleast_1d(array) for array in value]
+        inputs = [index[data_name] for data_name in self.input_names[id(formula)]
+                  if data_name in index]
+        if len(inputs) > 0 and inputs[0].shape == arrays[0].shape:
+            return DataCalculated(formula.name, data=arrays, origin=inputs[0].origin,
+                                  axes=[axis.copy() for axis in inputs[0].axes],
+                                  nav_indexes=inputs[0].nav_indexes,
+                                  distribution=inputs[0].distribution)
+        return DataCalculated(formula.name, data=arrays,
+                              origin=inputs[0].origin if len(inputs) > 0 else '')
+
+
+def get_engine(engine: str, graph: FormulaGraph) -> DataWithAxesEngine:
+    """ Get the engine evaluating the formulae of the graph from its name in ENGINES"""
+    if engine == 'ndarray':
+        return NdarrayEngine(graph)
+    return DataWithAxesEngine(graph)
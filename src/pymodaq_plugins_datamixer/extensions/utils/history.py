@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Fixed-size histories of the data referenced with the history syntax of the formulae
+
+* *{Det/ch}[-k]* is the data k frames before the current one
+* *hist({Det/ch}, N)* are the N last frames, the current one included, in chronological order
+
+The histories are preallocated numpy ring buffers, created only for the data whose history is
+referenced, and their total memory is capped.
+"""
+from typing import Dict, List, Mapping, Optional, Set
+
+import numpy as np
+
+from pymodaq_utils.logger import set_logger, get_module_name
+from pymodaq_data.data import DataCalculated, DataWithAxes
+
+logger = set_logger(get_module_name(__file__))
+
+
+class RingBuffer:
+    """ History of arrays of the same shape and dtype
+
+    Each frame is written twice, at index i and i + length of a buffer of twice the length, so
+    that the last frames are always available as a contiguous view in chronological order.
+
+    Parameters
+    ----------
+    length: int
+        the number of frames to keep
+    shape: tuple of int
+        the shape of the frames
+    dtype: np.dtype
+        the dtype of the frames
+    """
+
+    def __init__(self, length: int, shape: tuple, dtype: np.dtype):
+        self.length = length
+        self.buffer = np.empty((2 * length,) + tuple(shape), dtype=dtype)
+        self.index = 0  # the slot of the next frame
+        self.count = 0
+
+    @staticmethod
+    def get_nbytes(length: int, array: np.ndarray) -> int:
+        """ The memory needed to keep the history of arrays like this one"""
+        return 2 * length * array.nbytes
+
+    def matches(self, array: np.ndarray) -> bool:
+        return self.buffer.shape[1:] == array.shape and self.buffer.dtype == array.dtype
+
+    def append(self, array: np.ndarray):
+        self.buffer[self.index] = array
+        self.buffer[self.index + self.length] = array
+        self.index = (self.index + 1) % self.length
+        self.count = min(self.count + 1, self.length)
+
+    def past(self, k: int) -> np.ndarray:
+        """ The frame k frames before the last one, as a view"""
+        if not 0 <= k < self.count:
+            raise IndexError(f'{k} frames back is out of the history of {self.count} frames')
+        return self.buffer[self.index + self.length - 1 - k]
+
+    def window(self, n: int) -> np.ndarray:
+        """ The n last frames in chronological order, as a view"""
+        stop = self.index + self.length
+        return self.buffer[stop - min(n, self.count): stop]
+
+
+class DataHistory:
+    """ History of the channels of a DataWithAxes
+
+    Parameters
+    ----------
+    length: int
+        the number of frames to keep
+    """
+
+    def __init__(self, length: int):
+        self.length = length
+        self.channels: List[RingBuffer] = []
+        self.template: Optional[DataWithAxes] = None
+
+    @property
+    def nbytes(self) -> int:
+        return sum([channel.buffer.nbytes for channel in self.channels])
+
+    def matches(self, dwa: DataWithAxes) -> bool:
+        return (len(self.channels) == len(dwa) and
+                all([channel.matches(array) for channel, array in zip(self.channels, dwa)]))
+
+    def get_nbytes(self, dwa: DataWithAxes) -> int:
+        """ The memory needed to keep the history of this data"""
+        return sum([RingBuffer.get_nbytes(self.length, array) for array in dwa])
+
+    def allocate(self, dwa: DataWithAxes):
+        self.channels = [RingBuffer(self.length, array.shape, array.dtype) for array in dwa]
+
+    def clear(self):
+        self.channels = []
+        self.template = None
+
+    def append(self, dwa: DataWithAxes):
+        for channel, array in zip(self.channels, dwa):
+            channel.append(array)
+        self.template = dwa
+
+    def past(self, k: int) -> DataCalculated:
+        """ The data k frames before the last one"""
+        return DataCalculated(self.template.name,
+                              data=[channel.past(k) for channel in self.channels],
+                              labels=self.template.labels, origin=self.template.origin,
+                              units=self.template.units,
+                              axes=[axis.copy() for axis in self.template.axes],
+                              nav_indexes=self.template.nav_indexes,
+                              distribution=self.template.distribution)
+
+    def window(self, n: int) -> DataCalculated:
+        """ The n last frames, stacked along a first navigation axis"""
+        return DataCalculated(self.template.name,
+                              data=[channel.window(n) for channel in self.channels],
+                              labels=self.template.labels, origin=self.template.origin,
+                              units=self.template.units, nav_indexes=(0,))
+
+
+class HistoryStore:
+    """ The histories of the data referenced with the history syntax
+
+    The ring buffers are allocated from the first frame, and again if the shape or dtype of the
+    data changes. A history that would exceed the memory budget is not allocated and the
+    formulae using it fail.
+
+    Parameters
+    ----------
+    lengths: dict
+        the number of frames to keep for each data full name
+    max_bytes: float
+        the memory budget of all the histories
+    """
+
+    def __init__(self, lengths: Mapping[str, int], max_bytes: float):
+        self.max_bytes = max_bytes
+        self.histories: Dict[str, DataHistory] = {full_name: DataHistory(length)
+                                                  for full_name, length in lengths.items()}
+        self._over_budget: Set[str] = set()
+
+    def __contains__(self, full_name: str) -> bool:
+        return full_name in self.histories
+
+    def __getitem__(self, full_name: str) -> DataHistory:
+        return self.histories[full_name]
+
+    @property
+    def nbytes(self) -> int:
+        return sum([history.nbytes for history in self.histories.values()])
+
+    def update(self, index: Mapping[str, DataWithAxes]):
+        """ Append the current frame of the indexed data to their history"""
+        for full_name, history in self.histories.items():
+            dwa = index.get(full_name)
+            if dwa is None:
+                continue
+            if not history.matches(dwa):
+                nbytes = self.nbytes - history.nbytes + history.get_nbytes(dwa)
+                history.clear()
+                if nbytes > self.max_bytes:
+                    if full_name not in self._over_budget:
+                        self._over_budget.add(full_name)
+                        logger.warning(f'The history of {full_name} would exceed the memory '
+                                       f'budget: {nbytes / 1e6:.1f} MB > '
+                                       f'{self.max_bytes / 1e6:.1f} MB')
+                    continue
+                self._over_budget.discard(full_name)
+                history.allocate(dwa)
+            history.append(dwa)
+
+
+def past(history, k: int):
+    """ The data k frames before the current one, called by the formulae as *{Det/ch}[-k]*"""
+    return history.past(k)
+
+
+def window(history, n: int):
+    """ The n last frames, called by the formulae as *hist({Det/ch}, n)*"""
+    return history.window(n)
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Join stage combining the frames of free-running detectors into consistent DataToExport
+
+Each detector emits its own DataToExport at its own rate. The latest frames of each detector are
+buffered with their timestamps and a combined DataToExport is produced only when a frame of each
+required detector falls within a time tolerance of a common reference time.
+"""
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from pymodaq_data.data import DataToExport, DataWithAxes
+
+
+JOIN_POLICIES = ['Nearest', 'Interpolate']
+
+
+def get_timestamp(dte: DataToExport) -> float:
+    """ The acquisition time of a detector frame, that of its first data"""
+    return dte[0].timestamp
+
+
+def interpolate_dwa(before: DataWithAxes, after: DataWithAxes, weight: float) -> DataWithAxes:
+    """ Linear interpolation between two frames of the same data
+
+    Parameters
+    ----------
+    before: DataWithAxes
+    after: DataWithAxes
+    weight: float
+        the weight of the after frame, between 0 and 1
+    """
+    return before.deepcopy_with_new_data([(1 - weight) * array_before + weight * array_after
+                                          for array_before, array_after in zip(before, after)])
+
+
+class JoinBuffer:
+    """ Buffer the frames of several detectors and join those acquired at the same time
+
+    The reference time is the acquisition time of the latest frame of the slowest detector, so
+    that the other detectors already have frames around it. For each of them the frame nearest
+    to the reference time is taken, or with the Interpolate policy the linear interpolation
+    between the frames acquired just before and after it. A frame farther than the tolerance
+    from the reference time cannot be used, and the detectors are joined only once each of them
+    has a frame matching the reference. A frame is joined at most once, a reference matching
+    an already joined frame of a detector is skipped.
+
+    Parameters
+    ----------
+    required: list of str
+        the names of the detectors whose frames should be joined
+    tolerance: float
+        the maximum time difference, in seconds, between a frame and the reference time
+    policy: str
+        one of JOIN_POLICIES
+    depth: int
+        the number of frames buffered per detector
+    """
+
+    def __init__(self, required: Iterable[str], tolerance: float, policy: str = JOIN_POLICIES[0],
+                 depth: int = 16):
+        self.required = list(required)
+        self.tolerance = tolerance
+        self.policy = policy
+        self.frames: Dict[str, Deque[Tuple[float, DataToExport]]] = {
+            name: deque(maxlen=depth) for name in self.required}
+        self._last_used: Dict[str, float] = {}  # timestamp of the last joined frame per detector
+
+    def clear(self):
+        for frames in self.frames.values():
+            frames.clear()
+        self._last_used = {}
+
+    def add(self, dte: DataToExport) -> Optional[DataToExport]:
+        """ Buffer a detector frame
+
+        Returns
+        -------
+        DataToExport or None: the joined frames of all the required detectors, if they can be
+            joined with this new frame
+        """
+        if dte.name not in self.frames or len(dte) == 0:
+            return None
+        self.frames[dte.name].append((get_timestamp(dte), dte))
+        return self.join()
+
+    def join(self) -> Optional[DataToExport]:
+        if len(self.frames) == 0 or any([len(frames) == 0 for frames in self.frames.values()]):
+            return None
+        reference = min([frames[-1][0] for frames in self.frames.values()])
+
+        matches: Dict[str, Tuple[float, DataToExport]] = {}
+        for name in self.required:
+            match = self.match(self.frames[name], reference)
+            if match is None or (name in self._last_used and match[0] <= self._last_used[name]):
+                return None
+            matches[name] = match
+        data: List[DataWithAxes] = []
+        for name in self.required:
+            self._last_used[name] = matches[name][0]
+            data.extend(matches[name][1].data)
+        return DataToExport('Joined', data=data)
+
+    def match(self, frames: Deque[Tuple[float, DataToExport]],
+              reference: float) -> Optional[Tuple[float, DataToExport]]:
+        """ Get the frame matching the reference time and its timestamp, None if none is within
+        the tolerance"""
+        timestamps = np.array([timestamp for timestamp, _ in frames])
+        ind_nearest = int(np.argmin(np.abs(timestamps - reference)))
+        if self.policy == 'Interpolate' and timestamps[ind_nearest] != reference:
+            ind_after = int(np.searchsorted(timestamps, reference))
+            if (0 < ind_after < len(frames) and
+                    reference - timestamps[ind_after - 1] <= self.tolerance and
+                    timestamps[ind_after] - reference <= self.tolerance):
+                before, after = frames[ind_after - 1][1], frames[ind_after][1]
+                weight = ((reference - timestamps[ind_after - 1]) /
+                          (timestamps[ind_after] - timestamps[ind_after - 1]))
+                try:
+                    data = [interpolate_dwa(dwa_before, dwa_after, weight)
+                            for dwa_before, dwa_after in zip(before, after)]
+                except (ValueError, TypeError):  # frames of different shapes or types
+                    pass
+                else:
+                    for dwa in data:
+                        dwa.timestamp = reference
+                    return reference, DataToExport(before.name, data=data)
+        if abs(timestamps[ind_nearest] - reference) <= self.tolerance:
+            return frames[ind_nearest]
+        return None
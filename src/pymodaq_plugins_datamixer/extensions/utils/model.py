@@ -1,6 +1,8 @@
-from typing import List, TYPE_CHECKING
+from typing import List, Optional, Tuple, TYPE_CHECKING
 import importlib
+import importlib.util
 import inspect
+import json
 import pkgutil
 import warnings
 from pathlib import Path
@@ -13,12 +15,16 @@ from pymodaq_utils.logger import set_logger, get_module_name
 
 from pymodaq_data.data import DataToExport
 
-from pymodaq_gui.managers.parameter_manager import ParameterManager, Parameter
+from pymodaq_plugins_datamixer.utils import Config as PluginConfig
+from pymodaq_plugins_datamixer.extensions.utils.diagnostics import Diagnostics, DiagnosticsScope
 
 logger = set_logger(get_module_name(__file__))
 
+REGISTRY_FILE_NAME = 'models_registry_datamixer.json'
+
 if TYPE_CHECKING:
-    from pymodaq_plugins_datamixer.extensions.data_mixer import DataMixer
+    from pymodaq_gui.parameter import Parameter
+    from pymodaq_plugins_datamixer.extensions.utils.runner import ModelRunner
     from pymodaq.utils.managers.modules_manager import ModulesManager
 
 
@@ -27,10 +33,39 @@ class DataMixerModel:
     detectors_name: List[str] = []
     params = []
 
-    def __init__(self, data_mixer: 'DataMixer'):
+    def __init__(self, data_mixer: 'ModelRunner'):
+        """
+        Parameters
+        ----------
+        data_mixer: ModelRunner
+            the host of the model, giving access to its settings, to the detectors data and to
+            the diagnostics, either headless or within the DataMixer extension
+        """
         self.data_mixer = data_mixer
-        self.modules_manager: ModulesManager = data_mixer.dashboard.modules_manager
-        self.settings: Parameter = self.data_mixer.settings.child('models', 'model_params')
+        self.modules_manager: 'ModulesManager' = data_mixer.modules_manager
+        self.settings: 'Parameter' = data_mixer.model_settings
+        self.diagnostics: Union[Diagnostics, DiagnosticsScope] = data_mixer.diagnostics
+
+    def set_setting_value(self, value, *path: str):
+        """ Set the value of one of the model settings, from any thread
+
+        Parameters
+        ----------
+        value: object
+            the new value
+        path: str
+            the names of the parameter and its parents within the model settings
+        """
+        self.data_mixer.set_parameter_value(self.settings.child(*path), value)
+
+    @classmethod
+    def required_data(cls, settings: 'Parameter') -> Optional[List[str]]:
+        """ The full names of the data the model reads given its settings
+
+        Only these data are given to the model and only the detectors providing them need to be
+        grabbed. Models reading any data, the default, return None.
+        """
+        return None
 
     def ini_model_base(self):
         """ Method to add things that should be executed before instantiating the model"""
@@ -39,7 +74,7 @@ class DataMixerModel:
     def ini_model(self):
         pass
 
-    def update_settings(self, param: Parameter):
+    def update_settings(self, param: 'Parameter'):
         pass
 
     def process_dte(self, measurements: DataToExport) -> DataToExport:
@@ -57,38 +92,164 @@ class DataMixerModel:
         raise NotImplementedError
 
 
-def get_models(model_name=None):
-    """
-    Get DataMixer Models
+def get_registry_path() -> Path:
+    """ Path of the models registry cache, stored next to the plugin configuration file"""
+    return PluginConfig().config_path.parent.joinpath(REGISTRY_FILE_NAME)
+
+
+def get_models_packages() -> List[Tuple[str, str, List[Path]]]:
+    """ Get the packages declaring a pymodaq.models entry point without importing them
 
     Returns
     -------
-    list: list of dict containting the name and python module of the found models
+    list of tuple: the package name, the version of its distribution and its models directories
+    """
+    packages = []
+    for pkg in get_entrypoints(group='pymodaq.models'):
+        try:
+            spec = importlib.util.find_spec(pkg.value)
+            version = pkg.dist.version if pkg.dist is not None else ''
+            packages.append((pkg.value, version,
+                             [Path(path).joinpath('models') for path in spec.submodule_search_locations]))
+        except Exception as e:  # pragma: no cover
+            logger.warning(f'Impossible to list the {pkg.value} models: {str(e)}')
+    return packages
+
+
+def get_registry_key(packages: List[Tuple[str, str, List[Path]]]) -> dict:
+    """ Key identifying the installed models: distributions versions and models directories mtimes
+
+    The mtimes of the python files are included as editing a module does not change the mtime of
+    its directory
+    """
+    key = {}
+    for module_name, version, paths in packages:
+        mtime = 0.
+        for path in paths:
+            if path.is_dir():
+                mtime = max([mtime, path.stat().st_mtime] +
+                            [file.stat().st_mtime for file in path.glob('*.py')])
+        key[module_name] = [version, mtime]
+    return key
+
+
+def get_model_classes(model_module) -> List[type]:
+    """ Get the DataMixerModel subclasses, at any depth, defined within a module
+
+    Only the models implementing process_dte are kept, and among them the base classes of other
+    models only if they define process_dte themselves
     """
-    models_import = []
-    discovered_models = list(get_entrypoints(group='pymodaq.models'))
-    if len(discovered_models) > 0:
-        for pkg in discovered_models:
+    classes = [klass for name, klass in inspect.getmembers(model_module, inspect.isclass)
+               if issubclass(klass, DataMixerModel) and klass is not DataMixerModel
+               and klass.__module__ == model_module.__name__]
+    return [klass for klass in classes
+            if klass.process_dte is not DataMixerModel.process_dte and
+            ('process_dte' in vars(klass) or
+             not any([other is not klass and issubclass(other, klass) for other in classes]))]
+
+
+def get_primary_model(classes: List[type]) -> Optional[type]:
+    """ The model of a module named after the module: its first direct subclass of
+    DataMixerModel, else its first model"""
+    for klass in classes:
+        if klass.__base__ is DataMixerModel:
+            return klass
+    return classes[0] if len(classes) > 0 else None
+
+
+def scan_models(packages: List[Tuple[str, str, List[Path]]]) -> List[dict]:
+    """ Import all models modules and record the DataMixerModel subclasses they define
+
+    A model is named from its module. When a module defines several models, this name is kept by
+    its primary model, the one listed before models could be subclassed at any depth, so that the
+    presets and configurations referring to it still do; the others are named module/class
+    """
+    models = []
+    for module_name, version, paths in packages:
+        for mod in pkgutil.iter_modules([str(path) for path in paths]):
+            model_module_name = f'{module_name}.models.{mod.name}'
             try:
-                module = importlib.import_module(pkg.value)
-                module_name = pkg.value
+                classes = get_model_classes(importlib.import_module(model_module_name))
+            except Exception as e:  # pragma: no cover
+                logger.warning(f'Impossible to import the {mod.name} model: {str(e)}')
+                continue
+            primary = get_primary_model(classes)
+            for klass in classes:
+                models.append({'name': mod.name if klass is primary else f'{mod.name}/{klass.__name__}',
+                               'module_name': model_module_name,
+                               'class_name': klass.__name__})
+    return models
 
-                for mod in pkgutil.iter_modules([str(Path(module.__file__).parent.joinpath('models'))]):
-                    try:
-                        model_module = importlib.import_module(f'{module_name}.models.{mod.name}', module)
-                        classes = inspect.getmembers(model_module, inspect.isclass)
-                        for name, klass in classes:
-                            if klass.__base__ is DataMixerModel:
-                                models_import.append({'name': mod.name, 'module': model_module, 'class': klass})
-                                break
 
-                    except Exception as e:  # pragma: no cover
-                        logger.warning(str(e))
+def get_models(model_name=None, use_cache=True):
+    """
+    Get DataMixer Models
 
-            except Exception as e:  # pragma: no cover
-                logger.warning(f'Impossible to import the {pkg.value} extension: {str(e)}')
+    The models are read from the registry cache when it is valid, that is when no distribution
+    declaring models has been installed, removed or updated and no models directory has changed.
+    Otherwise all models modules are scanned and the registry saved. The model classes are then
+    imported on demand using load_model_class
+
+    Parameters
+    ----------
+    model_name: str, optional
+        if given, return only the dict of this model
+    use_cache: bool
+        if False, always do the full scan
+
+    Returns
+    -------
+    list: list of dict containing the name, python module name and class name of the found models
+    """
+    packages = get_models_packages()
+    key = get_registry_key(packages)
+    registry_path = get_registry_path()
+
+    models_import = None
+    if use_cache:
+        try:
+            registry = json.loads(registry_path.read_text())
+            if registry['key'] == key:
+                models_import = registry['models']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    if models_import is None:
+        models_import = scan_models(packages)
+        try:
+            registry_path.write_text(json.dumps({'key': key, 'models': models_import}, indent=1))
+        except OSError as e:  # pragma: no cover
+            logger.warning(f'Impossible to save the models registry: {str(e)}')
 
     if model_name is None:
         return models_import
     else:
         return find_dict_in_list_from_key_val(models_import, 'name', model_name)
+
+
+def load_model_class(model: dict) -> Optional[type]:
+    """ Import the module of a model listed by get_models and get its DataMixerModel subclass
+
+    The module and class are stored in the model dict under the 'module' and 'class' keys so that
+    the import is done only once
+
+    Parameters
+    ----------
+    model: dict
+        one of the dict returned by get_models
+
+    Returns
+    -------
+    type or None: the model class or None if it could not be imported
+    """
+    if 'class' not in model:
+        model['class'] = None
+        try:
+            model_module = importlib.import_module(model['module_name'])
+            model['module'] = model_module
+            model['class'] = getattr(model_module, model['class_name'], None)
+            if model['class'] is None:
+                logger.warning(f'No {model["class_name"]} model found in {model["module_name"]}')
+        except Exception as e:  # pragma: no cover
+            logger.warning(f'Impossible to import the {model["name"]} model: {str(e)}')
+    return model['class']
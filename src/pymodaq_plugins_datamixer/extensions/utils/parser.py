@@ -1,9 +1,22 @@
+import ast
 import re
-from typing import List
+from collections import Counter
+from typing import (Any, Dict, Iterator, List, Mapping, Optional, Set, Tuple, Union,
+                    TYPE_CHECKING)
+
+import numpy as np  # used by the compiled formulae
+
+from pymodaq_plugins_datamixer.extensions.utils.history import past, window
+
+if TYPE_CHECKING:
+    from pymodaq_data.data import DataToExport
 
 
 data_name_regexp = re.compile(r"({.*?})+")  # first occurrences of things between {}
 
+# global namespace of the evaluated formulae
+formula_globals = {'np': np, '_past': past, '_window': window}
+
 
 def split_formulae(formulae: str) -> List[str]:
     """ Split a string into a list of string for each new line
@@ -51,3 +64,410 @@ def replace_names_in_formula(formula: str):
             break
     return formula_tmp, names
 
+
+
+def bind_names_in_formula(formula: str, variables: Dict[str, str] = None) -> Tuple[str, Dict[str, str]]:
+    """ Replace the data full names between curly brackets by python identifiers
+
+    Parameters
+    ----------
+    formula: str
+        The mathematical expression containing in curly brackets the data full names
+    variables: dict
+        Mapping between data full names and identifiers. New names are added in place so that
+        the same mapping can be shared between several formulae
+
+    Returns
+    -------
+    str: the formula with identifiers in place of the data full names
+    dict: the mapping between the data full names and their identifier
+    """
+    if variables is None:
+        variables = {}
+
+    def to_identifier(match: re.Match) -> str:
+        full_name = match.group()[1:-1]
+        if full_name not in variables:
+            variables[full_name] = f'_data_{len(variables):03.0f}'
+        return variables[full_name]
+
+    return data_name_regexp.sub(to_identifier, formula), variables
+
+
+def history_identifier(identifier: str) -> str:
+    """ The identifier bound to the history of the data bound to the given identifier"""
+    return identifier.replace('_data_', '_hist_', 1)
+
+
+def index_full_names(dte) -> Dict[str, Any]:
+    """ Index the DataWithAxes of a DataToExport by their full name
+
+    If several data share the same full name, the first one is indexed, as would
+    DataToExport.get_data_from_full_name do.
+    """
+    index = {}
+    for dwa in dte.data:
+        index.setdefault(dwa.get_full_name(), dwa)
+    return index
+
+
+def bind_variables(index: Mapping[str, Any], variables: Dict[str, str]) -> Dict[str, Any]:
+    """ Get the namespace binding the identifiers to the indexed data
+
+    Names missing from the index are not bound, so that formulae using them raise a NameError
+    """
+    return {identifier: index[full_name] for full_name, identifier in variables.items()
+            if full_name in index}
+
+
+class Formula:
+    """ A single formula line compiled once into a python code object
+
+    A line is either an expression, whose result is an output of the mixer, or an assignment
+    *name = expression* defining a named intermediate that other lines can reference.
+
+    Past frames of the data can be referenced as *{Det/ch}[-k]*, the data k frames before the
+    current one, or *hist({Det/ch}, N)*, the N last frames, the current one included.
+
+    Parameters
+    ----------
+    expression: str
+        The mathematical expression using numpy and data full names within curly brackets
+    name: str
+        The name to give to the DataWithAxes produced by the evaluation of the formula
+    variables: dict
+        Mapping between data full names and identifiers, shared between formulae so that a
+        namespace bound once per frame can be used to evaluate all of them
+
+    Attributes
+    ----------
+    expression: str
+    name: str
+    target: str or None
+        The name of the intermediate defined by the formula, None if the formula is an output
+    data_names: list of str
+        The distinct data full names the formula depends on
+    history: dict
+        The number of frames of history needed for each data full name
+    variables: dict
+    node: ast.expr
+        The syntax tree of the expression, using identifiers in place of the data full names
+    code: CodeType
+        The compiled expression
+    """
+
+    def __init__(self, expression: str, name: str = '', variables: Dict[str, str] = None):
+        self.expression = expression
+        self.name = name
+        self.data_names = list(dict.fromkeys(extract_data_names(expression)))
+        formula_to_eval, self.variables = bind_names_in_formula(expression, variables)
+
+        tree = ast.parse(formula_to_eval.strip(), filename=f'<{name}>', mode='exec')
+        if len(tree.body) != 1:
+            raise SyntaxError(f'A formula should be a single expression: {expression}')
+        statement = tree.body[0]
+        if isinstance(statement, ast.Expr):
+            self.target: Optional[str] = None
+        elif (isinstance(statement, ast.Assign) and len(statement.targets) == 1 and
+              isinstance(statement.targets[0], ast.Name)):
+            self.target = statement.targets[0].id
+            if self.target == 'np' or self.target.startswith('_'):
+                raise SyntaxError(f'Invalid name for an intermediate: {self.target}')
+        else:
+            raise SyntaxError(f'A formula should be an expression or a single assignment: '
+                              f'{expression}')
+        rewriter = _HistoryRewriter(self.variables)
+        self.set_node(rewriter.visit(statement.value))
+        self.history: Dict[str, int] = rewriter.history
+
+    @classmethod
+    def from_node(cls, node: ast.expr, name: str, target: str = None,
+                  variables: Dict[str, str] = None) -> 'Formula':
+        """ Create a Formula from an already parsed expression, for instance a shared
+        sub-expression"""
+        formula = cls.__new__(cls)
+        formula.expression = ast.unparse(node)
+        formula.name = name
+        formula.target = target
+        formula.variables = variables if variables is not None else {}
+        formula.history = {}
+        identifiers = get_node_names(node)
+        formula.data_names = [full_name for full_name, identifier in formula.variables.items()
+                              if identifier in identifiers]
+        formula.set_node(node)
+        return formula
+
+    def set_node(self, node: ast.expr):
+        """ Set and compile the syntax tree of the expression"""
+        self.node = node
+        self.code = compile(ast.fix_missing_locations(ast.Expression(node)), f'<{self.name}>',
+                            'eval')
+        self._dependencies = get_node_names(node)
+
+    @property
+    def dependencies(self) -> Set[str]:
+        """ The identifiers the expression reads"""
+        return self._dependencies
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.name}: {self.expression})'
+
+    def evaluate(self, data: Union['DataToExport', Mapping[str, Any]]):
+        """ Evaluate the compiled expression
+
+        Parameters
+        ----------
+        data: DataToExport or dict
+            Either the DataToExport containing the data or a namespace already bound using
+            bind_variables
+        """
+        if not isinstance(data, Mapping):
+            data = bind_variables(index_full_names(data), self.variables)
+        return eval(self.code, formula_globals, data)
+
+
+class _HistoryRewriter(ast.NodeTransformer):
+    """ Rewrite the history syntax into calls to the history functions
+
+    *_data_000[-k]* becomes *_past(_hist_000, k)* and *hist(_data_000, N)* becomes
+    *_window(_hist_000, N)*, recording the number of frames needed for each data full name.
+    """
+
+    def __init__(self, variables: Dict[str, str]):
+        self.full_names = {identifier: full_name for full_name, identifier in variables.items()}
+        self.history: Dict[str, int] = {}
+
+    def _record(self, name: ast.Name, length: int):
+        full_name = self.full_names[name.id]
+        self.history[full_name] = max(self.history.get(full_name, 0), length)
+
+    def _call(self, function: str, name: ast.Name, frames: int, node: ast.expr) -> ast.Call:
+        return ast.copy_location(ast.Call(
+            func=ast.Name(id=function, ctx=ast.Load()),
+            args=[ast.Name(id=history_identifier(name.id), ctx=ast.Load()), ast.Constant(frames)],
+            keywords=[]), node)
+
+    def visit_Subscript(self, node: ast.Subscript):
+        if (isinstance(node.value, ast.Name) and node.value.id in self.full_names and
+                isinstance(node.slice, ast.UnaryOp) and isinstance(node.slice.op, ast.USub) and
+                isinstance(node.slice.operand, ast.Constant) and
+                type(node.slice.operand.value) is int and node.slice.operand.value > 0):
+            frames = node.slice.operand.value
+            self._record(node.value, frames + 1)
+            return self._call('_past', node.value, frames, node)
+        return self.generic_visit(node)
+
+    def visit_Call(self, node: ast.Call):
+        if isinstance(node.func, ast.Name) and node.func.id == 'hist':
+            if not (len(node.args) == 2 and len(node.keywords) == 0 and
+                    isinstance(node.args[0], ast.Name) and node.args[0].id in self.full_names and
+                    isinstance(node.args[1], ast.Constant) and
+                    type(node.args[1].value) is int and node.args[1].value > 0):
+                raise SyntaxError('hist expects a data full name within curly brackets and a '
+                                  'positive number of frames')
+            self._record(node.args[0], node.args[1].value)
+            return self._call('_window', node.args[0], node.args[1].value, node)
+        return self.generic_visit(node)
+
+
+_scoping_nodes = (ast.Lambda, ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)
+_shareable_nodes = (ast.BinOp, ast.UnaryOp, ast.Call, ast.Subscript, ast.Compare)
+
+
+def get_node_names(node: ast.AST) -> Set[str]:
+    """ Get the identifiers read within a syntax tree"""
+    return {child.id for child in ast.walk(node)
+            if isinstance(child, ast.Name) and isinstance(child.ctx, ast.Load)}
+
+
+def iter_shareable_nodes(node: ast.AST) -> Iterator[ast.expr]:
+    """ Iterate over the sub-expressions that could be computed once and shared
+
+    Nodes within lambdas or comprehensions are not considered as they may depend on locally
+    bound names.
+    """
+    if isinstance(node, _shareable_nodes):
+        yield node
+    if not isinstance(node, _scoping_nodes):
+        for child in ast.iter_child_nodes(node):
+            yield from iter_shareable_nodes(child)
+
+
+class _NodeReplacer(ast.NodeTransformer):
+    """ Replace all occurrences of a given sub-expression by an identifier"""
+
+    def __init__(self, key: str, identifier: str):
+        self.key = key
+        self.identifier = identifier
+
+    def visit(self, node):
+        if isinstance(node, _shareable_nodes) and ast.dump(node) == self.key:
+            return ast.copy_location(ast.Name(id=self.identifier, ctx=ast.Load()), node)
+        if isinstance(node, _scoping_nodes):
+            return node
+        return self.generic_visit(node)
+
+
+class FormulaGraph:
+    """ Formula lines compiled into a dependency graph
+
+    Lines defining intermediates (*name = expression*) can be referenced by any other line.
+    Only the intermediates needed by the outputs are evaluated and sub-expressions appearing
+    several times are computed only once per frame, formulae being considered as pure
+    functions of their data.
+
+    Parameters
+    ----------
+    formulae: str
+        The formulae separated with a new line character
+    name_format: str
+        The format used to name the outputs from their line index
+
+    Attributes
+    ----------
+    variables: dict
+        Mapping between data full names and identifiers shared by all the formulae
+    formulae: list of Formula
+        The valid formula lines
+    errors: dict
+        The error messages of the invalid lines indexed by their line index
+    steps: list of Formula
+        The formulae to evaluate in order: intermediates, shared sub-expressions and outputs
+    """
+
+    def __init__(self, formulae: str, name_format: str = 'Formula_{:03.0f}'):
+        self.name_format = name_format
+        self.variables: Dict[str, str] = {}
+        self.formulae: List[Formula] = []
+        self.errors: Dict[int, str] = {}
+        self.steps: List[Formula] = []
+
+        self._line_indexes: Dict[int, int] = {}
+        line_indexes: Dict[str, int] = {}
+        for ind, expression in enumerate(split_formulae(formulae)):
+            if expression.strip() == '':
+                continue
+            try:
+                formula = Formula(expression, name=name_format.format(ind),
+                                  variables=self.variables)
+                if formula.target is not None and formula.target in line_indexes:
+                    raise SyntaxError(f'{formula.target} is already defined at line '
+                                      f'{line_indexes[formula.target]}')
+            except SyntaxError as e:
+                self.errors[ind] = str(e)
+                continue
+            if formula.target is not None:
+                line_indexes[formula.target] = ind
+            self._line_indexes[id(formula)] = ind
+            self.formulae.append(formula)
+
+        self.build_steps()
+
+    @property
+    def outputs(self) -> List[Formula]:
+        return [formula for formula in self.steps if formula.target is None]
+
+    @property
+    def history(self) -> Dict[str, int]:
+        """ The number of frames of history needed by the outputs for each data full name"""
+        history: Dict[str, int] = {}
+        for formula in self.steps:
+            for full_name, length in formula.history.items():
+                history[full_name] = max(history.get(full_name, 0), length)
+        return history
+
+    @property
+    def data_names(self) -> List[str]:
+        """ The distinct data full names needed to evaluate the outputs"""
+        return list(dict.fromkeys([data_name for formula in self.steps
+                                   for data_name in formula.data_names]))
+
+    def build_steps(self):
+        """ Prune the intermediates not needed by the outputs, share the common
+        sub-expressions and order the evaluation"""
+        formulae = self.select_needed(self.formulae)
+        formulae = self.share_subexpressions(formulae)
+        self.steps = self.sort(formulae)
+
+    @staticmethod
+    def select_needed(formulae: List[Formula]) -> List[Formula]:
+        """ Keep the outputs and the intermediates they depend on, directly or not"""
+        intermediates = {formula.target: formula for formula in formulae
+                         if formula.target is not None}
+        needed = set()
+        to_visit = [formula for formula in formulae if formula.target is None]
+        while len(to_visit) > 0:
+            formula = to_visit.pop()
+            if id(formula) in needed:
+                continue
+            needed.add(id(formula))
+            to_visit.extend([intermediates[name] for name in formula.dependencies
+                             if name in intermediates])
+        return [formula for formula in formulae if id(formula) in needed]
+
+    def share_subexpressions(self, formulae: List[Formula]) -> List[Formula]:
+        """ Replace the sub-expressions appearing several times by shared intermediates
+
+        The largest repeated sub-expression is extracted first, until no repetition remains.
+        """
+        formulae = list(formulae)
+        n_shared = 0
+        while True:
+            counts = Counter(ast.dump(node) for formula in formulae
+                             for node in iter_shareable_nodes(formula.node))
+            repeated = [key for key, count in counts.items() if count > 1]
+            if len(repeated) == 0:
+                break
+            key = max(repeated, key=len)
+            defining = [formula for formula in formulae if formula.target is not None and
+                        ast.dump(formula.node) == key]
+            if len(defining) > 0:  # an intermediate already holds this sub-expression
+                identifier = defining[0].target
+            else:
+                identifier = f'_shared_{n_shared:03.0f}'
+                n_shared += 1
+                shared_node = next(node for formula in formulae
+                                   for node in iter_shareable_nodes(formula.node)
+                                   if ast.dump(node) == key)
+            replacer = _NodeReplacer(key, identifier)
+            for formula in formulae:
+                if formula.target != identifier:
+                    formula.set_node(replacer.visit(formula.node))
+            if len(defining) == 0:
+                formulae.append(Formula.from_node(shared_node, name=identifier,
+                                                  target=identifier, variables=self.variables))
+        return formulae
+
+    def sort(self, formulae: List[Formula]) -> List[Formula]:
+        """ Order the formulae so that each one is evaluated after its dependencies
+
+        Outputs keep their line order. Formulae involved in a circular definition are
+        discarded and reported in the errors.
+        """
+        intermediates = {formula.target: formula for formula in formulae
+                         if formula.target is not None}
+        steps: List[Formula] = []
+        done = set()
+        visiting = set()
+
+        def visit(formula: Formula) -> bool:
+            if id(formula) in done:
+                return True
+            if id(formula) in visiting:
+                return False
+            visiting.add(id(formula))
+            valid = all([visit(intermediates[name]) for name in sorted(formula.dependencies)
+                         if name in intermediates])
+            visiting.discard(id(formula))
+            if valid:
+                done.add(id(formula))
+                steps.append(formula)
+            else:
+                self.errors[self._line_indexes.get(id(formula), -1)] = \
+                    f'Circular definition involving {formula.target or formula.name}'
+            return valid
+
+        for formula in formulae:
+            if formula.target is None:
+                visit(formula)
+        return steps
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+Several models processing the same frames: independent models process the detectors data in
+parallel while chained models process the output of a previous model
+"""
+import copy
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Collection, Dict, List, Optional, Sequence, Set, Union, TYPE_CHECKING
+
+from pymodaq_data.data import DataToExport, DataWithAxes
+
+from pymodaq_plugins_datamixer.extensions.utils.runner import ModelRunner
+
+if TYPE_CHECKING:
+    from pymodaq_plugins_datamixer.extensions.utils.process import ProcessModelRunner
+
+DETECTORS_INPUT = 'Detectors'  # the input of the models processing the detectors data
+
+
+def is_descendant(root, param) -> bool:
+    """ True if param is within the tree of root, a Parameter or a SettingsNode"""
+    while param is not None:
+        if param is root:
+            return True
+        param = param.parent()
+    return False
+
+
+def select_data(dte: DataToExport, full_names: Collection[str]) -> DataToExport:
+    """ The data of dte having one of the given full names, without copying them"""
+    return DataToExport(dte.name, data=[dwa for dwa in dte if dwa.get_full_name() in full_names])
+
+
+def with_origin(dwa: DataWithAxes, origin: str) -> DataWithAxes:
+    """ A shallow copy of dwa, sharing its arrays, with another origin"""
+    dwa = copy.copy(dwa)
+    dwa.origin = origin
+    return dwa
+
+
+@dataclass
+class PipelineStage:
+    """ A model of a pipeline
+
+    Attributes
+    ----------
+    name: str
+        unique name of the stage within its pipeline
+    runner: ModelRunner or ProcessModelRunner
+        the host of the model
+    input: str
+        DETECTORS_INPUT or the name of the previous stage whose output is processed
+    """
+    name: str
+    runner: Union[ModelRunner, 'ProcessModelRunner']
+    input: str = DETECTORS_INPUT
+
+
+class ModelPipeline:
+    """ Models processing each frame, their outputs being merged into a single DataToExport
+
+    Stages are sorted in levels: the models processing the detectors data, then those processing
+    their outputs and so on. The models of a level run concurrently in a thread pool, the output
+    of a model being given as is, without copy, to the chained models. The models processing the
+    detectors data only get the data they declare reading, if any. The outputs of the stages
+    but the first one are merged with the stage name as origin, so that the full names of the
+    merged data are unique.
+
+    Parameters
+    ----------
+    stages: list of PipelineStage
+        in order, a stage can only process the output of a previous one
+    """
+
+    def __init__(self, stages: Sequence[PipelineStage] = ()):
+        self.stages: List[PipelineStage] = []
+        self.levels: List[List[PipelineStage]] = []
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pool_size = 0
+        self.required: Dict[str, Optional[Set[str]]] = {}
+        for stage in stages:
+            self.add_stage(stage)
+
+    def add_stage(self, stage: PipelineStage):
+        names = [previous.name for previous in self.stages]
+        if stage.name in names:
+            raise ValueError(f'A model named {stage.name} is already in the pipeline')
+        if stage.input != DETECTORS_INPUT and stage.input not in names:
+            raise ValueError(f'The input {stage.input} of the {stage.name} model is not a previous'
+                             f' model of the pipeline')
+        self.stages.append(stage)
+        self.levels = self.get_levels()
+        self.update_required()
+
+    def update_required(self):
+        """ Get the data each model reads, to be called when the models settings change"""
+        required = {}
+        for stage in self.stages:
+            data_names = stage.runner.required_data()
+            required[stage.name] = set(data_names) if data_names is not None else None
+        self.required = required  # replaced at once as read from the processing thread
+
+    def required_data(self) -> Optional[List[str]]:
+        """ The full names of the detectors data read by the models, None if any may be read"""
+        data_names = []
+        for stage in self.stages:
+            if stage.input == DETECTORS_INPUT:
+                if self.required[stage.name] is None:
+                    return None
+                data_names.extend(self.required[stage.name])
+        return list(dict.fromkeys(data_names))
+
+    def get_levels(self) -> List[List[PipelineStage]]:
+        depths: Dict[str, int] = {DETECTORS_INPUT: -1}
+        levels: List[List[PipelineStage]] = []
+        for stage in self.stages:
+            depth = depths[stage.input] + 1
+            depths[stage.name] = depth
+            if depth == len(levels):
+                levels.append([])
+            levels[depth].append(stage)
+        width = max([len(level) for level in levels])
+        if width > self._pool_size and width > 1:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+            self._executor = ThreadPoolExecutor(max_workers=width,
+                                                thread_name_prefix='DataMixerModel')
+            self._pool_size = width
+        return levels
+
+    @property
+    def model(self):
+        """ The model of the first stage"""
+        return self.stages[0].runner.model if len(self.stages) > 0 else None
+
+    def process(self, dte: DataToExport) -> DataToExport:
+        """ Process a frame with all the models and merge their outputs"""
+        outputs: Dict[str, DataToExport] = {DETECTORS_INPUT: dte}
+        required = self.required
+        for level in self.levels:
+            inputs = [outputs[stage.input] if stage.input != DETECTORS_INPUT or
+                      required[stage.name] is None else select_data(dte, required[stage.name])
+                      for stage in level]
+            if len(level) == 1:
+                outputs[level[0].name] = level[0].runner.process(inputs[0])
+            else:
+                futures = [self._executor.submit(stage.runner.process, stage_input)
+                           for stage, stage_input in zip(level, inputs)]
+                for stage, future in zip(level, futures):
+                    outputs[stage.name] = future.result()
+        data = list(outputs[self.stages[0].name])
+        for stage in self.stages[1:]:
+            data.extend([with_origin(dwa, stage.name) for dwa in outputs[stage.name]])
+        return DataToExport('computed', data=data)
+
+    process_dte = process  # so that a pipeline can be fed to a ModelWorker as a model
+
+    def update_settings(self, param) -> bool:
+        """ Let the model owning a parameter apply its change
+
+        Returns
+        -------
+        bool: True if the parameter belongs to one of the models
+        """
+        for stage in self.stages:
+            if is_descendant(stage.runner.model_settings, param):
+                stage.runner.update_settings(param)
+                self.update_required()
+                return True
+        return False
+
+    def stop(self):
+        """ End the model processes, if any, and the thread pool"""
+        for stage in self.stages:
+            if hasattr(stage.runner, 'stop'):
+                stage.runner.stop()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+            self._pool_size = 0
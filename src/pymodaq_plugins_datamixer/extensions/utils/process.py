@@ -0,0 +1,409 @@
+# -*- coding: utf-8 -*-
+"""
+Execution of a DataMixerModel in a separate process, so that CPU-bound models do not compete with
+the GUI and the acquisition for the GIL
+
+The frames arrays go both ways through ring slots in shared memory, only their description
+(names, labels, axes, layout within the slot...) travels through the pipe to the process.
+"""
+import multiprocessing
+import threading
+import traceback
+from multiprocessing import shared_memory
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple, Type, Union, TYPE_CHECKING
+
+import numpy as np
+
+from pymodaq_utils.logger import set_logger, get_module_name
+from pymodaq_data.data import DataToExport, DataWithAxes
+
+from pymodaq_plugins_datamixer.extensions.utils.diagnostics import Diagnostics
+from pymodaq_plugins_datamixer.extensions.utils.model import DataMixerModel
+from pymodaq_plugins_datamixer.extensions.utils.runner import (ModelRunner, create_settings,
+                                                               get_model_class, MODEL_SETTINGS_PATH)
+from pymodaq_plugins_datamixer.extensions.utils.settings import (SettingsNode, iter_params,
+                                                                 settings_to_dict)
+
+if TYPE_CHECKING:
+    from multiprocessing.connection import Connection
+    from pymodaq_gui.parameter import Parameter
+
+logger = set_logger(get_module_name(__file__))
+
+PROCESS_BACKENDS = ['Thread', 'Process']
+ALIGNMENT = 64  # bytes, alignment of the arrays within a slot
+
+
+class SharedRing:
+    """ Fixed-size slots within a shared memory block, used in turn to transfer frames arrays
+
+    Parameters
+    ----------
+    n_slots: int
+    slot_bytes: int
+        the size of each slot
+    name: str, optional
+        the name of an existing block to attach to, a new block is created if None and unlinked
+        when closed
+    """
+
+    def __init__(self, n_slots: int, slot_bytes: int, name: str = None):
+        self.n_slots = n_slots
+        self.slot_bytes = slot_bytes
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=n_slots * slot_bytes)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self._next_slot = 0
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def next_slot(self) -> int:
+        slot = self._next_slot
+        self._next_slot = (self._next_slot + 1) % self.n_slots
+        return slot
+
+    def write(self, slot: int, arrays: List[np.ndarray]) -> Optional[List[Tuple]]:
+        """ Copy arrays into a slot
+
+        Returns
+        -------
+        list of tuple or None: the offset, shape and dtype of each array within the slot, None if
+            they do not fit in the slot or cannot be shared
+        """
+        layouts = []
+        offset = 0
+        for array in arrays:
+            array = np.asarray(array)
+            if array.dtype.hasobject or offset + array.nbytes > self.slot_bytes:
+                return None
+            np.ndarray(array.shape, array.dtype, buffer=self.shm.buf,
+                       offset=slot * self.slot_bytes + offset)[...] = array
+            layouts.append((offset, array.shape, array.dtype.str))
+            offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+        return layouts
+
+    def read(self, slot: int, layouts: List[Tuple], copy: bool = True) -> List[np.ndarray]:
+        """ Get the arrays of a slot, as views on the shared memory if copy is False"""
+        arrays = [np.ndarray(shape, dtype, buffer=self.shm.buf, offset=slot * self.slot_bytes + offset)
+                  for offset, shape, dtype in layouts]
+        return [array.copy() for array in arrays] if copy else arrays
+
+    def close(self):
+        try:
+            self.shm.close()
+        except BufferError:  # views are still referenced, the block is released at exit
+            pass
+        if self.owner:
+            self.shm.unlink()
+
+
+def describe_data(dwa: DataWithAxes) -> Dict[str, Any]:
+    """ Everything but the data arrays of a DataWithAxes"""
+    return dict(name=dwa.name, source=dwa.source.name, dim=dwa.dim.name,
+                distribution=dwa.distribution.name, labels=dwa.labels, origin=dwa.origin,
+                units=dwa.units, nav_indexes=dwa.nav_indexes, axes=dwa.axes,
+                timestamp=dwa.timestamp, length=len(dwa))
+
+
+def encode_dte(dte: DataToExport, ring: SharedRing) -> Tuple[Optional[int], Dict[str, Any]]:
+    """ Write the arrays of a DataToExport in the next slot of a ring
+
+    Returns
+    -------
+    int or None: the slot, None if the arrays did not fit and are within the header
+    dict: the header describing the DataToExport
+    """
+    arrays = [array for dwa in dte for array in dwa]
+    header = dict(name=dte.name, data=[describe_data(dwa) for dwa in dte])
+    slot = ring.next_slot()
+    layouts = ring.write(slot, arrays)
+    if layouts is None:
+        header['arrays'] = arrays
+        return None, header
+    header['layouts'] = layouts
+    return slot, header
+
+
+def decode_dte(slot: Optional[int], header: Dict[str, Any], ring: SharedRing,
+               copy: bool = True) -> DataToExport:
+    """ Rebuild a DataToExport from its header and the arrays of a ring slot"""
+    arrays = header['arrays'] if slot is None else ring.read(slot, header['layouts'], copy=copy)
+    data = []
+    index = 0
+    for description in header['data']:
+        length = description['length']
+        dwa = DataWithAxes(description['name'], source=description['source'],
+                           dim=description['dim'], distribution=description['distribution'],
+                           data=arrays[index:index + length], labels=description['labels'],
+                           origin=description['origin'], units=description['units'],
+                           nav_indexes=description['nav_indexes'], axes=description['axes'])
+        dwa.timestamp = description['timestamp']
+        data.append(dwa)
+        index += length
+    return DataToExport(header['name'], data=data)
+
+
+def get_path(root, param) -> Tuple[str, ...]:
+    """ The names from root, excluded, to param, of a Parameter or SettingsNode tree"""
+    path = []
+    while param is not None and param is not root:
+        path.insert(0, param.name())
+        param = param.parent()
+    return tuple(path)
+
+
+def get_values(node) -> Dict[Tuple[str, ...], Any]:
+    """ The values of the descendants of a Parameter or SettingsNode indexed by their path"""
+    return {get_path(node, param): param.value() for param in iter_params(node)
+            if param.type() not in ('group', 'action')}
+
+
+def run_model_process(model: Type[DataMixerModel], settings: Mapping, data: DataToExport,
+                      input_name: str, output_name: str, n_slots: int, slot_bytes: int,
+                      connection: 'Connection'):
+    """ Main function of the model process: process the frames received until asked to stop
+
+    The settings after the initialization of the model are sent with the ready message. The model
+    settings it changes itself are sent back with each result and in reply to each settings or
+    activate message, except the changes applied from the message itself. The timings recorded
+    while processing a frame, if asked for, are sent back with its result
+    """
+    try:
+        input_ring = SharedRing(n_slots, slot_bytes, input_name)
+        output_ring = SharedRing(n_slots, slot_bytes, output_name)
+        runner = ModelRunner(model, settings, data=data)
+    except Exception:
+        connection.send(('error', traceback.format_exc()))
+        return
+
+    changes: Dict[Tuple[str, ...], Any] = {}
+    applied: Dict[Tuple[str, ...], Any] = {}
+
+    def record_change(param: SettingsNode):
+        path = get_path(runner.model_settings, param)
+        value = param.value()
+        if path in applied:
+            try:
+                if bool(applied[path] == value):
+                    return  # the change comes from the message being applied
+            except ValueError:
+                pass
+        changes[path] = value
+
+    runner.settings.sigTreeValueChanged.connect(record_change)
+    connection.send(('ready', get_values(runner.model_settings)))
+
+    while True:
+        message = connection.recv()
+        if message[0] == 'stop':
+            break
+        try:
+            if message[0] == 'settings':
+                applied.update({key if isinstance(key, tuple) else (key, ): value
+                                for key, value in message[1].items()})
+                try:
+                    runner.set_settings(message[1])
+                finally:
+                    applied.clear()
+            elif message[0] == 'activate':
+                runner.model_settings.child(*message[1]).activate()
+            elif message[0] == 'frame':
+                runner.diagnostics.enabled = message[3]
+                dte = decode_dte(message[1], message[2], input_ring, copy=False)
+                slot, header = encode_dte(runner.process(dte), output_ring)
+                connection.send(('result', slot, header, changes,
+                                 runner.diagnostics.take_records()))
+                changes.clear()
+                continue
+        except Exception:
+            if message[0] == 'frame':
+                connection.send(('error', traceback.format_exc()))
+                continue
+            logger.exception(f'Error in the model process handling {message[0]}')
+        connection.send(('changes', changes))
+        changes.clear()
+
+    input_ring.close()
+    output_ring.close()
+
+
+class ProcessModelRunner:
+    """ Host of a DataMixerModel running in a separate process
+
+    Same interface as ModelRunner: a ModelWorker calls process_dte, the host forwards the changes
+    of the model settings with update_settings. The settings the model changes itself are set in
+    the local tree through the parameter setter and the timings it records are added to the
+    local diagnostics.
+
+    Parameters
+    ----------
+    model: str or type
+        the model class or its name as listed by get_models
+    settings_tree: Parameter or SettingsNode, optional
+        an existing tree holding the model settings, a Qt-free one is created from the model
+        params if None
+    settings_path: tuple of str
+        the path of the group of the model settings within the settings tree
+    data: DataToExport, optional
+        the data the detectors would produce, as listed by the model
+    parameter_setter: callable, optional
+        called with a parameter and a value when the model sets one of its settings, by default
+        the value is set directly
+    diagnostics: Diagnostics, optional
+    name: str, optional
+        the name of the model among several ones, prefixing the names of the timings it records
+    n_slots: int
+        the number of ring slots in each direction. The model may keep a reference on the input
+        arrays until n_slots more frames are processed
+    slot_bytes: int
+        the size of a slot, frames that do not fit are pickled through the pipe
+    timeout: float
+        the maximum time in s to wait for the model process to be ready
+    """
+
+    def __init__(self, model: Union[str, Type[DataMixerModel]],
+                 settings_tree: Union['Parameter', SettingsNode] = None,
+                 settings_path: Tuple[str, ...] = MODEL_SETTINGS_PATH, data: DataToExport = None,
+                 parameter_setter: Callable[[Any, Any], None] = None,
+                 diagnostics: Diagnostics = None, name: str = '', n_slots: int = 2,
+                 slot_bytes: int = 64 * 2 ** 20, timeout: float = 30.):
+        self.model_class = get_model_class(model)
+        self.model: Optional[DataMixerModel] = None  # living in the model process
+        if settings_tree is None:
+            settings_tree = create_settings(self.model_class)
+            settings_tree.sigTreeValueChanged.connect(self.update_settings)
+            settings_path = MODEL_SETTINGS_PATH
+        self.settings = settings_tree
+        self.settings_path = settings_path
+        self._parameter_setter = parameter_setter
+        self.diagnostics = diagnostics if diagnostics is not None else Diagnostics()
+        self.name = name
+        self._received: Dict[Tuple[str, ...], Any] = {}
+        self._actions: List[Any] = []
+        self._lock = threading.Lock()
+
+        self.input_ring = SharedRing(n_slots, slot_bytes)
+        self.output_ring = SharedRing(n_slots, slot_bytes)
+        context = multiprocessing.get_context('spawn')  # no fork of the Qt application
+        self._connection, child_connection = context.Pipe()
+        self.model_process = context.Process(
+            target=run_model_process, daemon=True,
+            args=(self.model_class, settings_to_dict(self.model_settings), data,
+                  self.input_ring.name, self.output_ring.name, n_slots, slot_bytes,
+                  child_connection))
+        self.model_process.start()
+        child_connection.close()
+
+        try:
+            message = self._connection.recv() if self._connection.poll(timeout) else ('error',
+                                                                                       'timeout')
+        except (EOFError, OSError) as e:  # the model process ended
+            message = ('error', repr(e))
+        if message[0] != 'ready':
+            self.stop()
+            raise RuntimeError(f'The model process could not start: {message[1]}')
+        self.apply_changes({path: value for path, value in message[1].items()
+                            if not self._is_value(path, value)})
+
+        self._actions = [param for param in iter_params(self.model_settings)
+                         if param.type() == 'action']
+        for param in self._actions:
+            param.sigActivated.connect(self.activate)
+
+    @property
+    def model_settings(self) -> Union['Parameter', SettingsNode]:
+        return self.settings.child(*self.settings_path)
+
+    def _send(self, message: tuple):
+        with self._lock:
+            self._connection.send(message)
+
+    def _request(self, message: tuple) -> tuple:
+        """ Send a message to the model process and wait for its reply"""
+        with self._lock:
+            self._connection.send(message)
+            while not self._connection.poll(0.5):
+                if not self.model_process.is_alive():
+                    raise RuntimeError('The model process has ended')
+            return self._connection.recv()
+
+    def _is_value(self, path: Tuple[str, ...], value) -> bool:
+        try:
+            return bool(self.model_settings.child(*path).value() == value)
+        except ValueError:
+            return False
+
+    def apply_changes(self, changes: Mapping[Tuple[str, ...], Any]):
+        """ Set in the local tree the settings the model changed itself"""
+        for path, value in changes.items():
+            self._received[path] = value
+            self.set_parameter_value(self.model_settings.child(*path), value)
+
+    def set_parameter_value(self, param, value):
+        if self._parameter_setter is not None:
+            self._parameter_setter(param, value)
+        else:
+            param.setValue(value)
+
+    def update_settings(self, param):
+        """ Forward the change of one of the model settings to the model process"""
+        path = get_path(self.model_settings, param)
+        value = param.value()
+        if path in self._received:
+            try:
+                if bool(self._received.pop(path) == value):
+                    return  # the change comes from the model itself
+            except ValueError:
+                pass
+        self.apply_changes(self._request(('settings', {path: value}))[1])
+
+    def set_settings(self, settings: Mapping):
+        self.apply_changes(self._request(('settings', dict(settings)))[1])
+
+    def get_settings(self) -> dict:
+        return settings_to_dict(self.model_settings)
+
+    def required_data(self) -> Optional[List[str]]:
+        return self.model_class.required_data(self.model_settings)
+
+    def activate(self, param):
+        """ Forward the activation of an action of the model settings"""
+        self.apply_changes(self._request(('activate', get_path(self.model_settings, param)))[1])
+
+    def process(self, dte: DataToExport) -> DataToExport:
+        """ Process a DataToExport in the model process, waiting for the result"""
+        slot, header = encode_dte(dte, self.input_ring)
+        message = self._request(('frame', slot, header, self.diagnostics.enabled))
+        if message[0] == 'error':
+            raise RuntimeError(f'Error in the model process:\n{message[1]}')
+        _, slot, header, changes, records = message
+        self.apply_changes(changes)
+        self.diagnostics.add_records(records, self.name)
+        return decode_dte(slot, header, self.output_ring, copy=True)
+
+    process_dte = process
+
+    def stop(self, timeout: float = 5.):
+        """ End the model process and release the shared memory"""
+        for param in self._actions:
+            try:
+                param.sigActivated.disconnect(self.activate)
+            except (TypeError, RuntimeError):  # already disconnected
+                pass
+        self._actions = []
+        if self.model_process.is_alive():
+            try:
+                self._send(('stop', ))
+            except (OSError, ValueError):  # pragma: no cover
+                pass
+            self.model_process.join(timeout)
+            if self.model_process.is_alive():  # pragma: no cover
+                logger.warning('The DataMixer model process did not stop in time')
+                self.model_process.terminate()
+        self._connection.close()
+        self.input_ring.close()
+        self.output_ring.close()
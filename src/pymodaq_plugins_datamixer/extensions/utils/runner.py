@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Qt-free processing core of the DataMixer: a ModelRunner hosts a DataMixerModel and feeds it with
+DataToExport, either headless, from a plain settings mapping, or within the DataMixer extension
+on top of its Parameter tree
+"""
+from typing import Any, Callable, List, Mapping, Optional, Tuple, Type, Union, TYPE_CHECKING
+
+from pymodaq_data.data import DataToExport
+
+from pymodaq_plugins_datamixer.extensions.utils.diagnostics import Diagnostics, DiagnosticsScope
+from pymodaq_plugins_datamixer.extensions.utils.model import (DataMixerModel, get_models,
+                                                              load_model_class)
+from pymodaq_plugins_datamixer.extensions.utils.settings import (SettingsNode, apply_settings,
+                                                                 iter_params, settings_to_dict)
+
+if TYPE_CHECKING:
+    from pymodaq_gui.parameter import Parameter
+
+MODEL_SETTINGS_PATH = ('models', 'model_params')  # where the model settings are in the tree
+
+
+class HeadlessModulesManager:
+    """ Stand-in of the dashboard ModulesManager giving the models the detectors data
+
+    Parameters
+    ----------
+    data: DataToExport
+        the data the detectors would produce, used by the models to list the available data
+    """
+
+    def __init__(self, data: DataToExport = None):
+        self.data = data if data is not None else DataToExport('Headless')
+
+    def get_det_data_list(self) -> DataToExport:
+        return self.data
+
+
+def get_model_class(model: Union[str, Type[DataMixerModel]]) -> Type[DataMixerModel]:
+    """ Get a model class from itself or from its name as listed by get_models"""
+    if isinstance(model, str):
+        model_info = get_models(model)
+        model_class = load_model_class(model_info) if model_info is not None else None
+        if model_class is None:
+            raise ValueError(f'Unknown DataMixer model: {model}')
+        return model_class
+    return model
+
+
+def create_settings(model_class: Type[DataMixerModel]) -> SettingsNode:
+    """ The Qt-free settings tree of a model, within the models/model_params group"""
+    return SettingsNode.from_params([
+        {'name': 'models', 'type': 'group', 'children': [
+            {'name': 'model_params', 'type': 'group', 'children': model_class.params}]}])
+
+
+class ModelRunner:
+    """ Host of a DataMixerModel processing DataToExport without GUI
+
+    Parameters
+    ----------
+    model: str or type
+        the model class or its name as listed by get_models
+    settings: dict, optional
+        plain values of the model settings, see apply_settings, set before initializing the model
+    data: DataToExport, optional
+        the data the detectors would produce, as listed by the models
+    settings_tree: Parameter or SettingsNode, optional
+        an existing tree holding the model settings, a Qt-free one is created from the model
+        params if None
+    settings_path: tuple of str
+        the path of the group of the model settings within the settings tree
+    modules_manager: optional
+        the provider of the detectors data, a HeadlessModulesManager if None
+    diagnostics: Diagnostics, optional
+    parameter_setter: callable, optional
+        called with a parameter and a value when the model sets one of its settings, by default
+        the value is set directly
+    name: str, optional
+        the name of the model among several ones, prefixing the names of the timings it records
+
+    Examples
+    --------
+    >>> runner = ModelRunner('equation_model', {'edit_formula': '{Det/ch} * 2'})
+    >>> dte_computed = runner.process(dte)
+    """
+
+    def __init__(self, model: Union[str, Type[DataMixerModel]], settings: Mapping = None,
+                 data: DataToExport = None, settings_tree: Union['Parameter', SettingsNode] = None,
+                 settings_path: Tuple[str, ...] = MODEL_SETTINGS_PATH, modules_manager=None,
+                 diagnostics: Diagnostics = None,
+                 parameter_setter: Callable[[Any, Any], None] = None, name: str = ''):
+        self.model_class = get_model_class(model)
+        self.headless = settings_tree is None
+        if self.headless:
+            settings_tree = create_settings(self.model_class)
+            settings_tree.sigTreeValueChanged.connect(self.update_settings)
+            settings_path = MODEL_SETTINGS_PATH
+        self.settings = settings_tree
+        self.settings_path = settings_path
+        self.modules_manager = (modules_manager if modules_manager is not None else
+                                HeadlessModulesManager(data))
+        if diagnostics is None:
+            diagnostics = Diagnostics()
+        self.diagnostics = DiagnosticsScope(diagnostics, name) if name else diagnostics
+        self._parameter_setter = parameter_setter
+        self.model: Optional[DataMixerModel] = None
+
+        if settings is not None:
+            apply_settings(self.model_settings, settings)
+        self.model = self.model_class(self)
+        self.model.ini_model_base()
+
+        self._actions = [param for param in iter_params(self.model_settings)
+                         if param.type() == 'action']
+        for param in self._actions:
+            param.sigActivated.connect(self.update_settings)
+
+    @property
+    def model_settings(self) -> Union['Parameter', SettingsNode]:
+        return self.settings.child(*self.settings_path)
+
+    def set_parameter_value(self, param, value):
+        """ Set the value of a parameter on behalf of the model"""
+        if self._parameter_setter is not None:
+            self._parameter_setter(param, value)
+        else:
+            param.setValue(value)
+
+    def update_settings(self, param):
+        """ Let the model apply the change of one of its settings or the activation of one of
+        its actions"""
+        if self.model is not None:
+            self.model.update_settings(param)
+
+    def set_settings(self, settings: Mapping):
+        """ Set model settings from a plain mapping, the model being notified of the changes when
+        the tree is a headless one"""
+        apply_settings(self.model_settings, settings)
+
+    def get_settings(self) -> dict:
+        """ The model settings as a plain mapping"""
+        return settings_to_dict(self.model_settings)
+
+    def required_data(self) -> Optional[List[str]]:
+        """ The full names of the data the model reads, None if it may read any"""
+        return self.model_class.required_data(self.model_settings)
+
+    def process(self, dte: DataToExport) -> DataToExport:
+        """ Process a DataToExport with the model
+
+        Without dashboard modules manager, the processed data become the data the model can list
+        """
+        if isinstance(self.modules_manager, HeadlessModulesManager):
+            self.modules_manager.data = dte
+        return self.model.process_dte(dte)
+
+    process_dte = process  # so that a runner can be fed to a ModelWorker as a model
+
+    def stop(self):
+        """ Stop forwarding the activation of the model actions, the settings tree outliving the
+        runner"""
+        for param in self._actions:
+            try:
+                param.sigActivated.disconnect(self.update_settings)
+            except (TypeError, RuntimeError):  # already disconnected
+                pass
+        self._actions = []
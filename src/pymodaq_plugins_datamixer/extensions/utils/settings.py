@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Qt-free settings tree for running the DataMixer models outside of the dashboard
+
+SettingsNode mimics the subset of the pyqtgraph Parameter API the models use, so that the same
+params declarations and the same model code run headless.
+"""
+import inspect
+from typing import Any, Callable, Dict, Iterator, List, Mapping, Optional, Tuple, Union
+
+
+def _count_arguments(slot: Callable) -> Optional[int]:
+    """ The number of positional arguments a slot accepts, None if any number"""
+    try:
+        parameters = inspect.signature(slot).parameters.values()
+    except (TypeError, ValueError):
+        return None
+    if any(parameter.kind == parameter.VAR_POSITIONAL for parameter in parameters):
+        return None
+    return len([parameter for parameter in parameters
+                if parameter.kind in (parameter.POSITIONAL_ONLY, parameter.POSITIONAL_OR_KEYWORD)])
+
+
+class _Signal:
+    """ Minimal stand-in of a Qt signal, calling the connected slots synchronously
+
+    Like with Qt, slots may accept less arguments than emitted, the last ones being dropped
+    """
+
+    def __init__(self):
+        self._slots: List[Tuple[Callable, Optional[int]]] = []
+
+    def connect(self, slot: Callable):
+        self._slots.append((slot, _count_arguments(slot)))
+
+    def disconnect(self, slot: Callable = None):
+        if slot is None:
+            self._slots = []
+        else:
+            self._slots = [(connected, n_args) for connected, n_args in self._slots
+                           if connected != slot]
+
+    def emit(self, *args):
+        for slot, n_args in list(self._slots):
+            slot(*args[:n_args])
+
+
+class SettingsNode:
+    """ A node of a Qt-free settings tree, with the Parameter methods used by the models
+
+    Parameters
+    ----------
+    name: str
+    value: object
+    opts: dict
+        the other options of the param declaration (type, limits, title...)
+    children: list of SettingsNode
+
+    Attributes
+    ----------
+    sigActivated: emitted with the node when an action node is activated
+    sigValueChanged: emitted with the node and its new value when the value is changed
+    sigTreeValueChanged: emitted by the root of the tree with any node whose value changed
+    """
+
+    def __init__(self, name: str, value: Any = None, opts: Dict[str, Any] = None,
+                 children: List['SettingsNode'] = ()):
+        self._name = name
+        self._value = value
+        self.opts = dict(opts) if opts is not None else {}
+        self._parent: Optional['SettingsNode'] = None
+        self._children: List['SettingsNode'] = []
+        self.sigActivated = _Signal()
+        self.sigValueChanged = _Signal()
+        self.sigTreeValueChanged = _Signal()
+        for child in children:
+            self.addChild(child)
+
+    @classmethod
+    def from_params(cls, params: List[dict], name: str = 'settings') -> 'SettingsNode':
+        """ Create a tree from a list of param declarations, as given to Parameter.create"""
+        return cls(name, opts={'type': 'group'},
+                   children=[cls.from_param(param) for param in params])
+
+    @classmethod
+    def from_param(cls, param: dict) -> 'SettingsNode':
+        opts = {key: value for key, value in param.items()
+                if key not in ('name', 'value', 'children')}
+        return cls(param['name'], param.get('value'), opts,
+                   [cls.from_param(child) for child in param.get('children', [])])
+
+    def name(self) -> str:
+        return self._name
+
+    def type(self) -> str:
+        return self.opts.get('type', '')
+
+    def value(self) -> Any:
+        return self._value
+
+    def setValue(self, value: Any):
+        try:
+            changed = bool(value != self._value)
+        except ValueError:  # arrays
+            changed = True
+        self._value = value
+        if changed:
+            self.sigValueChanged.emit(self, value)
+            root = self
+            while root.parent() is not None:
+                root = root.parent()
+            root.sigTreeValueChanged.emit(self)
+
+    def setLimits(self, limits):
+        self.opts['limits'] = limits
+
+    def setOpts(self, **opts):
+        self.opts.update(opts)
+
+    def activate(self):
+        self.sigActivated.emit(self)
+
+    def parent(self) -> Optional['SettingsNode']:
+        return self._parent
+
+    def children(self) -> List['SettingsNode']:
+        return list(self._children)
+
+    def addChild(self, child: Union['SettingsNode', dict]) -> 'SettingsNode':
+        if isinstance(child, dict):
+            child = self.from_param(child)
+        child._parent = self
+        self._children.append(child)
+        return child
+
+    def addChildren(self, children: List[Union['SettingsNode', dict]]):
+        for child in children:
+            self.addChild(child)
+
+    def clearChildren(self):
+        for child in self._children:
+            child._parent = None
+        self._children = []
+
+    def child(self, *names: str) -> 'SettingsNode':
+        node = self
+        for name in names:
+            for child in node._children:
+                if child.name() == name:
+                    node = child
+                    break
+            else:
+                raise KeyError(f'{name} is not a child of {node.name()}')
+        return node
+
+    def __iter__(self) -> Iterator['SettingsNode']:
+        return iter(self.children())
+
+    def __getitem__(self, names: Union[str, Tuple[str, ...]]) -> Any:
+        if isinstance(names, str):
+            names = (names, )
+        return self.child(*names).value()
+
+    def __setitem__(self, names: Union[str, Tuple[str, ...]], value: Any):
+        if isinstance(names, str):
+            names = (names, )
+        self.child(*names).setValue(value)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self._name}: {self._value!r})'
+
+
+def iter_params(node) -> List:
+    """ All the descendants of a Parameter or SettingsNode"""
+    params = []
+    for child in node.children():
+        params.append(child)
+        params.extend(iter_params(child))
+    return params
+
+
+def apply_settings(node, values: Mapping):
+    """ Set the values of a settings tree, a Parameter or a SettingsNode, from a plain mapping
+
+    Keys are either the name of a child, whose value is set or, if given a mapping, applied
+    recursively, or a tuple of names giving the path of a child, for instance to set the value of
+    a node having children.
+    """
+    for key, value in values.items():
+        path = key if isinstance(key, tuple) else (key, )
+        child = node.child(*path)
+        if isinstance(value, Mapping) and len(child.children()) > 0:
+            apply_settings(child, value)
+        else:
+            child.setValue(value)
+
+
+def settings_to_dict(node) -> Dict[str, Any]:
+    """ Get the values of a settings tree, a Parameter or a SettingsNode, as a plain mapping
+
+    Groups are nested mappings, nodes with both a value and children are stored as a tuple key
+    for their value next to the mapping of their children, as accepted by apply_settings.
+    Actions are skipped.
+    """
+    values = {}
+    for child in node.children():
+        child_type = child.opts.get('type', '')
+        if child_type == 'action':
+            continue
+        if len(child.children()) > 0:
+            values[child.name()] = settings_to_dict(child)
+            if child_type != 'group':
+                values[(child.name(), )] = child.value()
+        elif child_type != 'group':
+            values[child.name()] = child.value()
+    return values
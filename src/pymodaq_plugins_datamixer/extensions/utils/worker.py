@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Thread processing the data with the active DataMixerModel, outside the Qt GUI thread
+"""
+from dataclasses import dataclass
+import queue
+from time import time
+from typing import List, Optional, TYPE_CHECKING
+
+from qtpy import QtCore
+
+from pymodaq_utils.logger import set_logger, get_module_name
+from pymodaq_data.data import DataToExport
+
+from pymodaq_plugins_datamixer.extensions.utils.diagnostics import (Diagnostics, MODEL_TIMING,
+                                                                     LATENCY_TIMING)
+
+if TYPE_CHECKING:
+    from pymodaq_plugins_datamixer.extensions.utils.model import DataMixerModel
+
+logger = set_logger(get_module_name(__file__))
+
+OVERLOAD_POLICIES = ['Latest only', 'Every Nth', 'Process all']
+
+
+@dataclass
+class FrameCounters:
+    """ Number of frames received, processed by the model and dropped because of overload"""
+    received: int = 0
+    processed: int = 0
+    dropped: int = 0
+
+    def reset(self):
+        self.received = 0
+        self.processed = 0
+        self.dropped = 0
+
+    def __str__(self):
+        return f'Received: {self.received} Processed: {self.processed} Dropped: {self.dropped}'
+
+
+class ModelWorker(QtCore.QThread):
+    """ Thread feeding the DataToExport submitted to a queue into a model
+
+    The overload policy defines what happens when frames arrive faster than the model processes
+    them:
+
+    * Latest only: the queue is bounded and the oldest pending frame is dropped when it is full,
+      so that the latency stays bounded
+    * Every Nth: only one received frame out of N is queued, in the bounded queue
+    * Process all: the queue is unbounded and all frames are processed
+
+    Parameters
+    ----------
+    model: DataMixerModel
+        The model whose process_dte method is called on each frame
+    maxsize: int
+        The maximum number of frames waiting to be processed
+    policy: str
+        One of OVERLOAD_POLICIES
+    every_n: int
+        The decimation used with the Every Nth policy
+    counters: FrameCounters
+        Counters to be updated, new ones if None
+    diagnostics: Diagnostics
+        Where to record the processing time, the acquisition to emission latency and the
+        exceptions of the model, new disabled ones if None
+
+    Signals
+    -------
+    dte_computed: emitted from the worker thread with the DataToExport computed by the model
+    """
+    dte_computed = QtCore.Signal(DataToExport)
+
+    def __init__(self, model: 'DataMixerModel', maxsize: int = 1,
+                 policy: str = OVERLOAD_POLICIES[0], every_n: int = 1,
+                 counters: FrameCounters = None, diagnostics: Diagnostics = None):
+        super().__init__()
+        self.model = model
+        self.policy = policy
+        self.every_n = max(1, every_n)
+        self.counters = counters if counters is not None else FrameCounters()
+        self.diagnostics = diagnostics if diagnostics is not None else Diagnostics()
+        self._queue: queue.Queue = queue.Queue(
+            maxsize=0 if policy == 'Process all' else max(1, maxsize))
+        self._phase = 0  # of the Every Nth decimation, independent of the counters reset
+
+    def submit(self, dte: DataToExport) -> bool:
+        """ Queue a frame for processing according to the overload policy
+
+        Returns
+        -------
+        bool: False if a frame, this one or an older pending one, has been dropped
+        """
+        self.counters.received += 1
+        if self.policy == 'Every Nth':
+            phase, self._phase = self._phase, (self._phase + 1) % self.every_n
+            if phase != 0:
+                self.counters.dropped += 1
+                return False
+        return self._put(dte)
+
+    def requeue(self, frames: List[DataToExport]):
+        """ Queue frames already received, for instance the pending frames of another worker,
+        the oldest ones being dropped if they do not fit"""
+        for dte in frames:
+            self._put(dte)
+
+    def _put(self, dte: Optional[DataToExport]) -> bool:
+        dropped = False
+        while True:
+            try:
+                self._queue.put_nowait(dte)
+                return not dropped
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                    self.counters.dropped += 1
+                    dropped = True
+                except queue.Empty:
+                    pass
+
+    def take_pending(self) -> List[DataToExport]:
+        """ Remove the pending frames from the queue and return them"""
+        frames = []
+        while True:
+            try:
+                dte = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if dte is not None:
+                frames.append(dte)
+        return frames
+
+    def clear(self):
+        """ Forget all pending frames, counted as dropped"""
+        self.counters.dropped += len(self.take_pending())
+
+    def run(self):
+        diagnostics = self.diagnostics
+        while True:
+            dte: Optional[DataToExport] = self._queue.get()
+            if dte is None:
+                break
+            enabled = diagnostics.enabled
+            start = diagnostics.now() if enabled else 0.
+            try:
+                dte_computed = self.model.process_dte(dte)
+            except Exception as e:
+                diagnostics.record_error(MODEL_TIMING)
+                logger.exception(str(e))
+                continue
+            self.counters.processed += 1
+            if enabled:
+                diagnostics.record_since(MODEL_TIMING, start)
+                if len(dte) > 0:
+                    diagnostics.record(LATENCY_TIMING, time() - dte[0].timestamp)
+                if diagnostics.emit:
+                    dte_computed.append(diagnostics.to_dte())
+            self.dte_computed.emit(dte_computed)
+
+    def stop(self, timeout: int = 5000):
+        """ Drop the pending frames, if not taken before, let the current processing finish and
+        end the thread
+
+        Parameters
+        ----------
+        timeout: int
+            maximum time in ms to wait for the thread to finish
+        """
+        self.clear()
+        self._put(None)
+        if not self.wait(timeout):
+            logger.warning('The DataMixer processing thread did not stop in time')
@@ -1,10 +1,50 @@
+from dataclasses import dataclass, replace
+from typing import Dict, List, Union, TYPE_CHECKING
+
 from pymodaq_plugins_datamixer.extensions.utils.model import DataMixerModel, np  # np will be used in method eval of the formula
 
+from pymodaq_utils.logger import set_logger, get_module_name
 from pymodaq_data.data import DataToExport, DataWithAxes
-from pymodaq_gui.parameter import Parameter
 
 from pymodaq_plugins_datamixer.extensions.utils.parser import (
-    extract_data_names, split_formulae, replace_names_in_formula)
+    extract_data_names, split_formulae, replace_names_in_formula, Formula, FormulaGraph,
+    index_full_names, bind_variables)
+from pymodaq_plugins_datamixer.extensions.utils.engine import (ENGINES, get_engine,
+                                                              DataWithAxesEngine)
+from pymodaq_plugins_datamixer.extensions.utils.history import HistoryStore
+from pymodaq_plugins_datamixer.extensions.utils.diagnostics import CircuitBreaker
+
+if TYPE_CHECKING:
+    from pymodaq_gui.parameter import Parameter
+
+logger = set_logger(get_module_name(__file__))
+
+
+@dataclass
+class CompiledFormulae:
+    """ The compiled formulae and the state of their evaluation
+
+    Replaced as a whole from the GUI thread so that a frame processed meanwhile never mixes the
+    objects of two compilations
+
+    Attributes
+    ----------
+    graph: FormulaGraph
+    engine: DataWithAxesEngine
+        evaluating the graph steps
+    history: HistoryStore
+        the past frames referenced in the formulae
+    breaker: CircuitBreaker
+        disabling the lines failing too often
+    warmup_frames: int
+        frames needed to fill the histories, no line is disabled meanwhile as lines using past
+        frames through intermediates or shared sub-expressions fail too
+    """
+    graph: FormulaGraph
+    engine: DataWithAxesEngine
+    history: HistoryStore
+    breaker: CircuitBreaker
+    warmup_frames: int = 0
 
 
 class DataMixerModelEquation(DataMixerModel):
@@ -12,6 +52,18 @@ class DataMixerModelEquation(DataMixerModel):
         {'title': 'Get Data:', 'name': 'get_data', 'type': 'bool_push', 'value': False,
          'label': 'Get Data'},
         {'title': 'Edit Formula:', 'name': 'edit_formula', 'type': 'text', 'value': ''},
+        {'title': 'Engine:', 'name': 'engine', 'type': 'list', 'limits': ENGINES,
+         'value': ENGINES[0],
+         'tip': 'Evaluate the formulae on the DataWithAxes objects or directly on their numpy'
+                ' arrays'},
+        {'title': 'History memory (MB):', 'name': 'history_memory', 'type': 'float', 'value': 100.,
+         'min': 0., 'tip': 'Maximum memory of the past frames referenced in the formulae as'
+                           ' {Det/ch}[-k] or hist({Det/ch}, N)'},
+        {'title': 'Max failures:', 'name': 'max_failures', 'type': 'int', 'value': 10, 'min': 0,
+         'tip': 'Number of consecutive frames a line may fail before being disabled, until the'
+                ' formulae are edited again. 0 to never disable a line'},
+        {'title': 'Errors:', 'name': 'formula_errors', 'type': 'text', 'value': '',
+         'readonly': True},
         {'title': 'Data0D:', 'name': 'data0D', 'type': 'itemselect',
          'value': dict(all_items=[], selected=[])},
         {'title': 'Data1D:', 'name': 'data1D', 'type': 'itemselect',
@@ -22,17 +74,91 @@ class DataMixerModelEquation(DataMixerModel):
          'value': dict(all_items=[], selected=[])},
     ]
 
+    @classmethod
+    def required_data(cls, settings: 'Parameter') -> List[str]:
+        return list(dict.fromkeys(extract_data_names(settings['edit_formula'])))
+
     def ini_model(self):
+        self.data_list = DataToExport('DataList')
+        self.compile_formulae()
         self.show_data_list()
 
-    def update_settings(self, param: Parameter):
+    def update_settings(self, param: 'Parameter'):
         if param.name() == 'get_data':
             self.show_data_list()
+        elif param.name() == 'edit_formula':
+            self.compile_formulae()
+        elif param.name() == 'engine':
+            compiled = self.compiled
+            self.compiled = replace(compiled, engine=get_engine(param.value(), compiled.graph))
+        elif param.name() == 'history_memory':
+            self.compiled.history.max_bytes = param.value() * 1e6
+        elif param.name() == 'max_failures':
+            self.compiled.breaker.max_failures = param.value()
 
     def get_formulae(self) -> str:
         """ Read the content of the formula QTextEdit widget"""
         return self.settings['edit_formula']
 
+    def compile_formulae(self):
+        """ Compile the lines of the formula widget into cached CompiledFormulae
+
+        Lines can define intermediates (*name = expression*) used by other lines and reference
+        past frames as *{Det/ch}[-k]* or *hist({Det/ch}, N)*. Empty lines are skipped and lines
+        that cannot be compiled are logged and ignored. The produced data keep the index of their
+        line in their name. The lines disabled after too many failures are enabled again.
+        """
+        graph = FormulaGraph(self.get_formulae())
+        self.compiled = CompiledFormulae(
+            graph, get_engine(self.settings['engine'], graph),
+            HistoryStore(graph.history, self.settings['history_memory'] * 1e6),
+            CircuitBreaker(self.settings['max_failures']),
+            warmup_frames=max(graph.history.values(), default=0))
+        for ind, error in graph.errors.items():
+            logger.info(f'Invalid formula at line {ind}: {error}')
+        self.validation_errors = self.validate_formulae(self.data_list)
+        self.show_errors()
+
+    def validate_formulae(self, dte: DataToExport) -> Dict[str, str]:
+        """ Dry-run the compiled formulae on data as listed by show_data_list
+
+        Returns
+        -------
+        dict: the error messages of the lines that cannot be compiled or evaluated, indexed by
+        the name of their output. Without data, only the compilation errors are returned.
+        """
+        engine = self.compiled.engine
+        graph = engine.graph
+        errors = {graph.name_format.format(ind): error for ind, error in graph.errors.items()}
+        if len(dte) == 0:
+            return errors
+        index = index_full_names(dte)
+        history = HistoryStore(graph.history, self.settings['history_memory'] * 1e6)
+        for _ in range(max(graph.history.values(), default=0)):  # the past frames are the same
+            history.update(index)
+        namespace = engine.bind(index, history)
+        for formula in graph.steps:
+            try:
+                unknown = [name for name in formula.data_names if name not in index]
+                if len(unknown) > 0:
+                    raise ValueError(f'Unknown data: {", ".join(unknown)}')
+                value = engine.evaluate(formula, namespace)
+                if formula.target is None:
+                    engine.to_data(formula, value, index)
+                else:
+                    namespace[formula.target] = value
+            except Exception as e:
+                errors[formula.name] = str(e)
+        return errors
+
+    def show_errors(self):
+        """ Display the errors of the dry-run and the lines disabled while processing"""
+        breaker = self.compiled.breaker
+        lines = [f'{name}: {error}' for name, error in self.validation_errors.items()]
+        lines.extend([f'{name} disabled after {breaker.errors[name]} errors: {error}'
+                      for name, error in list(breaker.disabled.items())])
+        self.set_setting_value('\n'.join(lines), 'formula_errors')
+
     def show_data_list(self):
         dte = self.modules_manager.get_det_data_list()
 
@@ -46,27 +172,57 @@ class DataMixerModelEquation(DataMixerModel):
         self.settings.child('data2D').setValue(dict(all_items=data_list2D, selected=[]))
         self.settings.child('dataND').setValue(dict(all_items=data_listND, selected=[]))
 
+        self.data_list = dte
+        self.validation_errors = self.validate_formulae(dte)
+        self.show_errors()
+
     def process_dte(self, dte: DataToExport):
-        formulae = split_formulae(self.get_formulae())
         dte_processed = DataToExport('Computed')
-        for ind, formula in enumerate(formulae):
+        compiled = self.compiled  # may be replaced from the GUI thread while processing
+        engine = compiled.engine
+        index = index_full_names(dte)
+        compiled.history.update(index)
+        namespace = engine.bind(index, compiled.history)
+        diagnostics = self.diagnostics
+        enabled = diagnostics.enabled
+        breaker = compiled.breaker
+        disabled = breaker.disabled
+        warming_up = compiled.warmup_frames > 0
+        if warming_up:
+            compiled.warmup_frames -= 1
+        for formula in engine.graph.steps:
+            if formula.name in disabled:
+                continue
+            start = diagnostics.now() if enabled else 0.
             try:
-                dwa = self.compute_formula(formula, dte,
-                                           name=f'Formula_{ind:03.0f}')
-                dte_processed.append(dwa)
+                value = engine.evaluate(formula, namespace)
+                if formula.target is None:
+                    dte_processed.append(engine.to_data(formula, value, index))
+                else:
+                    namespace[formula.target] = value
+                breaker.success(formula.name)
             except Exception as e:
-                pass
+                diagnostics.record_error(formula.name)
+                if not warming_up and breaker.failure(formula.name, e):
+                    logger.warning(f'{formula.name} disabled after {breaker.max_failures} failures'
+                                   f' in a row: {e}')
+                    self.show_errors()
+                continue
+            if enabled:
+                diagnostics.record_since(formula.name, start)
         return dte_processed
 
-    def compute_formula(self, formula: str, dte: DataToExport,
+    def compute_formula(self, formula: Union[str, Formula], dte: Union[DataToExport, dict],
                         name: str) -> DataWithAxes:
         """ Compute the operations in formula using data stored in dte
 
         Parameters
         ----------
-        formula: str
-            The mathematical formula using numpy and data fullnames within curly brackets
-        dte: DataToExport
+        formula: str or Formula
+            The mathematical formula using numpy and data fullnames within curly brackets or its
+            already compiled version
+        dte: DataToExport or dict
+            The data or the namespace already bound to the formula variables
         name: str
             The name to give to the produced DataWithAxes
 
@@ -74,8 +230,9 @@ class DataMixerModelEquation(DataMixerModel):
         -------
         DataWithAxes: the results of the formula computation
         """
-        formula_to_eval, names = replace_names_in_formula(formula)
-        dwa = eval(formula_to_eval)
+        if not isinstance(formula, Formula):
+            formula = Formula(formula, name=name)
+        dwa = formula.evaluate(dte)
         dwa.name = name
         return dwa
 
@@ -1,53 +1,314 @@
+from typing import List, TYPE_CHECKING
 import numpy as np
+from scipy.optimize import curve_fit
 
 from pymodaq_plugins_datamixer.extensions.utils.model import DataMixerModel, np  # np will be used in method eval of the formula
 
 from pymodaq_utils.math_utils import gauss1D, my_moment
 
 from pymodaq_data.data import DataToExport, DataWithAxes, DataCalculated
-from pymodaq_gui.parameter import Parameter
 
 from pymodaq_plugins_datamixer.extensions.utils.parser import (
     extract_data_names, split_formulae, replace_names_in_formula)
 
+if TYPE_CHECKING:
+    from pymodaq_gui.parameter import Parameter
+
+
+GAUSS_FACTOR = 2 * np.log(2)  # exponent factor used in gauss1D
+STD_TO_DX = 2 * np.sqrt(np.log(2))  # dx of gauss1D from the standard deviation
+
 
 def gaussian_fit(x, amp, x0, dx, offset):
     dx = abs(dx)
     return amp * gauss1D(x, x0, dx) + offset
 
 
+def gaussian_jacobian(x, amp, x0, dx, offset):
+    """ Analytic jacobian of gaussian_fit with respect to (amp, x0, dx, offset)"""
+    sign = np.sign(dx) if dx != 0 else 1.
+    dx = abs(dx)
+    reduced = (x - x0) / dx
+    gauss = np.exp(-GAUSS_FACTOR * reduced ** 2)
+    jacobian = np.empty((np.size(x), 4))
+    jacobian[:, 0] = gauss
+    jacobian[:, 1] = amp * gauss * 2 * GAUSS_FACTOR * reduced / dx
+    jacobian[:, 2] = sign * amp * gauss * 2 * GAUSS_FACTOR * reduced ** 2 / dx
+    jacobian[:, 3] = 1.
+    return jacobian
+
+
+def batch_gaussian_guess(x: np.ndarray, data: np.ndarray) -> np.ndarray:
+    """ Moments guess of the gaussian coefficients of each row of data
+
+    Parameters
+    ----------
+    x: ndarray
+        the axis of shape (N,)
+    data: ndarray
+        the rows to fit, of shape (M, N)
+
+    Returns
+    -------
+    ndarray of shape (M, 4) containing the amp, x0, dx and offset guesses
+    """
+    offset = np.min(data, axis=1)
+    weights = data - offset[:, None]
+    norm = np.sum(weights, axis=1)
+    norm[norm == 0] = 1.
+    x0 = weights @ x / norm
+    dx = STD_TO_DX * np.sqrt(np.sum((x[None, :] - x0[:, None]) ** 2 * weights, axis=1) / norm)
+    dx[dx == 0] = abs(x[-1] - x[0]) / 4
+    return np.stack((np.max(data, axis=1) - offset, x0, dx, offset), axis=1)
+
+
+def batch_gaussian_fit(x: np.ndarray, data: np.ndarray, guess: np.ndarray,
+                       max_iter: int = 100, tol: float = 1e-8) -> np.ndarray:
+    """ Fit each row of data with gaussian_fit, all rows at once
+
+    A Levenberg-Marquardt iteration is vectorized over the rows using the analytic jacobian,
+    each row having its own damping. Rows stop being updated once converged.
+
+    Parameters
+    ----------
+    x: ndarray
+        the axis of shape (N,)
+    data: ndarray
+        the rows to fit, of shape (M, N)
+    guess: ndarray
+        the initial coefficients of shape (M, 4)
+    max_iter: int
+        maximum number of iterations
+    tol: float
+        relative change of the coefficients or of the squared residuals below which a row is
+        converged
+
+    Returns
+    -------
+    ndarray of shape (M, 4) containing the fitted amp, x0, dx and offset of each row
+    """
+    coeffs = np.array(guess, dtype=float)
+    data = np.asarray(data, dtype=float)
+    n_rows = data.shape[0]
+    damping = np.full((n_rows, ), 1e-3)
+    active = np.arange(n_rows)
+
+    def residuals_jacobian(rows: np.ndarray, params: np.ndarray, with_jacobian=True):
+        amp, x0, dx, offset = params.T
+        width = np.abs(dx)[:, None]
+        width[width == 0] = np.finfo(float).eps
+        reduced = (x[None, :] - x0[:, None]) / width
+        gauss = np.exp(-GAUSS_FACTOR * reduced ** 2)
+        residuals = data[rows] - (amp[:, None] * gauss + offset[:, None])
+        if not with_jacobian:
+            return residuals, None
+        common = amp[:, None] * gauss * 2 * GAUSS_FACTOR * reduced / width
+        sign = np.where(dx < 0, -1., 1.)[:, None]
+        # the derivative with respect to the offset is 1 and is handled separately
+        return residuals, (gauss, common, sign * common * reduced)
+
+    residuals, _ = residuals_jacobian(active, coeffs, with_jacobian=False)
+    cost = np.sum(residuals ** 2, axis=1)
+
+    for _ in range(max_iter):
+        if active.size == 0:
+            break
+        residuals, jacobian = residuals_jacobian(active, coeffs[active])
+        jtj = np.empty((active.size, 4, 4))
+        jtr = np.empty((active.size, 4))
+        for ind in range(3):
+            jtr[:, ind] = np.sum(jacobian[ind] * residuals, axis=1)
+            jtj[:, ind, 3] = jtj[:, 3, ind] = np.sum(jacobian[ind], axis=1)
+            for jnd in range(ind, 3):
+                jtj[:, ind, jnd] = jtj[:, jnd, ind] = np.sum(jacobian[ind] * jacobian[jnd], axis=1)
+        jtr[:, 3] = np.sum(residuals, axis=1)
+        jtj[:, 3, 3] = x.size
+
+        diagonal = np.diagonal(jtj, axis1=1, axis2=2)
+        damped = jtj + (damping[active, None] * (diagonal + 1e-12 * np.max(diagonal, axis=1,
+                                                                              keepdims=True) +
+                                                 np.finfo(float).tiny))[:, :, None] * np.eye(4)
+        try:
+            step = np.linalg.solve(damped, jtr[:, :, None])[:, :, 0]
+        except np.linalg.LinAlgError:
+            step = (np.linalg.pinv(damped) @ jtr[:, :, None])[:, :, 0]
+
+        new_coeffs = coeffs[active] + step
+        new_residuals, _ = residuals_jacobian(active, new_coeffs, with_jacobian=False)
+        new_cost = np.sum(new_residuals ** 2, axis=1)
+        improved = np.isfinite(new_cost) & (new_cost <= cost[active])
+
+        converged = improved & (
+            np.all(np.abs(step) <= tol * (np.abs(new_coeffs) + tol), axis=1) |
+            (cost[active] - new_cost <= tol * cost[active]))
+
+        rows = active[improved]
+        coeffs[rows] = new_coeffs[improved]
+        cost[rows] = new_cost[improved]
+        damping[rows] /= 10
+        damping[active[~improved]] *= 10
+
+        stuck = damping[active] > 1e10
+        active = active[~(converged | stuck)]
+
+    coeffs[:, 2] = np.abs(coeffs[:, 2])
+    return coeffs
+
+
 class DataMixerModelFit(DataMixerModel):
     params = [
-
+        {'title': 'Track fit:', 'name': 'tracking', 'type': 'bool', 'value': False,
+         'tip': 'Start each fit from the coefficients of the previous frame, falling back to a'
+                ' guess from the moments of the data if the fit diverges'},
+        {'title': 'Coefficients only:', 'name': 'coeffs_only', 'type': 'bool', 'value': False,
+         'tip': 'Only output the fitted coefficients, neither the data nor the fitted curve'},
+        {'title': 'Get Data:', 'name': 'get_data', 'type': 'bool_push', 'value': False,
+         'label': 'Get Data'},
+        {'title': 'Source:', 'name': 'source', 'type': 'list', 'limits': ['Spectro/Spectro'],
+         'value': 'Spectro/Spectro', 'tip': 'Full name of the data to fit'},
+        {'title': 'Batch fit:', 'name': 'batch', 'type': 'bool', 'value': False,
+         'tip': 'Fit each row of 2D or ND data along its last axis, all rows at once, and output'
+                ' maps of the coefficients'},
     ]
 
+    @classmethod
+    def required_data(cls, settings: 'Parameter') -> List[str]:
+        return [settings['source']]
+
     def ini_model(self):
-        pass
+        self.previous_coeffs = None
+        self.show_data_list()
 
-    def update_settings(self, param: Parameter):
-        pass
+    def update_settings(self, param: 'Parameter'):
+        if param.name() in ('tracking', 'source', 'batch'):
+            self.previous_coeffs = None
+        elif param.name() == 'get_data':
+            self.show_data_list()
+
+    def show_data_list(self):
+        dte = self.modules_manager.get_det_data_list()
+        data_list = (dte.get_full_names('data1D') + dte.get_full_names('data2D') +
+                     dte.get_full_names('dataND'))
+        source = self.settings['source']
+        if source not in data_list:
+            data_list.insert(0, source)
+        self.settings.child('source').setLimits(data_list)
+        self.settings.child('source').setValue(source)
 
     def process_dte(self, dte: DataToExport):
-        dte_processed = DataToExport('computed')
-        dwa = dte.get_data_from_full_name('Spectro/Spectro').deepcopy()
-        dwa_fit = dwa.fit(gaussian_fit, self.get_guess(dwa))
-        dwa.append(dwa_fit)
+        dwa = dte.get_data_from_full_name(self.settings['source'])
+        if self.settings['batch']:
+            return self.process_batch(dwa)
 
+        dte_processed = DataToExport('computed')
+        axis = dwa.axes[0].get_data()
+        coeffs = self.fit(axis, dwa.data[0])
 
-        dte_processed.append(dwa)
-        dte_processed.append(DataCalculated('Coeffs', data=[np.atleast_1d(coeff) for coeff in dwa_fit.fit_coeffs[0]],
+        if not self.settings['coeffs_only']:
+            dwa = dwa.deepcopy()
+            dwa.append(DataCalculated(f'{dwa.name}_fit', data=[gaussian_fit(axis, *coeffs)],
+                                      labels=[f'{dwa.labels[0]}_fit'], axes=[dwa.axes[0].copy()]))
+            dte_processed.append(dwa)
+        dte_processed.append(DataCalculated('Coeffs', data=[np.atleast_1d(coeff) for coeff in coeffs],
                                                       labels=['amp', 'x0', 'dx', 'offset']))
 
         return dte_processed
 
+    def process_batch(self, dwa: DataWithAxes) -> DataToExport:
+        """ Fit all the rows of the first channel of dwa along its last axis
+
+        Returns
+        -------
+        DataToExport: containing the Coeffs maps, whose axes are the other axes of dwa
+        """
+        data = dwa.data[0]
+        last_index = data.ndim - 1
+        axes = dwa.get_axis_from_index(last_index)
+        axis = axes[0].get_data() if len(axes) > 0 and axes[0] is not None else None
+        if axis is None:
+            axis = np.arange(data.shape[-1], dtype=float)
+        rows = data.reshape((-1, data.shape[-1]))
+
+        guess = batch_gaussian_guess(axis, rows)
+        tracking = (self.settings['tracking'] and self.previous_coeffs is not None and
+                    self.previous_coeffs.shape == guess.shape)
+        coeffs = batch_gaussian_fit(axis, rows, self.previous_coeffs if tracking else guess)
+        if tracking:
+            diverged = ~self.batch_is_valid(axis, coeffs, rows)
+            if np.any(diverged):
+                coeffs[diverged] = batch_gaussian_fit(axis, rows[diverged], guess[diverged])
+        self.previous_coeffs = coeffs
+
+        maps_shape = data.shape[:-1] if data.ndim > 1 else (1, )
+        return DataToExport('computed', data=[
+            DataCalculated('Coeffs', data=[coeffs[:, ind].reshape(maps_shape) for ind in range(4)],
+                           labels=['amp', 'x0', 'dx', 'offset'],
+                           axes=[dwa_axis.copy() for dwa_axis in dwa.axes
+                                 if dwa_axis.index != last_index],
+                           nav_indexes=tuple([index for index in dwa.nav_indexes
+                                              if index != last_index]),
+                           distribution=dwa.distribution)])
+
+    @staticmethod
+    def batch_is_valid(axis: np.ndarray, coeffs: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        """ Vectorized version of is_valid over the rows"""
+        return (np.all(np.isfinite(coeffs), axis=1) & (coeffs[:, 2] != 0) &
+                (coeffs[:, 1] >= min(axis[0], axis[-1])) & (coeffs[:, 1] <= max(axis[0], axis[-1])) &
+                (np.abs(coeffs[:, 2]) <= abs(axis[-1] - axis[0])) &
+                (np.abs(coeffs[:, 0]) >= 0.5 * (np.max(rows, axis=1) - np.min(rows, axis=1))))
+
+    def fit(self, axis: np.ndarray, data: np.ndarray) -> np.ndarray:
+        """ Fit the data with a gaussian using the analytic jacobian
+
+        In tracking mode, the fit starts from the previous coefficients and falls back to the
+        moments guess if it fails or diverges.
+        """
+        tracking = self.settings['tracking'] and self.previous_coeffs is not None
+        guess = self.previous_coeffs if tracking else self.get_guess_from_arrays(axis, data)
+        try:
+            coeffs = self._fit(axis, data, guess)
+        except (RuntimeError, ValueError):
+            if not tracking:
+                raise
+            coeffs = None
+        if tracking and (coeffs is None or not self.is_valid(axis, coeffs, data)):
+            coeffs = self._fit(axis, data, self.get_guess_from_arrays(axis, data))
+        self.previous_coeffs = coeffs if self.is_valid(axis, coeffs) else None
+        return coeffs
+
+    @staticmethod
+    def _fit(axis: np.ndarray, data: np.ndarray, guess) -> np.ndarray:
+        coeffs, _ = curve_fit(gaussian_fit, axis, data, p0=guess, jac=gaussian_jacobian)
+        coeffs[2] = abs(coeffs[2])
+        return coeffs
+
+    @staticmethod
+    def is_valid(axis: np.ndarray, coeffs: np.ndarray, data: np.ndarray = None) -> bool:
+        """ Check the fitted gaussian is finite, centered within the axis and narrower than it
+
+        If data is given, also check that the absolute fitted amplitude, negative for a dip,
+        accounts for at least half the data range, as does the moments guess, which is not the case when a warm started fit
+        locked on a wrong feature
+        """
+        span = abs(axis[-1] - axis[0])
+        valid = (bool(np.all(np.isfinite(coeffs))) and coeffs[2] != 0 and
+                 min(axis[0], axis[-1]) <= coeffs[1] <= max(axis[0], axis[-1]) and
+                 abs(coeffs[2]) <= span)
+        if valid and data is not None:
+            valid = abs(coeffs[0]) >= 0.5 * (np.max(data) - np.min(data))
+        return valid
+
     @staticmethod
     def get_guess(dwa):
-        offset = np.min(dwa).value()
-        moments = my_moment(dwa.axes[0].get_data(), dwa.data[0])
-        amp = (np.max(dwa) - np.min(dwa)).value()
+        return DataMixerModelFit.get_guess_from_arrays(dwa.axes[0].get_data(), dwa.data[0])
+
+    @staticmethod
+    def get_guess_from_arrays(axis: np.ndarray, data: np.ndarray):
+        offset = float(np.min(data))
+        moments = my_moment(axis, data - offset)  # the offset would bias the moments
+        amp = float(np.max(data)) - offset
         x0 = float(moments[0])
-        dx = float(moments[1])
+        dx = STD_TO_DX * float(moments[1])
 
         return amp, x0, dx, offset
 
-
@@ -1,11 +1,12 @@
+from typing import List, Optional, TYPE_CHECKING
+
 import numpy as np
 
 from pymodaq_plugins_datamixer.extensions.utils.model import DataMixerModel, np  # np will be used in method eval of the formula
 
 from pymodaq_utils.math_utils import gauss1D, my_moment
 
-from pymodaq_data.data import DataToExport, DataWithAxes
-from pymodaq_gui.parameter import Parameter
+from pymodaq_data.data import DataToExport, DataWithAxes, DataCalculated
 
 from pymodaq_plugins_datamixer.extensions.utils.parser import (
     extract_data_names, split_formulae, replace_names_in_formula)
@@ -13,14 +14,61 @@ from pymodaq_plugins_datamixer.extensions.utils.parser import (
 
 from scipy.signal import find_peaks
 
+if TYPE_CHECKING:
+    from pymodaq_gui.parameter import Parameter
+
+FIRST_DATA = 'First data'  # source processing the first data it is given, whatever its name
+
+
+def track_peak(data: np.ndarray, index: int, half_window: int, **options) -> Optional[int]:
+    """ Get the index of the highest peak of data within half_window samples around index
+
+    The peaks are searched with find_peaks and the same options, such as height or prominence,
+    as the full search. Returns None if the peak is lost, that is if no peak meeting them lies
+    within the window, meaning the peak moved out of the window or vanished.
+    """
+    start = max(0, index - half_window)
+    stop = min(data.size, index + half_window + 1)
+    if stop - start < 3:
+        return None
+    window = data[start:stop]
+    peaks_indices, _ = find_peaks(window, **options)
+    if len(peaks_indices) == 0:
+        return None
+    return start + int(peaks_indices[np.argmax(window[peaks_indices])])
+
+
+def parabolic_refinement(data: np.ndarray, index: int) -> float:
+    """ Sub-pixel position of the maximum at index from the parabola through its neighbours"""
+    if index <= 0 or index >= data.size - 1:
+        return float(index)
+    left, center, right = data[index - 1: index + 2]
+    curvature = left - 2 * center + right
+    if curvature >= 0:
+        return float(index)
+    return index + 0.5 * (left - right) / curvature
+
 
 
 class DataMixerModelFit(DataMixerModel):
     params = [
+        {'title': 'Get Data:', 'name': 'get_data', 'type': 'bool_push', 'value': False,
+         'label': 'Get Data'},
+        {'title': 'Source:', 'name': 'source', 'type': 'list', 'limits': [FIRST_DATA],
+         'value': FIRST_DATA, 'tip': 'Full name of the 1D data to process'},
         {'title': 'Find Peaks', 'name': 'find_peaks', 'type': 'group', 'children': [
             {'title': 'Highest Peak', 'name': 'highest_peak', 'type': 'float', 'value': 0, 'readonly': True},
+            {'title': 'Sub-pixel', 'name': 'refine', 'type': 'bool', 'value': False,
+             'tip': 'Refine the peak position by parabolic interpolation'},
+            {'title': 'Tracking', 'name': 'tracking', 'type': 'bool', 'value': False,
+             'tip': 'Search only around the last peak, a full search is done when it is lost',
+             'children': [
+                {'title': 'Half window', 'name': 'half_window', 'type': 'int', 'value': 20, 'min': 1},
+            ]},
             {'title': 'Options', 'name': 'options', 'type': 'bool', 'value': False, 'children': [
                 {'title': 'Height', 'name': 'height', 'type': 'float', 'value': 0},
+                {'title': 'Prominence', 'name': 'prominence', 'type': 'float', 'value': 0,
+                 'min': 0},
                 {'title': 'Distance', 'name': 'distance', 'type': 'int', 'value': 1, 'max': 1},
             ]},
             ]},
@@ -31,36 +79,75 @@ class DataMixerModelFit(DataMixerModel):
         ]},
     ]
 
-    def ini_model(self):
-        pass
-
-    def update_settings(self, param: Parameter):
-        pass
-
-    def process_dte(self, dte: DataToExport):
-        dte_processed = DataToExport('computed')
-        dwa = dte[0].deepcopy()
+    @classmethod
+    def required_data(cls, settings: 'Parameter') -> Optional[List[str]]:
+        return None if settings['source'] == FIRST_DATA else [settings['source']]
 
+    def ini_model(self):
+        self.peak_index: Optional[int] = None
+        self.show_data_list()
+
+    def update_settings(self, param: 'Parameter'):
+        if param.name() == 'get_data':
+            self.show_data_list()
+        elif (param.name() in ['tracking', 'options', 'source'] or
+              param.parent().name() == 'options'):
+            self.peak_index = None
+
+    def show_data_list(self):
+        data_list = [FIRST_DATA] + self.modules_manager.get_det_data_list().get_full_names('data1D')
+        source = self.settings['source']
+        if source not in data_list:
+            data_list.insert(1, source)
+        self.settings.child('source').setLimits(data_list)
+        self.settings.child('source').setValue(source)
+
+    def find_highest_peak(self, data: np.ndarray) -> int:
+        """ Index of the highest peak, tracked around the last one if asked for"""
         options = {}
         if self.settings['find_peaks', 'options']:
             for param in self.settings.child('find_peaks', 'options'):
                 options[param.name()] = param.value()
 
-        peaks_indices, _ = find_peaks(dwa[0], **options)
+        if self.settings['find_peaks', 'tracking'] and self.peak_index is not None:
+            ind = track_peak(data, self.peak_index,
+                             self.settings['find_peaks', 'tracking', 'half_window'], **options)
+            if ind is not None:
+                self.peak_index = ind
+                return ind
+
+        peaks_indices, _ = find_peaks(data, **options)
+        self.peak_index = int(peaks_indices[np.argmax(data[peaks_indices])])
+        return self.peak_index
 
-        heights = [float(dwa.isig[index][0][0]) for index in peaks_indices]
-        ind_max = peaks_indices[np.argmax(heights)]
-        self.settings.child('find_peaks', 'highest_peak').setValue(dwa.axes[0].get_data()[ind_max])
+    def process_dte(self, dte: DataToExport):
+        """ Crop the source data, by default the first one, around its highest peak
 
-        dwa_indexed = dwa.isig[ind_max + self.settings['cropping', 'ind_min']:
-                               ind_max + self.settings['cropping', 'ind_max']]
-        dwa_indexed.axes = []
-        dwa_indexed.create_missing_axes()
+        The input data is never copied: the peak heights and the cropped signal are views on the
+        input arrays, only the cropped output is copied when appended to the returned
+        DataToExport.
+        """
+        dte_processed = DataToExport('computed')
+        source = self.settings['source']
+        dwa = dte[0] if source == FIRST_DATA else dte.get_data_from_full_name(source)
 
-        dte_processed.append(dwa_indexed)
+        ind_max = self.find_highest_peak(dwa[0])
+        axis = dwa.axes[0].get_data()
+        if self.settings['find_peaks', 'refine']:
+            position = np.interp(parabolic_refinement(dwa[0], ind_max), np.arange(axis.size), axis)
+        else:
+            position = axis[ind_max]
+        self.set_setting_value(float(position), 'find_peaks', 'highest_peak')
 
-        return dte_processed
+        crop = slice(max(0, ind_max + self.settings['cropping', 'ind_min']),
+                     max(0, ind_max + self.settings['cropping', 'ind_max']))
+        dwa_cropped = DataCalculated(dwa.name, data=[array[crop] for array in dwa],
+                                     labels=dwa.labels, origin=dwa.origin, units=dwa.units)
+        dwa_cropped.create_missing_axes()
 
+        dte_processed.append(dwa_cropped)
+
+        return dte_processed
 
 def main():
     from pymodaq_gui.utils.utils import mkQApp
@@ -0,0 +1,178 @@
+from typing import Dict, List, Optional, TYPE_CHECKING
+
+import numpy as np
+
+from pymodaq_plugins_datamixer.extensions.utils.model import DataMixerModel
+
+from pymodaq_data.data import DataToExport, DataWithAxes, DataCalculated
+
+if TYPE_CHECKING:
+    from pymodaq_gui.parameter import Parameter
+
+
+STATISTICS = ['mean', 'std', 'variance', 'min', 'max', 'ema']
+
+
+class RunningStatistics:
+    """ Running statistics of a stream of arrays of the same shape
+
+    Mean and variance are accumulated with the Welford algorithm, min, max and the exponential
+    moving average in place: each update costs a few passes on arrays of the data shape allocated
+    with the first frame, whatever the number of frames
+
+    Parameters
+    ----------
+    alpha: float
+        the weight of the new data in the exponential moving average
+    """
+
+    def __init__(self, alpha: float = 0.1):
+        self.alpha = alpha
+        self.count = 0
+        self.mean: Optional[np.ndarray] = None
+        self.m2: Optional[np.ndarray] = None
+        self.min: Optional[np.ndarray] = None
+        self.max: Optional[np.ndarray] = None
+        self.ema: Optional[np.ndarray] = None
+        self._delta: Optional[np.ndarray] = None
+        self._scratch: Optional[np.ndarray] = None
+
+    def reset(self):
+        self.count = 0
+
+    def update(self, data: np.ndarray):
+        if self.count == 0 or self.mean.shape != data.shape:
+            self.count = 1
+            self.mean = np.array(data, dtype=float)
+            self.m2 = np.zeros_like(self.mean)
+            self.min = self.mean.copy()
+            self.max = self.mean.copy()
+            self.ema = self.mean.copy()
+            self._delta = np.empty_like(self.mean)
+            self._scratch = np.empty_like(self.mean)
+            return
+
+        self.count += 1
+        delta, scratch = self._delta, self._scratch
+        np.subtract(data, self.mean, out=delta)
+        np.divide(delta, self.count, out=scratch)
+        self.mean += scratch
+        np.subtract(data, self.mean, out=scratch)
+        delta *= scratch
+        self.m2 += delta
+        np.minimum(self.min, data, out=self.min)
+        np.maximum(self.max, data, out=self.max)
+        np.subtract(data, self.ema, out=scratch)
+        scratch *= self.alpha
+        self.ema += scratch
+
+    @property
+    def variance(self) -> np.ndarray:
+        if self.count < 2:
+            return np.zeros_like(self.mean)
+        return self.m2 / (self.count - 1)
+
+    @property
+    def std(self) -> np.ndarray:
+        return np.sqrt(self.variance)
+
+    def get(self, statistic: str) -> np.ndarray:
+        """ Get one of the STATISTICS"""
+        return getattr(self, statistic)
+
+
+class DataMixerModelStatistics(DataMixerModel):
+    params = [
+        {'title': 'Get Data:', 'name': 'get_data', 'type': 'bool_push', 'value': False,
+         'label': 'Get Data'},
+        {'title': 'Sources:', 'name': 'sources', 'type': 'itemselect', 'checkbox': True,
+         'value': dict(all_items=[], selected=[]), 'tip': 'Full names of the data to process'},
+        {'title': 'Statistics:', 'name': 'statistics', 'type': 'itemselect', 'checkbox': True,
+         'value': dict(all_items=STATISTICS, selected=['mean', 'std'])},
+        {'title': 'Accumulation', 'name': 'window', 'type': 'group', 'children': [
+            {'title': 'Restart every (0: never):', 'name': 'restart_frames', 'type': 'int',
+             'value': 0, 'min': 0,
+             'tip': 'Restart the accumulation from scratch once it holds the given number of'
+                    ' frames, the statistics being then computed on a single frame'},
+            {'title': 'EMA frames:', 'name': 'ema_frames', 'type': 'float', 'value': 10., 'min': 1.,
+             'tip': 'Number of frames N of the exponential moving average, alpha = 2 / (N + 1)'},
+        ]},
+        {'title': 'Count:', 'name': 'count', 'type': 'int', 'value': 0, 'readonly': True},
+        {'title': 'Reset', 'name': 'reset', 'type': 'action'},
+    ]
+
+    @classmethod
+    def required_data(cls, settings: 'Parameter') -> List[str]:
+        return list(settings['sources']['selected'])
+
+    def ini_model(self):
+        self.statistics: Dict[str, List[RunningStatistics]] = {}
+        self._reset = False
+        self._count = 0  # the value last shown in the count setting
+        self.show_data_list()
+
+    def reset(self):
+        """ Restart the accumulation at the next frame, from any thread"""
+        self._reset = True
+
+    def update_settings(self, param: 'Parameter'):
+        if param.name() == 'get_data':
+            self.show_data_list()
+        elif param.name() in ['reset', 'sources']:
+            self.reset()
+        elif param.name() == 'ema_frames':
+            for statistics in self.statistics.values():
+                for channel_statistics in statistics:
+                    channel_statistics.alpha = self.alpha
+
+    @property
+    def alpha(self) -> float:
+        return 2 / (self.settings['window', 'ema_frames'] + 1)
+
+    def show_data_list(self):
+        dte = self.modules_manager.get_det_data_list()
+        data_list = []
+        for dim in ['data0D', 'data1D', 'data2D', 'dataND']:
+            data_list.extend(dte.get_full_names(dim))
+        selected = [name for name in self.settings['sources']['selected'] if name in data_list]
+        self.settings.child('sources').setValue(dict(all_items=data_list, selected=selected))
+
+    def process_dte(self, dte: DataToExport):
+        if self._reset:
+            self._reset = False
+            self.statistics = {}
+        restart_frames = self.settings['window', 'restart_frames']
+
+        dte_processed = DataToExport('computed')
+        count = 0
+        for full_name in self.settings['sources']['selected']:
+            dwa = dte.get_data_from_full_name(full_name)
+            if dwa is None:
+                continue
+            statistics = self.statistics.get(full_name)
+            if statistics is None or len(statistics) != len(dwa):
+                statistics = [RunningStatistics(self.alpha) for _ in range(len(dwa))]
+                self.statistics[full_name] = statistics
+            for channel_statistics, array in zip(statistics, dwa):
+                if restart_frames > 0 and channel_statistics.count >= restart_frames:
+                    channel_statistics.reset()
+                channel_statistics.update(array)
+            count = statistics[0].count
+            dte_processed.append(self.statistics_to_data(dwa, statistics))
+
+        if count != self._count:  # not queued to the GUI thread for nothing
+            self._count = count
+            self.set_setting_value(count, 'count')
+        return dte_processed
+
+    def statistics_to_data(self, dwa: DataWithAxes,
+                           statistics: List[RunningStatistics]) -> List[DataCalculated]:
+        return [DataCalculated(f'{dwa.name}_{statistic}',
+                               data=[channel_statistics.get(statistic)
+                                     for channel_statistics in statistics],
+                               labels=[f'{label}_{statistic}' for label in dwa.labels],
+                               units=dwa.units if statistic != 'variance' else '',
+                               origin=dwa.origin,
+                               axes=[axis.copy() for axis in dwa.axes],
+                               nav_indexes=dwa.nav_indexes)
+                for statistic in self.settings['statistics']['selected']]
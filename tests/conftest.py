@@ -0,0 +1,11 @@
+import pytest
+
+from pymodaq_plugins_datamixer.extensions.utils import model as model_module
+
+
+@pytest.fixture(autouse=True)
+def registry_path(tmp_path, monkeypatch):
+    """ Keep the models registry written by get_models out of the user configuration directory"""
+    registry_path = tmp_path.joinpath('registry.json')
+    monkeypatch.setattr(model_module, 'get_registry_path', lambda: registry_path)
+    return registry_path
@@ -0,0 +1,41 @@
+import pytest
+from qtpy import QtWidgets
+
+from pymodaq_gui.utils import DockArea
+from pymodaq_gui.utils.utils import mkQApp
+
+from pymodaq_plugins_datamixer.extensions.data_mixer import DataMixer
+
+
+class FakeDashboard:
+    detector_modules = []
+    actuators_modules = []
+
+
+@pytest.fixture
+def data_mixer():
+    mkQApp('DataMixer')
+    window = QtWidgets.QMainWindow()
+    area = DockArea()
+    window.setCentralWidget(area)
+    data_mixer = DataMixer(area, FakeDashboard())
+    data_mixer.settings.child('models', 'model_class').setValue('equation_model')
+    yield data_mixer
+    data_mixer.quit_fun()
+
+
+def test_quit_fun(data_mixer):
+    data_mixer.ini_model()
+    worker = data_mixer.worker
+    pipeline = data_mixer.pipeline
+    assert worker.isRunning()
+    stopped = []
+    pipeline.stop = lambda: stopped.append(True)
+
+    data_mixer.quit_fun()
+    assert not worker.isRunning()
+    assert stopped == [True]
+    assert data_mixer.worker is None
+    assert data_mixer.pipeline is None
+    assert not data_mixer.counters_timer.isActive()
+    assert not data_mixer.display_timer.isActive()
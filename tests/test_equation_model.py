@@ -0,0 +1,61 @@
+import numpy as np
+
+from pymodaq_data.data import DataToExport, DataRaw
+
+from pymodaq_plugins_datamixer.extensions.utils.diagnostics import CircuitBreaker
+from pymodaq_plugins_datamixer.extensions.utils.runner import ModelRunner
+
+dte = DataToExport('dte', data=[DataRaw('Power', data=[np.array([2.])], origin='Det'),
+                                DataRaw('Spectro', data=[np.arange(5.)], origin='Det')])
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(max_failures=3)
+    error = ValueError('error')
+    assert not breaker.failure('line', error)
+    breaker.success('line')
+    assert [breaker.failure('line', error) for _ in range(3)] == [False, False, True]
+    assert breaker.disabled == {'line': 'error'}
+    assert breaker.errors['line'] == 4
+    breaker = CircuitBreaker(max_failures=0)
+    assert not any([breaker.failure('line', error) for _ in range(100)])
+
+
+def test_validation():
+    runner = ModelRunner('equation_model', {'edit_formula': '{Det/Power} * 2\n'
+                                                            '{Det/Spectro} + np.ones(3)\n'
+                                                            '{Det/Unknown}\n'
+                                                            '(1 +'}, data=dte)
+    errors = runner.model_settings['formula_errors'].split('\n')
+    assert [error.split(':')[0] for error in errors] == ['Formula_003', 'Formula_001',
+                                                        'Formula_002']
+    runner.set_settings({'edit_formula': '{Det/Power} * 2\n{Det/Spectro}[-3] + 1'})
+    assert runner.model_settings['formula_errors'] == ''
+
+
+def test_failing_line_disabled():
+    runner = ModelRunner('equation_model', {'edit_formula': '{Det/Power} * 2\n'
+                                                            '{Det/Spectro} + np.ones(3)\n'
+                                                            '{Det/Spectro}[-5] - {Det/Spectro}',
+                                            'max_failures': 3}, data=dte)
+    computed = [runner.process(dte) for _ in range(10)]
+    assert [dwa.name for dwa in computed[-1]] == ['Formula_000', 'Formula_002']
+    # no failure counted while the history fills up
+    assert runner.model.compiled.breaker.errors == {'Formula_001': 3}
+    assert 'Formula_001 disabled after 3 errors' in runner.model_settings['formula_errors']
+
+    runner.set_settings({'edit_formula': '{Det/Power} * 2\n{Det/Spectro} + np.ones(5)'})
+    assert len(runner.process(dte)) == 2
+
+
+def test_warmup_not_disabled():
+    formulae = ('d = {Det/Spectro} - {Det/Spectro}[-20]\n'
+                'd * 2\n'  # through an intermediate using past frames
+                '{Det/Spectro}[-20] * 2\n'  # shared sub-expression using past frames
+                '{Det/Spectro}[-20] + 1')
+    runner = ModelRunner('equation_model', {'edit_formula': formulae, 'max_failures': 3},
+                         data=dte)
+    for _ in range(25):
+        computed = runner.process(dte)
+    assert runner.model.compiled.breaker.disabled == {}
+    assert [dwa.name for dwa in computed] == ['Formula_001', 'Formula_002', 'Formula_003']
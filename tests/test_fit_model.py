@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+from scipy.optimize import approx_fprime
+
+from pymodaq_data.data import DataToExport, DataRaw, Axis
+
+from pymodaq_plugins_datamixer.extensions.utils.runner import ModelRunner
+from pymodaq_plugins_datamixer.models.fit_model import (
+    gaussian_fit, gaussian_jacobian, batch_gaussian_guess, batch_gaussian_fit, DataMixerModelFit)
+
+x = np.linspace(0, 100, 500)
+
+
+def test_gaussian_jacobian():
+    coeffs = np.array([2., 40., -7., 0.3])
+    jacobian = gaussian_jacobian(x, *coeffs)
+    assert jacobian.shape == (x.size, 4)
+    for ind in range(0, x.size, 50):
+        numerical = approx_fprime(coeffs, lambda c: gaussian_fit(x[ind], *c), 1e-7)
+        assert np.allclose(jacobian[ind], numerical, atol=1e-5)
+
+
+def test_batch_gaussian_fit():
+    rng = np.random.default_rng(0)
+    n_rows = 50
+    coeffs = np.stack((rng.uniform(1, 3, n_rows), rng.uniform(20, 80, n_rows),
+                       rng.uniform(3, 15, n_rows), rng.uniform(-1, 1, n_rows)), axis=1)
+    rows = np.array([gaussian_fit(x, *row_coeffs) for row_coeffs in coeffs])
+    rows += rng.normal(0, 0.01, rows.shape)
+
+    fitted = batch_gaussian_fit(x, rows, batch_gaussian_guess(x, rows))
+    assert fitted.shape == (n_rows, 4)
+    assert np.allclose(fitted, coeffs, atol=0.1)
+
+
+def test_batch_gaussian_guess_width():
+    rows = gaussian_fit(x, 2., 50., 10., 0.)[None, :]
+    assert batch_gaussian_guess(x, rows)[0, 2] == pytest.approx(10., rel=0.01)
+
+
+def test_process_batch_nav():
+    rows = np.array([gaussian_fit(x, 1., x0, 8., 0.) for x0 in [30., 40., 50.]])
+    dwa = DataRaw('Spectra', data=[rows], nav_indexes=(0, ), origin='Det',
+                  axes=[Axis('pos', data=np.arange(3.), index=0), Axis('x', data=x, index=1)])
+    runner = ModelRunner(DataMixerModelFit, {'batch': True, 'source': 'Det/Spectra'},
+                         data=DataToExport('dte', data=[dwa]))
+    coeffs = runner.process(DataToExport('dte', data=[dwa]))[0]
+    assert coeffs.nav_indexes == (0, )
+    assert coeffs.distribution == dwa.distribution
+    assert np.allclose(coeffs[1], [30., 40., 50.], atol=0.01)
+
+
+def test_dip_is_valid():
+    coeffs = np.array([-1., 50., 10., 2.])
+    data = gaussian_fit(x, *coeffs)
+    assert DataMixerModelFit.is_valid(x, coeffs, data)
+    assert DataMixerModelFit.batch_is_valid(x, coeffs[None, :], data[None, :])[0]
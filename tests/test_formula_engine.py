@@ -0,0 +1,118 @@
+import ast
+import pytest
+import numpy as np
+
+from pymodaq_plugins_datamixer.extensions.utils.parser import FormulaGraph, index_full_names
+from pymodaq_plugins_datamixer.extensions.utils.history import HistoryStore
+from pymodaq_plugins_datamixer.extensions.utils.engine import (
+    get_engine, fuse, NdarrayEngine, DataWithAxesEngine, inplace_binary)
+from pymodaq_data.data import DataToExport, DataRaw, DataCalculated, Axis
+
+dte = DataToExport('dte', data=[
+    DataRaw('a', data=[np.array([-1., ])], origin='A'),
+    DataRaw('b', data=[np.array([4., ])], origin='B'),
+    DataRaw('image', data=[np.arange(20.).reshape((4, 5)), np.ones((4, 5))], origin='Camera',
+            axes=[Axis('x', data=np.linspace(0, 1, 5), index=1),
+                  Axis('y', data=np.linspace(0, 1, 4), index=0)]),
+])
+
+FORMULAE = 'ratio = np.abs({A/a}/{B/b})\n-np.sqrt({Camera/image} * 2 + 1) * ratio\nratio'
+
+
+def evaluate(engine, graph: FormulaGraph):
+    index = index_full_names(dte)
+    namespace = engine.bind(index)
+    outputs = []
+    for formula in graph.steps:
+        value = engine.evaluate(formula, namespace)
+        if formula.target is None:
+            outputs.append(engine.to_data(formula, value, index))
+        else:
+            namespace[formula.target] = value
+    return outputs
+
+
+def test_get_engine():
+    graph = FormulaGraph(FORMULAE)
+    assert isinstance(get_engine('ndarray', graph), NdarrayEngine)
+    assert type(get_engine('DataWithAxes', graph)) is DataWithAxesEngine
+
+
+def test_fuse():
+    graph = FormulaGraph(FORMULAE)
+    fused = [ast.unparse(fuse(formula.node)) for formula in graph.steps]
+    assert fused[0] == '_inplace_unary(np.abs, _data_000 / _data_001)'
+    assert fused[1].startswith('_inplace_binary(np.multiply, _inplace_unary(np.negative')
+    assert fused[2] == 'ratio'
+    assert ast.unparse(graph.steps[0].node) == 'np.abs(_data_000 / _data_001)'
+
+
+def test_inplace_binary():
+    left = np.ones((3, ))
+    assert inplace_binary(np.add, left, 1., True, False) is left
+    integers = np.ones((3, ), dtype=int)
+    result = inplace_binary(np.true_divide, integers, 2, True, False)
+    assert result is not integers
+    assert result.dtype == float
+
+
+def test_ndarray_engine_matches_data_engine():
+    graph = FormulaGraph(FORMULAE)
+    image = dte[2].data[0].copy()
+    outputs = evaluate(get_engine('ndarray', graph), graph)
+    outputs_dwa = evaluate(get_engine('DataWithAxes', graph), graph)
+
+    assert np.all(dte[2].data[0] == image)  # inputs are left untouched
+    for output, output_dwa in zip(outputs, outputs_dwa):
+        assert isinstance(output, DataCalculated)
+        assert output.name == output_dwa.name
+        assert np.allclose(output.data[0], output_dwa.data[0])
+
+    assert len(outputs[0]) == 2  # single channel data are broadcast over the others
+    assert np.allclose(outputs[0].data[1], -np.sqrt(3) / 4)
+    assert outputs[0].axes[0] == dte[2].axes[0]
+    assert outputs[0].origin == 'Camera'
+
+
+def test_ndarray_engine_channels_mismatch():
+    wrong = DataToExport('dte', data=[
+        DataRaw('two', data=[np.ones((3, )), np.ones((3, ))], origin='A'),
+        DataRaw('three', data=[np.ones((3, )), np.ones((3, )), np.ones((3, ))], origin='B')])
+    graph = FormulaGraph('{A/two} + {B/three}')
+    engine = get_engine('ndarray', graph)
+    with pytest.raises(ValueError):
+        engine.evaluate(graph.steps[0], engine.bind(index_full_names(wrong)))
+
+
+@pytest.mark.parametrize('engine_name', ['DataWithAxes', 'ndarray'])
+def test_history(engine_name):
+    graph = FormulaGraph('{A/a} - {A/a}[-1]\nnp.mean(hist({Camera/image}, 3), axis=0)')
+    engine = get_engine(engine_name, graph)
+    history = HistoryStore(graph.history, 1e6)
+    for ind in range(5):
+        frame = DataToExport('dte', data=[
+            DataRaw('a', data=[np.array([ind ** 2])], origin='A'),
+            DataRaw('image', data=[np.full((4, 5), float(ind))], origin='Camera')])
+        index = index_full_names(frame)
+        history.update(index)
+    namespace = engine.bind(index, history)
+    outputs = [engine.to_data(formula, engine.evaluate(formula, namespace), index)
+               for formula in graph.outputs]
+    assert outputs[0].data[0][0] == 16 - 9
+    assert np.allclose(outputs[1].data[0], 3.)
+    assert history['Camera/image'].channels[0].buffer.shape == (6, 4, 5)
+
+
+def test_history_memory_budget():
+    history = HistoryStore({'Camera/image': 100}, 1e3)
+    history.update(index_full_names(dte))
+    assert history['Camera/image'].channels == []
+    assert history.nbytes == 0
+
+
+def test_pass_through_output():
+    graph = FormulaGraph('{A/a}')
+    output = evaluate(DataWithAxesEngine(graph), graph)[0]
+    assert output.name == 'Formula_000'
+    assert dte.get_data_from_full_name('A/a').name == 'a'  # the shared input is not renamed
+    assert output.data[0] is dte.get_data_from_full_name('A/a').data[0]  # copied once appended
@@ -1,9 +1,11 @@
+import ast
 import pytest
 import re
 import numpy as np
 
 from pymodaq_plugins_datamixer.extensions.utils.parser import (
-    split_formulae, extract_data_names, replace_names_in_formula)
+    split_formulae, extract_data_names, replace_names_in_formula, Formula,
+    bind_names_in_formula, index_full_names, bind_variables, FormulaGraph)
 from pymodaq_data.data import DataToExport, DataRaw
 
 data_name_1 = 'Integrated_ROI_01'
@@ -50,3 +52,115 @@ def test_replace_name_in_formula():
 
     assert eval(formula_to_eval) == dte[2] / np.abs(dte[0] / dte[1])
 
+
+
+def test_formula():
+    formula = Formula(FORMULA, name='Formula_000')
+    assert formula.data_names == [f'{origin3}/{data_name_3}',
+                                  f'{origin1}/{data_name_1}',
+                                  f'{origin2}/{data_name_2}']
+    assert formula.evaluate(dte) == dte[2] / np.abs(dte[0] / dte[1])
+
+
+def test_formula_distinct_names():
+    formula = Formula(f'{{{origin1}/{data_name_1}}} + {{{origin1}/{data_name_1}}}')
+    assert formula.data_names == [f'{origin1}/{data_name_1}']
+    assert formula.evaluate(dte) == dte[0] + dte[0]
+
+
+def test_formula_syntax_error():
+    with pytest.raises(SyntaxError):
+        Formula(f'{{{origin1}/{data_name_1}}} +')
+
+
+def test_bind_names_in_formula():
+    variables = {}
+    formula_to_eval, variables = bind_names_in_formula(FORMULA, variables)
+    assert list(variables.keys()) == [f'{origin3}/{data_name_3}',
+                                      f'{origin1}/{data_name_1}',
+                                      f'{origin2}/{data_name_2}']
+    assert '{' not in formula_to_eval
+
+    _, variables = bind_names_in_formula(f'{{{origin1}/{data_name_1}}}*2', variables)
+    assert len(variables) == 3
+
+
+def test_shared_namespace():
+    variables = {}
+    formulae = [Formula(FORMULA, variables=variables),
+                Formula(f'{{{origin1}/{data_name_1}}}*2', variables=variables)]
+    index = index_full_names(dte)
+    assert index[f'{origin1}/{data_name_1}'] is dte[0]
+    namespace = bind_variables(index, variables)
+    assert formulae[0].evaluate(namespace) == dte[2] / np.abs(dte[0] / dte[1])
+    assert formulae[1].evaluate(namespace) == dte[0] * 2
+
+
+def test_missing_name():
+    formula = Formula('{not/there} * 2')
+    with pytest.raises(NameError):
+        formula.evaluate(dte)
+
+
+def evaluate_graph(graph: FormulaGraph):
+    namespace = bind_variables(index_full_names(dte), graph.variables)
+    outputs = {}
+    for formula in graph.steps:
+        if formula.target is None:
+            outputs[formula.name] = formula.evaluate(namespace)
+        else:
+            namespace[formula.target] = formula.evaluate(namespace)
+    return outputs
+
+
+def test_formula_assignment():
+    formula = Formula(f'ratio = {FORMULA}')
+    assert formula.target == 'ratio'
+    assert formula.evaluate(dte) == dte[2] / np.abs(dte[0] / dte[1])
+
+    for expression in ['np = 2', '_data_000 = 2', 'a = b = 2']:
+        with pytest.raises(SyntaxError):
+            Formula(expression)
+
+
+def test_formula_graph_intermediates():
+    graph = FormulaGraph(f'ratio = np.abs({{{origin1}/{data_name_1}}}/{{{origin2}/{data_name_2}}})\n'
+                         f'{{{origin3}/{data_name_3}}}/ratio\n'
+                         f'unused = {{{origin1}/{data_name_1}}} * 10\n'
+                         f'\n'
+                         f'ratio * 2')
+    assert [formula.name for formula in graph.outputs] == ['Formula_001', 'Formula_004']
+    assert 'unused' not in [formula.target for formula in graph.steps]
+    assert graph.data_names == [f'{origin1}/{data_name_1}', f'{origin2}/{data_name_2}',
+                                f'{origin3}/{data_name_3}']
+    outputs = evaluate_graph(graph)
+    assert outputs['Formula_001'] == dte[2] / np.abs(dte[0] / dte[1])
+    assert outputs['Formula_004'] == np.abs(dte[0] / dte[1]) * 2
+
+
+def test_formula_graph_shared_subexpressions():
+    graph = FormulaGraph(FORMULAE)
+    shared = [formula for formula in graph.steps if formula.target is not None]
+    assert len(shared) == 1
+    assert len(graph.outputs) == NFORMULA
+    assert shared[0] is graph.steps[0]
+    for output in evaluate_graph(graph).values():
+        assert output == dte[2] / np.abs(dte[0] / dte[1])
+
+
+def test_formula_graph_errors():
+    graph = FormulaGraph('a = b + 1\nb = a * 2\na + 1\nbad +\na = 3\n2 * 3')
+    assert sorted(graph.errors.keys()) == [0, 1, 2, 3, 4]
+    assert len(graph.steps) == 1
+    assert evaluate_graph(graph)['Formula_005'] == 6
+
+
+def test_formula_history():
+    formula = Formula('{A/a} - {A/a}[-2] + np.mean(hist({B/b}, 10), axis=0) + {C/c}[0]')
+    assert formula.history == {'A/a': 3, 'B/b': 10}
+    assert ast.unparse(formula.node) == ('_data_000 - _past(_hist_000, 2) + '
+                                         'np.mean(_window(_hist_001, 10), axis=0) + _data_002[0]')
+    with pytest.raises(SyntaxError):
+        Formula('hist({A/a} + 1, 10)')
+    assert FormulaGraph('{A/a}[-1]\nx = hist({A/a}, 5)\nhist({B/b}, 4)').history == \
+        {'A/a': 2, 'B/b': 4}
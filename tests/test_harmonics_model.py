@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+
+from pymodaq_plugins_datamixer.models.harmonics_model import track_peak, parabolic_refinement
+
+x = np.arange(1000)
+
+
+def peak(x0, amp=1.):
+    return amp * np.exp(-((x - x0) / 10) ** 2)
+
+
+def test_track_peak():
+    data = peak(500) + peak(800, 0.9)
+    assert track_peak(data, 495, 20) == 500
+    assert track_peak(data, 790, 20) == 800
+    assert track_peak(peak(530), 500, 20) is None  # moved out of the window
+    assert track_peak(peak(5), 2, 20) == 5
+    noise = 0.01 * np.sin(x / 2.)
+    assert track_peak(noise, 500, 20) is not None
+    assert track_peak(noise, 500, 20, height=0.5) is None  # vanished, not locked on the noise
+    assert track_peak(peak(500) + noise, 495, 20, height=0.5) == 500
+
+
+def test_parabolic_refinement():
+    assert parabolic_refinement(peak(500.3), 500) == pytest.approx(500.3, abs=0.05)
+    assert parabolic_refinement(peak(0), 0) == 0.
+
@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+
+from pymodaq_plugins_datamixer.extensions.utils.history import RingBuffer
+
+
+def test_ring_buffer():
+    ring = RingBuffer(4, (2, ), float)
+    for ind in range(6):
+        ring.append(np.full((2, ), ind))
+    assert ring.count == 4
+    assert np.all(ring.past(0) == 5)
+    assert np.all(ring.past(3) == 2)
+    with pytest.raises(IndexError):
+        ring.past(4)
+    window = ring.window(3)
+    assert np.all(window[:, 0] == [3, 4, 5])
+    assert np.shares_memory(window, ring.buffer)
+    assert np.all(ring.window(10)[:, 0] == [2, 3, 4, 5])
+
+
+def test_ring_buffer_filling():
+    ring = RingBuffer(4, (), int)
+    ring.append(np.array(1))
+    assert ring.window(4).shape == (1, )
+    assert ring.matches(np.array(2))
+    assert not ring.matches(np.array(2.))
@@ -0,0 +1,46 @@
+import numpy as np
+
+from pymodaq_data.data import DataToExport, DataRaw
+
+from pymodaq_plugins_datamixer.extensions.utils.join import JoinBuffer
+
+
+def frame(detector: str, timestamp: float, value: float) -> DataToExport:
+    dwa = DataRaw(detector, data=[np.array([value])], origin=detector)
+    dwa.timestamp = timestamp
+    return DataToExport(detector, data=[dwa])
+
+
+def test_join_nearest():
+    join = JoinBuffer(['fast', 'slow'], tolerance=0.02)
+    assert join.add(frame('fast', 0.00, 0.)) is None  # waiting for the slow detector
+    assert join.add(frame('fast', 0.10, 10.)) is None
+    joined = join.add(frame('slow', 0.09, 1.))
+    assert joined.get_full_names() == ['fast/fast', 'slow/slow']
+    assert joined.get_data_from_full_name('fast/fast')[0][0] == 10.
+    assert join.add(frame('fast', 0.20, 20.)) is None  # same reference, already joined
+
+    assert join.add(frame('slow', 0.15, 2.)) is None  # nearest fast frame 50 ms away
+    assert join.add(frame('other', 0.16, 2.)) is None
+
+
+def test_join_interpolate():
+    join = JoinBuffer(['fast', 'slow'], tolerance=0.1, policy='Interpolate')
+    join.add(frame('fast', 0.0, 0.))
+    join.add(frame('fast', 0.1, 10.))
+    joined = join.add(frame('slow', 0.025, 1.))
+    fast = joined.get_data_from_full_name('fast/fast')
+    assert np.allclose(fast[0], 2.5)
+    assert fast.timestamp == 0.025
+
+
+def test_join_interleaved_once():
+    join = JoinBuffer(['fast', 'slow'], tolerance=0.005)
+    frames = [frame('fast', 0.01 * index, index) for index in range(50)]
+    frames.extend([frame('slow', 0.1 * index + 0.003, 100 + index) for index in range(5)])
+    joined = [join.add(dte) for dte in sorted(frames, key=lambda dte: dte[0].timestamp)]
+    pairs = [(dte.get_data_from_full_name('fast/fast')[0][0],
+              dte.get_data_from_full_name('slow/slow')[0][0])
+             for dte in joined if dte is not None]
+    assert pairs == [(10 * index, 100 + index) for index in range(5)]
+    assert join.add(frame('fast', 0.2, 20.)) is None  # slow frame already joined
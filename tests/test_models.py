@@ -0,0 +1,92 @@
+import json
+import sys
+import types
+
+from pymodaq_plugins_datamixer.extensions.utils import model as model_module
+from pymodaq_plugins_datamixer.extensions.utils.model import (get_models, load_model_class,
+                                                              get_model_classes, scan_models,
+                                                              DataMixerModel)
+
+
+def test_get_models(registry_path):
+    models = get_models()
+    names = [model['name'] for model in models]
+    for name in ['equation_model', 'fit_model', 'harmonics_model']:
+        assert name in names
+    for model in models:
+        assert 'class' not in model
+
+
+def test_load_model_class(registry_path):
+    model = get_models('equation_model')
+    model_class = load_model_class(model)
+    assert issubclass(model_class, DataMixerModel)
+    assert model['module'] is sys.modules[model['module_name']]
+    assert load_model_class(model) is model_class
+
+
+def test_registry_cache(registry_path):
+    models = get_models()
+    registry = json.loads(registry_path.read_text())
+    assert registry['models'] == models
+
+    registry['models'] = registry['models'][:1]
+    registry_path.write_text(json.dumps(registry))
+    assert get_models() == registry['models']  # valid key: the scan is skipped
+    assert get_models(use_cache=False) == models
+
+    registry['key'] = {}
+    registry_path.write_text(json.dumps(registry))
+    assert get_models() == models
+
+
+def test_get_model_classes():
+    module = types.ModuleType('my_models')
+
+    class AbstractModel(DataMixerModel):
+        pass
+
+    class BaseModel(AbstractModel):
+        def process_dte(self, measurements):
+            return measurements
+
+    class IntermediateModel(BaseModel):
+        pass
+
+    class DerivedModel(IntermediateModel):
+        params = [{'title': 'Option:', 'name': 'option', 'type': 'bool', 'value': False}]
+
+    class UnfinishedModel(DataMixerModel):
+        pass
+
+    for klass in (AbstractModel, BaseModel, IntermediateModel, DerivedModel, UnfinishedModel):
+        klass.__module__ = module.__name__
+        setattr(module, klass.__name__, klass)
+    module.DataMixerModel = DataMixerModel
+
+    assert get_model_classes(module) == [BaseModel, DerivedModel]
+
+
+def test_scan_models_names(tmp_path, monkeypatch):
+    models_path = tmp_path.joinpath('my_plugin', 'models')
+    models_path.mkdir(parents=True)
+    tmp_path.joinpath('my_plugin', '__init__.py').write_text('')
+    models_path.joinpath('__init__.py').write_text('')
+    models_path.joinpath('multi_model.py').write_text(
+        'from pymodaq_plugins_datamixer.extensions.utils.model import DataMixerModel\n\n\n'
+        'class AnotherModel(DataMixerModel):\n'
+        '    def process_dte(self, measurements):\n'
+        '        return measurements\n\n\n'
+        'class DerivedModel(AnotherModel):\n'
+        '    def process_dte(self, measurements):\n'
+        '        return measurements\n\n\n'
+        'class MainModel(DataMixerModel):\n'
+        '    def process_dte(self, measurements):\n'
+        '        return measurements\n')
+    monkeypatch.syspath_prepend(str(tmp_path))
+
+    models = scan_models([('my_plugin', '', [models_path])])
+    # the name of the module is kept by its first direct subclass of DataMixerModel
+    assert [(model['name'], model['class_name']) for model in models] == [
+        ('multi_model', 'AnotherModel'), ('multi_model/DerivedModel', 'DerivedModel'),
+        ('multi_model/MainModel', 'MainModel')]
@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+
+from pymodaq_data.data import DataToExport, DataRaw, DataCalculated
+
+from pymodaq_plugins_datamixer.extensions.utils.model import DataMixerModel
+from pymodaq_plugins_datamixer.extensions.utils.runner import ModelRunner
+from pymodaq_plugins_datamixer.extensions.utils.pipeline import ModelPipeline, PipelineStage
+
+dte = DataToExport('dte', data=[DataRaw('Power', data=[np.array([2.])], origin='Det')])
+
+
+class RecordingModel(DataMixerModel):
+    """ Keep track of the data it is given and double the first one"""
+    params = []
+    received = []
+
+    def process_dte(self, dte: DataToExport) -> DataToExport:
+        self.received.append(dte)
+        return DataToExport('computed', data=[
+            DataCalculated('Double', data=[dte[0][0] * 2])])
+
+
+def equation_stage(name, formula, input_name='Detectors'):
+    return PipelineStage(name, ModelRunner('equation_model', {'edit_formula': formula}, data=dte),
+                         input_name)
+
+
+def test_parallel_models():
+    pipeline = ModelPipeline([equation_stage('first', '{Det/Power} * 2'),
+                              equation_stage('second', '{Det/Power} + 1')])
+    assert [[stage.name for stage in level] for level in pipeline.levels] == [['first', 'second']]
+    computed = pipeline.process(dte)
+    assert [dwa[0][0] for dwa in computed] == [4., 3.]
+    assert [dwa.get_full_name() for dwa in computed] == ['Det/Formula_000', 'second/Formula_000']
+    pipeline.stop()
+
+
+def test_chained_models():
+    RecordingModel.received = []
+    first = equation_stage('first', '{Det/Power} * 2')
+    pipeline = ModelPipeline([first, PipelineStage('chained', ModelRunner(RecordingModel), 'first'),
+                              equation_stage('other', '{Det/Power} - 1')])
+    assert len(pipeline.levels) == 2
+    computed = pipeline.process(dte)
+    full_names = [dwa.get_full_name() for dwa in computed]
+    assert full_names == ['Det/Formula_000', 'chained/Double', 'other/Formula_000']
+    assert computed.get_data_from_full_name('chained/Double')[0][0] == 8.
+    assert RecordingModel.received[0][0] is computed[0]  # no copy between the models
+    pipeline.stop()
+
+
+def test_update_settings():
+    first, second = equation_stage('first', '{Det/Power}'), equation_stage('second', '{Det/Power}')
+    pipeline = ModelPipeline([first, second])
+    param = second.runner.model_settings.child('edit_formula')
+    param.setValue('{Det/Power} * 10')
+    assert pipeline.update_settings(param)
+    assert not pipeline.update_settings(first.runner.settings.child('models'))
+    assert [dwa[0][0] for dwa in pipeline.process(dte)] == [2., 20.]
+    pipeline.stop()
+
+
+def test_unknown_input():
+    pipeline = ModelPipeline([equation_stage('first', '{Det/Power}')])
+    with pytest.raises(ValueError):
+        pipeline.add_stage(equation_stage('chained', '{Det/Power}', 'unknown'))
+    with pytest.raises(ValueError):
+        pipeline.add_stage(equation_stage('first', '{Det/Power}'))
+
+
+def test_required_data():
+    RecordingModel.received = []
+    two_channels = DataToExport('dte', data=[
+        dte[0], DataRaw('Camera', data=[np.ones((100, 100))], origin='Cam')])
+    pipeline = ModelPipeline([equation_stage('first', '{Det/Power} * 2\n{Det/Power} + 1'),
+                              PipelineStage('all', ModelRunner(RecordingModel))])
+    assert pipeline.required_data() is None
+    pipeline.process(two_channels)
+    assert len(RecordingModel.received[0]) == 2
+
+    first = equation_stage('first', '{Det/Power} * 2\n{Det/Power} + 1')
+    pipeline = ModelPipeline([first, PipelineStage('chained', ModelRunner(RecordingModel), 'first')])
+    assert pipeline.required_data() == ['Det/Power']
+    param = first.runner.model_settings.child('edit_formula')
+    param.setValue('{Cam/Camera}.mean()')
+    pipeline.update_settings(param)
+    assert pipeline.required_data() == ['Cam/Camera']
+    computed = pipeline.process(two_channels)
+    assert computed[0][0][0] == 1.
@@ -0,0 +1,130 @@
+import os
+
+import numpy as np
+import pytest
+
+from pymodaq_data.data import DataToExport, DataRaw, Axis
+
+from pymodaq_plugins_datamixer.extensions.utils.diagnostics import Diagnostics
+from pymodaq_plugins_datamixer.extensions.utils.model import DataMixerModel
+from pymodaq_plugins_datamixer.extensions.utils.process import (SharedRing, encode_dte,
+                                                                decode_dte, ProcessModelRunner)
+
+
+class DyingModel(DataMixerModel):
+    """ Model ending its process while initialized"""
+
+    def ini_model(self):
+        os._exit(1)
+
+    def process_dte(self, measurements):
+        return measurements
+
+
+def make_dte(ind: int = 0) -> DataToExport:
+    x = np.linspace(0, 1, 100)
+    return DataToExport('Det', data=[
+        DataRaw('Image', data=[np.full((20, 100), float(ind))], origin='Camera',
+                axes=[Axis('y', data=np.arange(20.), index=0), Axis('x', data=x, index=1)]),
+        DataRaw('Counts', data=[np.array([ind]), np.array([2 * ind], dtype=np.int32)],
+                labels=['a', 'b'], origin='Det0D')])
+
+
+def test_shared_ring():
+    ring = SharedRing(2, 1024)
+    try:
+        arrays = [np.arange(10.), np.ones((3, 3), dtype=np.int16)]
+        layouts = ring.write(1, arrays)
+        assert [layout[0] % 64 for layout in layouts] == [0, 0]
+        for array, read in zip(arrays, ring.read(1, layouts)):
+            assert np.all(array == read) and array.dtype == read.dtype
+        assert ring.write(0, [np.zeros((200, ))]) is None
+        assert [ring.next_slot() for _ in range(3)] == [0, 1, 0]
+    finally:
+        ring.close()
+
+
+@pytest.mark.parametrize('slot_bytes', [2 ** 20, 16])
+def test_encode_decode(slot_bytes):
+    ring = SharedRing(2, slot_bytes)
+    try:
+        dte = make_dte(3)
+        slot, header = encode_dte(dte, ring)
+        assert (slot is None) == (slot_bytes == 16)
+        decoded = decode_dte(slot, header, ring)
+        image = decoded.get_data_from_full_name('Camera/Image')
+        assert image.shape == (20, 100)
+        assert np.allclose(image.axes[1].get_data(), np.linspace(0, 1, 100))
+        counts = decoded.get_data_from_full_name('Det0D/Counts')
+        assert counts.labels == ['a', 'b']
+        assert counts[1].dtype == np.int32 and counts[1][0] == 6
+        assert counts.timestamp == dte[1].timestamp
+    finally:
+        ring.close()
+
+
+def test_process_model_runner():
+    runner = ProcessModelRunner('equation_model', data=make_dte())
+    try:
+        runner.set_settings({'edit_formula': '{Camera/Image}.mean()\n{Det0D/Counts} * 2'})
+        dte = runner.process(make_dte(4))
+        assert dte[0][0][0] == pytest.approx(4.)
+        assert np.allclose(dte.get_data_from_name('Formula_001')[1], 16)
+
+        runner.model_settings.child('edit_formula').setValue('{Camera/Image}.mean() * 10')
+        dte = runner.process(make_dte(1))
+        assert dte[0][0][0] == pytest.approx(10.)
+    finally:
+        runner.stop()
+    assert not runner.model_process.is_alive()
+
+
+def test_process_model_settings_back():
+    runner = ProcessModelRunner('statistics_model', data=make_dte())
+    try:
+        runner.set_settings({'sources': dict(all_items=['Camera/Image'],
+                                             selected=['Camera/Image'])})
+        for ind in range(3):
+            dte = runner.process(make_dte(ind))
+        assert np.allclose(dte.get_data_from_name('Image_mean')[0], 1.)
+        assert runner.model_settings['count'] == 3
+        runner.model_settings.child('reset').activate()
+        runner.process(make_dte())
+        assert runner.model_settings['count'] == 1
+    finally:
+        runner.stop()
+    runner.model_settings.child('reset').activate()  # no longer forwarded to the ended process
+
+
+def test_process_model_dies_at_startup():
+    with pytest.raises(RuntimeError, match='could not start'):
+        ProcessModelRunner(DyingModel, data=make_dte())
+
+
+def test_process_model_settings_round_trip():
+    runner = ProcessModelRunner('equation_model', data=make_dte())
+    try:
+        # set by the model while initialized
+        assert runner.model_settings['data0D']['all_items'] == ['Det0D/Counts']
+        # set by the model while applying a forwarded change
+        runner.set_settings({'edit_formula': '{Det/Unknown}'})
+        assert runner.model_settings['formula_errors'] == 'Formula_000: Unknown data: Det/Unknown'
+        runner.model_settings.child('edit_formula').setValue('{Det0D/Counts} * 2')
+        assert runner.model_settings['formula_errors'] == ''
+        assert runner.get_settings()['edit_formula'] == '{Det0D/Counts} * 2'
+    finally:
+        runner.stop()
+
+
+def test_process_model_diagnostics():
+    diagnostics = Diagnostics(enabled=True)
+    runner = ProcessModelRunner('equation_model', data=make_dte(), diagnostics=diagnostics,
+                                name='equation_model (model00)')
+    try:
+        runner.set_settings({'edit_formula': '{Det0D/Counts} * 2\n{Camera/Image} + np.ones(3)'})
+        for ind in range(2):
+            runner.process(make_dte(ind))
+        assert diagnostics.get_timing('equation_model (model00)/Formula_000').count == 2
+        assert diagnostics.get_timing('equation_model (model00)/Formula_001').errors == 2
+    finally:
+        runner.stop()
@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+from pymodaq_data.data import DataToExport, DataRaw, Axis
+from pymodaq_data.h5modules.saving import H5SaverLowLevel
+from pymodaq_data.h5modules.data_saving import DataToExportExtendedSaver, DataLoader
+
+from pymodaq_plugins_datamixer.extensions.replay import ReplaySource, replay, main
+
+NAV_SHAPE = (4, 3)
+x = np.linspace(0, 1, 10)
+
+
+@pytest.fixture
+def scan_file(tmp_path):
+    """ A 2D scan of a detector giving a 1D spectrum of two channels and a 0D count"""
+    file_path = tmp_path / 'scan.h5'
+    h5saver = H5SaverLowLevel(save_type='scan')
+    h5saver.init_file(file_path, new_file=True)
+    scan_group = h5saver.add_scan_group()
+    det_group = h5saver.add_det_group(scan_group, title='Det')
+    saver = DataToExportExtendedSaver(h5saver, NAV_SHAPE)
+    saver.add_nav_axes(scan_group, [Axis('xnav', data=np.arange(4.), index=0),
+                                    Axis('ynav', data=np.arange(3.) * 2, index=1)])
+    for ind in range(NAV_SHAPE[0]):
+        for ind_bis in range(NAV_SHAPE[1]):
+            saver.add_data(det_group, DataToExport('Det', data=[
+                DataRaw('Spectro', data=[x * ind + ind_bis, x], origin='Det',
+                        axes=[Axis('x', data=x, index=0)]),
+                DataRaw('Counts', data=[np.array([ind * 10. + ind_bis])], origin='Det')]),
+                indexes=[ind, ind_bis])
+    h5saver.close_file()
+    return file_path
+
+
+def load_computed(file_path):
+    h5saver = H5SaverLowLevel()
+    h5saver.open_file(file_path, 'r')
+    loader = DataLoader(h5saver)
+    dte = loader.load_all('/RawData/Scan000/Detector000')
+    h5saver.close_file()
+    return dte
+
+
+def test_replay_source(scan_file):
+    with ReplaySource(scan_file) as source:
+        assert source.nav_shape == NAV_SHAPE
+        assert [axis.label for axis in source.nav_axes] == ['xnav', 'ynav']
+        assert source.get_chunks(7) == [(0, 2), (2, 4)]
+        frames = source.read_chunk(1, 3)
+        assert len(frames) == 6
+        spectro = frames[4].get_data_from_full_name('Det/Spectro')
+        assert np.allclose(spectro[0], x * 2 + 1)
+        assert spectro.axes[0].index == 0
+        counts = frames[4].get_data_from_full_name('Det/Counts')
+        assert counts.dim.name == 'Data0D'
+        assert counts[0][0] == pytest.approx(21.)
+        frame = source.read_frame(7)
+        assert np.allclose(frame.get_data_from_full_name('Det/Spectro')[0], x * 2 + 1)
+        assert frame.get_data_from_full_name('Det/Counts')[0][0] == pytest.approx(21.)
+
+
+@pytest.mark.parametrize('processes', [0, 2])
+def test_replay(scan_file, tmp_path, processes):
+    output_path = tmp_path / 'computed.h5'
+    replay(scan_file, output_path, 'equation_model',
+           {'edit_formula': '{Det/Counts} * 2\n{Det/Spectro}.mean()'},
+           chunk_frames=3, processes=processes)
+
+    dte = load_computed(output_path)
+    counts = dte.get_data_from_name('Formula_000')
+    assert counts.shape == NAV_SHAPE
+    assert [axis.label for axis in counts.axes] == ['xnav', 'ynav']
+    expected = 2 * (10. * np.arange(4)[:, None] + np.arange(3)[None, :])
+    assert np.allclose(counts[0], expected)
+    mean = dte.get_data_from_name('Formula_001')
+    assert len(mean) == 2
+    assert np.allclose(mean[0], np.arange(4)[:, None] * 0.5 + np.arange(3)[None, :])
+
+
+def test_main_unknown_model(scan_file, tmp_path):
+    with pytest.raises(SystemExit):
+        main([str(scan_file), str(tmp_path / 'computed.h5'), '--model', 'unknown_model'])
@@ -0,0 +1,76 @@
+import subprocess
+import sys
+
+import numpy as np
+
+from pymodaq_data.data import DataToExport, DataRaw, Axis
+
+from pymodaq_plugins_datamixer.extensions.utils.diagnostics import Diagnostics
+from pymodaq_plugins_datamixer.extensions.utils.runner import ModelRunner
+from pymodaq_plugins_datamixer.extensions.utils.settings import (SettingsNode, apply_settings,
+                                                                 settings_to_dict)
+from pymodaq_plugins_datamixer.models.harmonics_model import DataMixerModelFit
+
+x = np.linspace(0, 10, 1000)
+dte = DataToExport('dte', data=[
+    DataRaw('Spectro', data=[np.exp(-(x - 3) ** 2)], origin='Spectro',
+            axes=[Axis('x', data=x, index=0)]),
+    DataRaw('Power', data=[np.array([2.])], origin='Det')])
+
+
+def test_settings_node():
+    settings = SettingsNode.from_params(DataMixerModelFit.params)
+    changed = []
+    settings.sigTreeValueChanged.connect(changed.append)
+    apply_settings(settings, {'find_peaks': {'tracking': {'half_window': 5}, 'refine': True},
+                              ('find_peaks', 'tracking'): True})
+    assert settings['find_peaks', 'tracking', 'half_window'] == 5
+    assert settings['find_peaks', 'tracking']
+    assert [param.name() for param in changed] == ['half_window', 'refine', 'tracking']
+    assert [param.name() for param in settings.child('find_peaks', 'options')] == [
+        'height', 'prominence', 'distance']
+    values = settings_to_dict(settings)
+    assert values['find_peaks'][('tracking', )] is True
+    other = SettingsNode.from_params(DataMixerModelFit.params)
+    apply_settings(other, values)
+    assert settings_to_dict(other) == values
+
+
+def test_equation_runner():
+    runner = ModelRunner('equation_model', {'edit_formula': '{Det/Power} * {Spectro/Spectro}'},
+                         data=dte)
+    computed = runner.process(dte)
+    assert np.allclose(computed[0].data[0], 2 * dte[0].data[0])
+    runner.set_settings({'edit_formula': '{Det/Power} + 1'})
+    assert runner.process(dte)[0].data[0][0] == 3.
+    assert runner.get_settings()['edit_formula'] == '{Det/Power} + 1'
+
+
+def test_runners_diagnostics():
+    diagnostics = Diagnostics(enabled=True)
+    for name in ['equation_model', 'equation_model (model00)']:
+        runner = ModelRunner('equation_model', {'edit_formula': '{Det/Power} + 1'}, data=dte,
+                             diagnostics=diagnostics, name=name)
+        runner.process(dte)
+    assert list(diagnostics.timings) == ['equation_model/Formula_000',
+                                         'equation_model (model00)/Formula_000']
+
+
+def test_harmonics_runner():
+    runner = ModelRunner(DataMixerModelFit, {'cropping': {'ind_min': -10, 'ind_max': 10}})
+    computed = runner.process(DataToExport('dte', data=[dte[0]]))
+    assert computed[0].size == 20
+    assert runner.model_settings['find_peaks', 'highest_peak'] == x[300]
+
+
+def test_qt_free():
+    code = ('import sys\n'
+            'from pymodaq_plugins_datamixer.extensions.utils.runner import ModelRunner\n'
+            'import pymodaq_plugins_datamixer.models.equation_model\n'
+            'import pymodaq_plugins_datamixer.models.fit_model\n'
+            'import pymodaq_plugins_datamixer.models.harmonics_model\n'
+            'import pymodaq_plugins_datamixer.models.statistics_model\n'
+            'print([name for name in sys.modules if name.split(".")[0] in '
+            '("qtpy", "PyQt5", "PyQt6", "PySide2", "PySide6", "pyqtgraph")])')
+    assert subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                          check=True).stdout.strip() == '[]'
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+from pymodaq_data.data import DataToExport, DataRaw
+
+from pymodaq_plugins_datamixer.extensions.utils.runner import ModelRunner
+from pymodaq_plugins_datamixer.models.statistics_model import RunningStatistics
+
+
+def test_running_statistics():
+    rng = np.random.default_rng(0)
+    frames = rng.normal(3, 2, (200, 5, 4))
+    statistics = RunningStatistics(alpha=0.2)
+    ema = frames[0]
+    for frame in frames:
+        statistics.update(frame)
+        ema = ema + 0.2 * (frame - ema)
+
+    assert statistics.count == 200
+    assert statistics.mean == pytest.approx(frames.mean(axis=0))
+    assert statistics.variance == pytest.approx(frames.var(axis=0, ddof=1))
+    assert statistics.std == pytest.approx(frames.std(axis=0, ddof=1))
+    assert np.all(statistics.min == frames.min(axis=0))
+    assert np.all(statistics.max == frames.max(axis=0))
+    assert statistics.ema == pytest.approx(ema)
+
+
+def test_running_statistics_reset():
+    statistics = RunningStatistics()
+    statistics.update(np.array([1., 2.]))
+    statistics.update(np.array([3., 4.]))
+    assert np.all(statistics.variance == 2.)
+
+    statistics.reset()
+    statistics.update(np.array([5.]))
+    assert statistics.count == 1
+    assert np.all(statistics.mean == 5.)
+    assert np.all(statistics.variance == 0.)
+
+
+def test_restart_frames():
+    def make_dte(value: float) -> DataToExport:
+        return DataToExport('dte', data=[DataRaw('Power', data=[np.array([value])], origin='Det')])
+
+    runner = ModelRunner('statistics_model', {'window': {'restart_frames': 3},
+                                              'sources': dict(all_items=['Det/Power'],
+                                                              selected=['Det/Power'])},
+                         data=make_dte(0.))
+    counts = []
+    for ind in range(7):
+        runner.process(make_dte(float(ind)))
+        counts.append(runner.model_settings['count'])
+    assert counts == [1, 2, 3, 1, 2, 3, 1]
+
+
+def test_reset_action():
+    def make_dte(value: float) -> DataToExport:
+        return DataToExport('dte', data=[DataRaw('Power', data=[np.array([value])], origin='Det')])
+
+    values = []
+
+    def set_value(param, value):
+        values.append(value)
+        param.setValue(value)
+
+    runner = ModelRunner('statistics_model', {'sources': dict(all_items=['Det/Power'],
+                                                              selected=['Det/Power'])},
+                         data=make_dte(0.), parameter_setter=set_value)
+    for ind in range(3):
+        runner.process(make_dte(float(ind)))
+    runner.model_settings.child('reset').activate()
+    runner.process(make_dte(0.))
+    runner.process(make_dte(0.))
+    assert values == [1, 2, 3, 1, 2]
+
+    runner.stop()
+    runner.model_settings.child('reset').activate()  # no longer forwarded to the model
+    runner.process(make_dte(0.))
+    assert values == [1, 2, 3, 1, 2, 3]
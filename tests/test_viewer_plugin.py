@@ -0,0 +1,86 @@
+import time
+
+import numpy as np
+from qtpy import QtCore
+
+from pymodaq_data.data import DataToExport, DataCalculated
+
+from pymodaq_plugins_datamixer.daq_viewer_plugins.plugins_0D.daq_0Dviewer_DataMixer import (
+    DAQ_0DViewer_DataMixer)
+
+
+class FakeDataMixer(QtCore.QObject):
+    dte_computed_signal = QtCore.Signal(DataToExport)
+
+    def __init__(self):
+        super().__init__()
+        self.snaps = 0
+
+    def snap(self):
+        self.snaps += 1
+
+
+def make_dte(value: float) -> DataToExport:
+    return DataToExport('computed', data=[DataCalculated('Formula', data=[np.array([value])])])
+
+
+def make_plugin(grab_mode: str, max_age: float = 0.):
+    controller = FakeDataMixer()
+    plugin = DAQ_0DViewer_DataMixer(None, None)
+    plugin.settings.child('grab_mode').setValue(grab_mode)
+    plugin.settings.child('max_age').setValue(max_age)
+    plugin.ini_detector(controller)
+    emitted = []
+    plugin.dte_signal.connect(emitted.append, QtCore.Qt.ConnectionType.DirectConnection)
+    return plugin, controller, emitted
+
+
+def test_snap_mode():
+    plugin, controller, emitted = make_plugin('Snap detectors')
+    plugin.grab_data()
+    assert controller.snaps == 1
+    controller.dte_computed_signal.emit(make_dte(1.))
+    assert len(emitted) == 1
+
+
+def test_cached_mode_waits_for_next():
+    plugin, controller, emitted = make_plugin('Cached result')
+    controller.dte_computed_signal.emit(make_dte(1.))
+    assert len(emitted) == 0
+    plugin.grab_data()
+    assert controller.snaps == 0
+    assert len(emitted) == 0
+    controller.dte_computed_signal.emit(make_dte(2.))
+    controller.dte_computed_signal.emit(make_dte(3.))
+    assert [dte[0][0][0] for dte in emitted] == [2.]
+
+
+def test_cached_mode_fresh():
+    plugin, controller, emitted = make_plugin('Cached result', max_age=200.)
+    controller.dte_computed_signal.emit(make_dte(1.))
+    plugin.grab_data()
+    assert [dte[0][0][0] for dte in emitted] == [1.]
+    time.sleep(0.3)
+    plugin.grab_data()
+    assert len(emitted) == 1
+    controller.dte_computed_signal.emit(make_dte(2.))
+    assert [dte[0][0][0] for dte in emitted] == [1., 2.]
+    assert controller.snaps == 0
+
+
+def test_cached_mode_served_once():
+    plugin, controller, emitted = make_plugin('Cached result', max_age=1000.)
+    controller.dte_computed_signal.emit(make_dte(1.))
+    plugin.grab_data()
+    plugin.grab_data()  # waits for the next result instead of emitting the same one again
+    assert [dte[0][0][0] for dte in emitted] == [1.]
+    controller.dte_computed_signal.emit(make_dte(2.))
+    assert [dte[0][0][0] for dte in emitted] == [1., 2.]
+
+
+def test_stop_cancels_waiting():
+    plugin, controller, emitted = make_plugin('Cached result')
+    plugin.grab_data()
+    plugin.stop()
+    controller.dte_computed_signal.emit(make_dte(1.))
+    assert len(emitted) == 0
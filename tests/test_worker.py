@@ -0,0 +1,111 @@
+import numpy as np
+import pytest
+from qtpy import QtCore
+
+from pymodaq_data.data import DataToExport, DataRaw
+
+from pymodaq_plugins_datamixer.extensions.utils.worker import ModelWorker, FrameCounters
+from pymodaq_plugins_datamixer.extensions.utils.diagnostics import (
+    Diagnostics, DIAGNOSTICS_NAME, MODEL_TIMING, LATENCY_TIMING, ERRORS_NAME)
+
+
+class IdentityModel:
+    def process_dte(self, dte: DataToExport) -> DataToExport:
+        return dte
+
+
+def test_latest_only():
+    worker = ModelWorker(IdentityModel(), maxsize=2, policy='Latest only')
+    assert all([worker.submit(DataToExport(f'{ind}')) for ind in range(2)])
+    assert not worker.submit(DataToExport('2'))
+    assert worker.counters == FrameCounters(received=3, processed=0, dropped=1)
+    assert [worker._queue.get_nowait().name for _ in range(2)] == ['1', '2']
+
+
+def test_every_nth():
+    worker = ModelWorker(IdentityModel(), maxsize=10, policy='Every Nth', every_n=3)
+    accepted = [worker.submit(DataToExport(f'{ind}')) for ind in range(7)]
+    assert accepted == [True, False, False, True, False, False, True]
+    assert worker.counters.dropped == 4
+    worker.counters.reset()  # the decimation phase is kept
+    accepted = [worker.submit(DataToExport(f'{ind}')) for ind in range(3)]
+    assert accepted == [False, False, True]
+
+
+def test_process_all():
+    worker = ModelWorker(IdentityModel(), maxsize=1, policy='Process all')
+    assert all([worker.submit(DataToExport(f'{ind}')) for ind in range(100)])
+    assert worker.counters.dropped == 0
+
+
+def test_run_and_stop():
+    worker = ModelWorker(IdentityModel(), policy='Process all')
+    for ind in range(5):
+        worker.submit(DataToExport(f'{ind}'))
+    worker.start()
+    worker.stop()
+    assert worker.isFinished()
+    assert worker.counters.processed + worker.counters.dropped == 5
+
+
+def test_requeue():
+    worker = ModelWorker(IdentityModel(), policy='Process all')
+    for ind in range(3):
+        worker.submit(DataToExport(f'{ind}'))
+    other = ModelWorker(IdentityModel(), maxsize=2, policy='Latest only')
+    other.requeue(worker.take_pending())
+    assert worker.counters.dropped == 0
+    assert other.counters.dropped == 1
+    assert [other._queue.get_nowait().name for _ in range(2)] == ['1', '2']
+
+
+def test_diagnostics():
+    diagnostics = Diagnostics(enabled=True, emit=True)
+    worker = ModelWorker(IdentityModel(), policy='Process all', diagnostics=diagnostics)
+    computed = []
+    worker.dte_computed.connect(computed.append, QtCore.Qt.ConnectionType.DirectConnection)
+    for ind in range(3):
+        worker.submit(DataToExport(f'{ind}', data=[DataRaw('a', data=[np.array([ind])])]))
+    worker.start()
+    for _ in range(500):
+        if worker.counters.processed == 3:
+            break
+        QtCore.QThread.msleep(10)
+    worker.stop()
+    assert diagnostics.get_timing(MODEL_TIMING).count == 3
+    assert diagnostics.get_timing(LATENCY_TIMING).count == 3
+    assert diagnostics.get_timing(MODEL_TIMING).p99 >= diagnostics.get_timing(MODEL_TIMING).last
+    assert computed[-1].get_full_names() == ['2/a', f'{DIAGNOSTICS_NAME}/{MODEL_TIMING}',
+                                             f'{DIAGNOSTICS_NAME}/{LATENCY_TIMING}',
+                                             f'{DIAGNOSTICS_NAME}/{ERRORS_NAME}']
+    errors = computed[-1].get_data_from_full_name(f'{DIAGNOSTICS_NAME}/{ERRORS_NAME}')
+    assert errors.units == '' and errors.labels == [MODEL_TIMING, LATENCY_TIMING]
+    assert computed[-1].get_data_from_full_name(f'{DIAGNOSTICS_NAME}/{MODEL_TIMING}').units == 'ms'
+
+
+def test_diagnostics_disabled():
+    diagnostics = Diagnostics()
+    worker = ModelWorker(IdentityModel(), policy='Process all', diagnostics=diagnostics)
+    worker.submit(DataToExport('0'))
+    worker.start()
+    for _ in range(500):
+        if worker.counters.processed == 1:
+            break
+        QtCore.QThread.msleep(10)
+    worker.stop()
+    assert worker.counters.processed == 1
+    assert diagnostics.timings == {}
+
+
+def test_diagnostics_records():
+    recorded = Diagnostics(enabled=True)
+    recorded.record('Formula_000', 0.1)
+    recorded.record_error('Formula_001')
+    diagnostics = Diagnostics()
+    diagnostics.add_records(recorded.take_records(), 'model')
+    recorded.record('Formula_000', 0.2)
+    diagnostics.add_records(recorded.take_records(), 'model')
+    assert recorded.take_records() == {}
+    assert diagnostics.get_timing('model/Formula_000').count == 2
+    assert diagnostics.get_timing('model/Formula_000').mean == pytest.approx(0.15)
+    assert diagnostics.get_timing('model/Formula_001').errors == 1